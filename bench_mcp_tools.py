@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Synthetic large-workspace benchmarks for the Cursor MCP Server tools.
+
+Generates a realistic workspace (deep source trees, a vendored node_modules,
+large text and binary files) and measures latency percentiles, throughput and
+peak RSS for list_files, search_code, read_file, run_command and
+workspace_tree. Results are written as JSON and can be compared against a
+previous run to catch regressions.
+
+Usage:
+    python bench_mcp_tools.py --profile medium --out bench_results.json
+    python bench_mcp_tools.py --files 200000 --compare bench_results.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource  # POSIX only
+except ImportError:  # pragma: no cover - Windows
+    resource = None
+
+PROFILES = {
+    "tiny": {"files": 300, "depth": 4, "vendor_fraction": 0.3, "large_text": 1, "large_binary": 1},
+    "medium": {"files": 10_000, "depth": 8, "vendor_fraction": 0.4, "large_text": 4, "large_binary": 4},
+    "large": {"files": 100_000, "depth": 10, "vendor_fraction": 0.5, "large_text": 8, "large_binary": 8},
+    "huge": {"files": 500_000, "depth": 12, "vendor_fraction": 0.5, "large_text": 16, "large_binary": 16},
+}
+
+TOOLS = ["list_files", "search_code", "read_file", "run_command", "workspace_tree"]
+
+_SOURCE_TEMPLATES = {
+    ".py": "import os\n\n\nclass Widget{n}:\n    \"\"\"Widget {n}.\"\"\"\n\n    def render(self, value):\n        # TODO: cache result {n}\n        return str(value) * {k}\n\n\ndef helper_{n}(x):\n    return x + {k}\n",
+    ".ts": "export interface Props{n} {{ id: number; name: string }}\n\nexport function render{n}(p: Props{n}): string {{\n  // FIXME: escape {k}\n  return `${{p.id}}-${{p.name}}`;\n}}\n",
+    ".js": "'use strict';\n\nmodule.exports = function fn{n}(a, b) {{\n  // TODO: validate {k}\n  return a + b + {k};\n}};\n",
+    ".md": "# Document {n}\n\nSome prose about component {n}.\n\n- item {k}\n- TODO: expand\n",
+    ".json": "{{\"name\": \"pkg-{n}\", \"version\": \"1.{k}.0\", \"private\": true}}\n",
+}
+
+
+# -----------------------------
+# Workspace generation
+# -----------------------------
+def generate_workspace(root: Path, files: int, depth: int = 8, vendor_fraction: float = 0.4,
+                       large_text: int = 4, large_binary: int = 4, seed: int = 1234) -> Dict[str, Any]:
+    """Create a synthetic workspace under root and return a manifest of what was written."""
+    rnd = random.Random(seed)
+    root.mkdir(parents=True, exist_ok=True)
+    exts = list(_SOURCE_TEMPLATES)
+    vendor_files = int(files * vendor_fraction)
+    source_files = max(0, files - vendor_files - large_text - large_binary)
+    total_bytes = 0
+    sample_paths: List[str] = []
+
+    def _write(rel: str, data: bytes) -> None:
+        nonlocal total_bytes
+        p = root / rel
+        p.parent.mkdir(parents=True, exist_ok=True)
+        with open(p, "wb") as f:
+            f.write(data)
+        total_bytes += len(data)
+
+    # Source tree: fan out across packages with varying depth
+    for i in range(source_files):
+        d = rnd.randint(1, depth)
+        parts = ["src"] + [f"pkg{rnd.randint(0, 7)}" for _ in range(d)]
+        ext = exts[i % len(exts)]
+        rel = "/".join(parts + [f"mod_{i}{ext}"])
+        _write(rel, _SOURCE_TEMPLATES[ext].format(n=i, k=rnd.randint(1, 99)).encode("utf-8"))
+        if len(sample_paths) < 64:
+            sample_paths.append(rel)
+
+    # Vendored node_modules: many small packages, shallow but wide
+    for i in range(vendor_files):
+        pkg = f"dep{i // 40}"
+        rel = f"node_modules/{pkg}/lib/file_{i}.js"
+        _write(rel, _SOURCE_TEMPLATES[".js"].format(n=i, k=i % 97).encode("utf-8"))
+
+    # Large text files just under the default byte limit, and large binaries
+    line = b"lorem ipsum dolor sit amet, consectetur adipiscing elit TODO\n"
+    for i in range(large_text):
+        _write(f"data/large_{i}.log", line * (1_900_000 // len(line)))
+    for i in range(large_binary):
+        _write(f"assets/blob_{i}.bin", rnd.randbytes(2_000_000) if hasattr(rnd, "randbytes") else os.urandom(2_000_000))
+
+    _write("README.md", b"# Synthetic benchmark workspace\n")
+    return {
+        "root": str(root),
+        "files": source_files + vendor_files + large_text + large_binary + 1,
+        "bytes": total_bytes,
+        "sample_paths": sample_paths,
+    }
+
+
+# -----------------------------
+# Measurement
+# -----------------------------
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile (pct in 0..100)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[k]
+
+
+def _peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS, kilobytes elsewhere
+    return int(rss / 1024) if sys.platform == "darwin" else int(rss)
+
+
+def _result_size(res: Any) -> int:
+    if isinstance(res, (list, tuple)):
+        return len(res)
+    if isinstance(res, dict):
+        return len(res.get("stdout", "")) + len(res.get("stderr", "")) if "returncode" in res else len(res)
+    text = getattr(res, "text", res)
+    return len(text) if isinstance(text, str) else 1
+
+
+async def _measure_tool(workspace: str, audit_log: str, tool: str, iterations: int,
+                        sample_paths: List[str], command: str) -> Dict[str, Any]:
+    import cursor_mcp_server as srv
+
+    srv.WORKSPACE_DIR = Path(workspace).resolve()
+    srv.AUDIT_LOG_PATH = Path(audit_log)
+    # Summaries depend on accumulated context and would make iterations incomparable.
+    srv.CONTEXT_SUMMARY_ENABLED = False
+    srv._context_tracker.enabled = False
+    srv._context_tracker.reset()
+    # Benchmarks should measure the tools, not the rate limiter.
+    for limiter in (srv.rate_read, srv.rate_write, srv.rate_cmd):
+        limiter.max_ops = 10 ** 9
+        limiter.events.clear()
+
+    calls = {
+        "list_files": lambda i: srv.list_files(".", "**/*", 10 ** 9),
+        "search_code": lambda i: srv.search_code(r"TODO|FIXME", "**/*", 200, 1),
+        "read_file": lambda i: srv.read_file(sample_paths[i % len(sample_paths)] if sample_paths else "README.md"),
+        "run_command": lambda i: srv.run_command(command),
+        "workspace_tree": lambda i: srv.workspace_tree(),
+    }
+    fn = calls[tool]
+    latencies: List[float] = []
+    items = 0
+    errors = 0
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        try:
+            res = await fn(i)
+            items += _result_size(res)
+        except Exception:
+            errors += 1
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+    total_s = sum(latencies) / 1000.0
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        "ops_per_s": round(iterations / total_s, 3) if total_s else 0.0,
+        "items_per_s": round(items / total_s, 1) if total_s else 0.0,
+        "peak_rss_kb": _peak_rss_kb(),
+    }
+
+
+def _child_measure(workspace: str, audit_log: str, tool: str, iterations: int,
+                   sample_paths: List[str], command: str) -> Dict[str, Any]:
+    # Runs in a fresh process so peak RSS is attributable to a single tool.
+    os.environ["WORKSPACE_DIR"] = workspace
+    os.environ["MCP_AUDIT_LOG"] = audit_log
+    os.environ["MCP_ENABLE_WATCHER"] = "false"
+    return asyncio.run(_measure_tool(workspace, audit_log, tool, iterations, sample_paths, command))
+
+
+def run_benchmark(workspace: Path, manifest: Dict[str, Any], tools: List[str], iterations: int,
+                  command: str = "python --version", isolate: bool = True) -> Dict[str, Any]:
+    """Measure each tool against an existing workspace and return the results document."""
+    audit_log = str(Path(tempfile.gettempdir()) / f"mcp_bench_audit_{os.getpid()}.log")
+    results: Dict[str, Any] = {}
+    for tool in tools:
+        args = (str(workspace), audit_log, tool, iterations, manifest.get("sample_paths", []), command)
+        if isolate:
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                results[tool] = pool.submit(_child_measure, *args).result()
+        else:
+            results[tool] = _child_measure(*args)
+    Path(audit_log).unlink(missing_ok=True)
+    return {
+        "version": 1,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "workspace": {k: v for k, v in manifest.items() if k != "sample_paths"},
+        "results": results,
+    }
+
+
+def compare_results(current: Dict[str, Any], previous: Dict[str, Any], threshold: float = 0.2,
+                    metrics: tuple = ("p50_ms", "p95_ms", "p99_ms")) -> List[Dict[str, Any]]:
+    """Return regressions where a latency metric grew by more than threshold (fraction)."""
+    regressions: List[Dict[str, Any]] = []
+    for tool, cur in current.get("results", {}).items():
+        prev = previous.get("results", {}).get(tool)
+        if not prev:
+            continue
+        for m in metrics:
+            old, new = prev.get(m) or 0.0, cur.get(m) or 0.0
+            if old > 0 and (new - old) / old > threshold:
+                regressions.append({"tool": tool, "metric": m, "previous": old, "current": new,
+                                    "change_pct": round((new - old) / old * 100, 1)})
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--profile", choices=sorted(PROFILES), default="medium")
+    ap.add_argument("--files", type=int, help="Override total file count (10k-500k are realistic)")
+    ap.add_argument("--workspace", type=Path, help="Reuse/generate the workspace here instead of a temp dir")
+    ap.add_argument("--tools", default=",".join(TOOLS), help="Comma list of tools to benchmark")
+    ap.add_argument("--iterations", type=int, default=5)
+    ap.add_argument("--command", default="python --version", help="Whitelisted command for run_command")
+    ap.add_argument("--out", type=Path, default=Path("bench_results.json"))
+    ap.add_argument("--compare", type=Path, help="Previous results JSON to compare against")
+    ap.add_argument("--threshold", type=float, default=0.2, help="Regression threshold (0.2 = +20%%)")
+    ap.add_argument("--no-isolate", action="store_true", help="Measure in-process (RSS is then cumulative)")
+    args = ap.parse_args(argv)
+
+    cfg = dict(PROFILES[args.profile])
+    if args.files:
+        cfg["files"] = args.files
+    tools = [t.strip() for t in args.tools.split(",") if t.strip()]
+    unknown = set(tools) - set(TOOLS)
+    if unknown:
+        ap.error(f"Unknown tools: {', '.join(sorted(unknown))}")
+
+    previous = json.loads(args.compare.read_text(encoding="utf-8")) if args.compare else None
+
+    with tempfile.TemporaryDirectory(prefix="mcp_bench_") as tmp:
+        ws = (args.workspace or Path(tmp) / "ws").resolve()
+        t0 = time.perf_counter()
+        manifest = generate_workspace(ws, **cfg)
+        print(f"Generated {manifest['files']} files ({manifest['bytes'] / 1e6:.1f} MB) "
+              f"in {time.perf_counter() - t0:.1f}s at {ws}", file=sys.stderr)
+        doc = run_benchmark(ws, manifest, tools, args.iterations, args.command, isolate=not args.no_isolate)
+
+    doc["profile"] = args.profile
+    args.out.write_text(json.dumps(doc, indent=2), encoding="utf-8")
+    for tool, r in doc["results"].items():
+        print(f"{tool:15s} p50={r['p50_ms']:9.2f}ms p95={r['p95_ms']:9.2f}ms p99={r['p99_ms']:9.2f}ms "
+              f"ops/s={r['ops_per_s']:8.2f} rss={r['peak_rss_kb']}KB errors={r['errors']}")
+
+    if previous is not None:
+        regressions = compare_results(doc, previous, args.threshold)
+        for reg in regressions:
+            print(f"REGRESSION {reg['tool']}.{reg['metric']}: {reg['previous']} -> {reg['current']} "
+                  f"(+{reg['change_pct']}%)", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
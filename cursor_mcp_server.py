@@ -6,9 +6,10 @@ Exposes a project workspace to ChatGPT Developer Mode using the official
 MCP Python SDK over stdio. Includes:
 
 - Tools: read_file, list_files, write_file (confirmable), run_command (whitelist),
-         get_diagnostics, search_code
+         get_diagnostics, search_code, find_symbol, outline, git_status, git_diff, find_file,
+         workspace_delta, workspace_tree_snapshot, run_impacted_tests, audit_query
 
-- Resources: workspace_tree, workspace_summary, readme
+- Resources: workspace_tree, workspace_summary, workspace_stats, readme
 
 - Prompts: code_review, debug_assistant, refactor_suggestion
 
@@ -23,22 +24,43 @@ Requires: `pip install mcp`
 from __future__ import annotations
 
 import asyncio
-import fnmatch
+import base64
+import bisect
+import functools
+import gzip
+import hashlib
+import heapq
 import json
+import itertools
 import logging
+import multiprocessing
 import os
+import queue
 import re
+import subprocess
 import sys
+import tempfile
+import threading
 import time
+import zlib
 from dataclasses import dataclass, asdict
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Callable
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Callable, Union
 from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 
-# MCP SDK
-from mcp.server import Server
-from mcp.types import ResourceContents
-from mcp.transport import stdio_server
+# The MCP SDK (`mcp.server`, `mcp.types`, `mcp.transport`) and OpenTelemetry are
+# imported on first use: the HTTP bridges call tools directly and never need the SDK.
+
+@functools.lru_cache(maxsize=None)
+def _otel_trace():
+    """OpenTelemetry trace API for per-stage spans (`pip install opentelemetry-api`), or None."""
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        return None
+    return trace
 
 # -----------------------------
 # Configuration
@@ -76,6 +98,16 @@ ALLOWED_COMMANDS = [
     r"^pnpm\s+run\s+test(?::[\w\-]+)?$"
 ]
 
+# Subprocesses run_command may have in flight at once (test shards count individually)
+MAX_CONCURRENT_COMMANDS = int(os.environ.get("MCP_MAX_CONCURRENT_COMMANDS", min(4, os.cpu_count() or 1)))
+
+# HTTP bridge admission control: requests in flight overall / per client, and bounded wait queues
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("MCP_ADMISSION_MAX_CONCURRENT", 8))
+ADMISSION_PER_CLIENT = int(os.environ.get("MCP_ADMISSION_PER_CLIENT", 2))
+ADMISSION_QUEUE_PER_CLIENT = int(os.environ.get("MCP_ADMISSION_QUEUE_PER_CLIENT", 4))
+ADMISSION_QUEUE_TOTAL = int(os.environ.get("MCP_ADMISSION_QUEUE_TOTAL", 32))
+ADMISSION_QUEUE_TIMEOUT_S = float(os.environ.get("MCP_ADMISSION_QUEUE_TIMEOUT_S", 10))
+
 # Denylist globs excluded from reads/searches unless explicitly targeted
 READ_DENYLIST = [
     # VCS / vendors / envs
@@ -87,6 +119,7 @@ READ_DENYLIST = [
     "**/venv/**",
     "**/.tox/**",
     "**/.cache/**",
+    "**/.mcp_cache/**",
     
     # Secrets & credentials
     "**/.env*",
@@ -113,7 +146,9 @@ MAX_FILE_BYTES = int(os.environ.get("MCP_MAX_FILE_BYTES", 2_000_000))
 
 # Audit rotation settings
 _MAX_AUDIT_BYTES = int(os.environ.get("MCP_MAX_AUDIT_BYTES", 10_000_000))  # 10MB default
-_MAX_AUDIT_BACKUPS = 3
+# Rotated segments are gzipped in the background; oldest are dropped past either limit (0 disables a limit)
+AUDIT_RETAIN_BYTES = int(os.environ.get("MCP_AUDIT_RETAIN_BYTES", 500_000_000))
+AUDIT_RETAIN_DAYS = float(os.environ.get("MCP_AUDIT_RETAIN_DAYS", 90))
 
 # Context summarization settings
 # Auto-summarize when context reaches 85% of max
@@ -124,23 +159,118 @@ CONTEXT_SUMMARY_ENABLED = os.environ.get("MCP_CONTEXT_SUMMARY_ENABLED", "true").
 # Watcher settings
 WATCHER_ENABLED = os.environ.get("MCP_ENABLE_WATCHER", "true").lower() == "true"
 
+# Command telemetry: every run_command outcome goes to a SQLite file in the cache dir (oldest rows pruned)
+COMMAND_TELEMETRY_ENABLED = os.environ.get("MCP_COMMAND_TELEMETRY", "true").lower() == "true"
+COMMAND_TELEMETRY_MAX_ROWS = int(os.environ.get("MCP_COMMAND_TELEMETRY_MAX_ROWS", 50_000))
+
+# Derived state (profiles, indexes). Relative paths are resolved against the workspace.
+CACHE_DIR = os.environ.get("MCP_CACHE_DIR", ".mcp_cache")
+
+# Symbol index: min seconds between full re-stat passes (writes through write_file invalidate immediately)
+SYMBOL_INDEX_TTL = float(os.environ.get("MCP_SYMBOL_INDEX_TTL", 2.0))
+
+# workspace_stats: min seconds between full re-stat passes without the watcher (write_file updates immediately)
+WORKSPACE_STATS_TTL = float(os.environ.get("MCP_WORKSPACE_STATS_TTL", 5.0))
+
+# find_file: min seconds between workspace index refreshes without the watcher (new files from write_file show up immediately)
+FIND_FILE_TTL = float(os.environ.get("MCP_FIND_FILE_TTL", 2.0))
+
+# Per-stage timing: histogram buckets (ms) and OpenTelemetry span export
+STAGE_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000, 30000)
+STAGE_SPANS_ENABLED = os.environ.get("MCP_STAGE_SPANS", "true").lower() == "true"
+
+# Honour .gitignore/.ignore files when listing and searching (per-call override: respect_gitignore=)
+RESPECT_GITIGNORE = os.environ.get("MCP_RESPECT_GITIGNORE", "true").lower() == "true"
+
+# search_code regexes run in a killable worker process with a per-query deadline (seconds).
+# The pre-check rejects nested unbounded quantifiers like (a+)+ ("reject" | "off").
+REGEX_SANDBOX_ENABLED = os.environ.get("MCP_REGEX_SANDBOX", "true").lower() == "true"
+REGEX_TIMEOUT_S = float(os.environ.get("MCP_REGEX_TIMEOUT", 10.0))
+REGEX_PRECHECK = os.environ.get("MCP_REGEX_PRECHECK", "reject").lower()
+
+# Filesystem change watcher ("auto" = inotify on Linux, else polling | "inotify" | "poll" | "off").
+# While it runs, indexes skip their re-stat passes and only revisit changed paths.
+FS_WATCH_MODE = os.environ.get("MCP_FS_WATCH", "auto").lower()
+FS_WATCH_DEBOUNCE_MS = int(os.environ.get("MCP_FS_WATCH_DEBOUNCE_MS", 150))
+FS_WATCH_POLL_S = float(os.environ.get("MCP_FS_WATCH_POLL_S", 2.0))
+FS_WATCH_NOTIFY = os.environ.get("MCP_FS_WATCH_NOTIFY", "true").lower() == "true"
+
 # -----------------------------
 # Utilities: sandboxing, audit, rate-limit
 # -----------------------------
-def _is_relative_to(base: Path, target: Path) -> bool:
-    try:
-        target.resolve().relative_to(base.resolve())
-        return True
-    except Exception:
-        return False
+def _within(root: str, resolved: str) -> bool:
+    return resolved == root or resolved.startswith(root.rstrip(os.sep) + os.sep)
 
 def in_workspace(path: Path) -> bool:
-    return _is_relative_to(WORKSPACE_DIR, path)
+    # WORKSPACE_DIR is resolved once at startup
+    return _within(str(WORKSPACE_DIR), os.path.realpath(path))
+
+class PathResolver:
+    """Resolves joined workspace paths for safe_join, caching symlink-free results.
+    
+    A path is cached only when it resolves to itself (no symlink or `..`
+    involved) and its directory is watched by inotify. Any change that
+    could make it resolve elsewhere, such as a component replaced by a
+    symlink, is then an event in a watched directory, and entries are only
+    trusted while the watcher's raw event counter (bumped before debouncing)
+    is unchanged and no events are queued unread on the inotify fd, so a
+    change is seen even before the watcher thread has read it. Without an
+    inotify watcher nothing is cached and a lookup costs one realpath plus
+    a prefix check.
+    """
+    
+    MAX_ENTRIES = 50_000
+    
+    def __init__(self):
+        self._cache: Dict[str, tuple[str, int]] = {}  # joined path -> (resolved, watcher change token)
+        self.stats = {"hits": 0, "misses": 0, "cached": 0, "escapes": 0}
+    
+    def resolve(self, joined: str) -> str:
+        token = _fs_watcher.change_token()
+        if token is not None:
+            hit = self._cache.get(joined)
+            # Unread events count as a change; the counter is re-read after that check
+            if (hit is not None and hit[1] == token and not _fs_watcher.unread_events()
+                    and _fs_watcher.change_token() == token):
+                self.stats["hits"] += 1
+                return hit[0]
+        self.stats["misses"] += 1
+        root = str(WORKSPACE_DIR)
+        resolved = os.path.realpath(joined)
+        if not _within(root, resolved):
+            self.stats["escapes"] += 1
+            raise PermissionError(f"Path escapes workspace: {resolved}")
+        if token is not None and resolved == os.path.normpath(joined):
+            rel_dir = os.path.dirname(resolved[len(root):].lstrip(os.sep)).replace(os.sep, "/")
+            if _fs_watcher.watches(rel_dir) and _fs_watcher.change_token() == token:
+                if len(self._cache) >= self.MAX_ENTRIES:
+                    self._cache.clear()
+                self._cache[joined] = (resolved, token)
+                self.stats["cached"] += 1
+        return resolved
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"entries": len(self._cache), **self.stats}
+
+# Global path resolver
+_path_resolver = PathResolver()
 
 def safe_join(*parts: str | Path) -> Path:
-    p = (WORKSPACE_DIR.joinpath(*map(str, parts))).resolve()
-    if not in_workspace(p):
-        raise PermissionError(f"Path escapes workspace: {p}")
+    return Path(_path_resolver.resolve(os.path.join(WORKSPACE_DIR, *map(str, parts))))
+
+def safe_join_many(paths: List[str | Path]) -> List[Path]:
+    """safe_join for a batch of workspace paths; rejects the whole batch if any escapes."""
+    root = os.fspath(WORKSPACE_DIR)
+    resolve = _path_resolver.resolve
+    return [Path(resolve(os.path.join(root, os.fspath(p)))) for p in paths]
+
+def _cache_dir(*parts: str) -> Path:
+    """Return (and create) a directory under the server cache dir."""
+    base = Path(CACHE_DIR)
+    if not base.is_absolute():
+        base = WORKSPACE_DIR / base
+    p = base.joinpath(*parts)
+    p.mkdir(parents=True, exist_ok=True)
     return p
 
 @dataclass
@@ -150,34 +280,409 @@ class AuditEntry:
     args: Dict[str, Any]
     ok: bool
     meta: Dict[str, Any]
+    client: Optional[str] = None  # defaults to the caller installed via audit_client()
 
-def _rotate_audit_if_needed() -> None:
-    """Rotate audit log if it exceeds size limit."""
+# Per-request client identity for audit entries (set by the HTTP bridges)
+_audit_client: ContextVar[Optional[str]] = ContextVar("mcp_audit_client", default=None)
+
+@contextmanager
+def audit_client(client: Optional[str]) -> Iterator[None]:
+    """Attribute audit entries written inside the block to `client`."""
+    token = _audit_client.set(client)
     try:
-        if AUDIT_LOG_PATH.exists() and AUDIT_LOG_PATH.stat().st_size > _MAX_AUDIT_BYTES:
-            # Rotate backups: .log.3 -> .log.4 (delete), .log.2 -> .log.3, .log.1 -> .log.2, .log -> .log.1
-            for i in range(_MAX_AUDIT_BACKUPS, 0, -1):
-                src = AUDIT_LOG_PATH.with_suffix(AUDIT_LOG_PATH.suffix + (f".{i-1}" if i > 1 else ""))
-                dst = AUDIT_LOG_PATH.with_suffix(AUDIT_LOG_PATH.suffix + f".{i}")
-                if i == 1:
-                    src = AUDIT_LOG_PATH
-                if Path(src).exists():
-                    Path(dst).unlink(missing_ok=True)
-                    Path(src).replace(dst)
-    except Exception:
-        # Never crash due to rotation failures
-        pass
+        yield
+    finally:
+        _audit_client.reset(token)
+
+# Serializes audit appends with the background rotator's rename
+_audit_lock = threading.Lock()
 
 def write_audit(entry: AuditEntry) -> None:
     try:
         AUDIT_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
-        _rotate_audit_if_needed()
-        with AUDIT_LOG_PATH.open("a", encoding="utf-8") as f:
-            f.write(json.dumps(asdict(entry), ensure_ascii=False) + "\n")
+        # Fixed key order with the small fields first lets audit_query index lines without json.loads
+        record = {"ts": entry.ts, "tool": entry.tool, "ok": entry.ok}
+        client = entry.client if entry.client is not None else _audit_client.get()
+        if client is not None:
+            record["client"] = client
+        record["args"] = entry.args
+        record["meta"] = entry.meta
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with _audit_lock:
+            with AUDIT_LOG_PATH.open("a", encoding="utf-8") as f:
+                f.write(line)
+                size = f.tell()
+        if size > _MAX_AUDIT_BYTES:
+            _audit_rotator.request()
     except Exception:
         # Never crash the tool path due to audit failures
         pass
 
+# -----------------------------
+# Audit log index & queries
+# -----------------------------
+_AUDIT_HEAD = re.compile(rb'^\{"ts": (-?[\d.eE+-]+), "tool": "((?:[^"\\]|\\.)*)", "ok": (true|false)(?:, "client": "((?:[^"\\]|\\.)*)")?')
+
+def _rotated_audit_segments() -> List[tuple[Path, os.stat_result]]:
+    """Rotated segments (`<log>.<stamp>[.gz]`, legacy `<log>.N`) with their stat, newest first."""
+    found = []
+    for p in AUDIT_LOG_PATH.parent.glob(AUDIT_LOG_PATH.name + ".*"):
+        if p.name.endswith((".idx", ".tmp")):
+            continue
+        try:
+            found.append((p, p.stat()))
+        except OSError:
+            continue
+    found.sort(key=lambda item: (item[1].st_mtime, item[0].name), reverse=True)
+    return found
+
+def _audit_segments() -> List[Path]:
+    """Audit log segments, newest first (the live log, then rotated segments)."""
+    live = [AUDIT_LOG_PATH] if AUDIT_LOG_PATH.exists() else []
+    return live + [p for p, _ in _rotated_audit_segments()]
+
+def _json_str(raw: bytes) -> str:
+    return json.loads(b'"' + raw + b'"') if b"\\" in raw else raw.decode("utf-8", errors="replace")
+
+def _audit_line_head(line: bytes) -> Optional[tuple[float, str, bool, Optional[str]]]:
+    """(ts, tool, ok, client) of a JSONL audit line, from its prefix when possible."""
+    m = _AUDIT_HEAD.match(line)
+    if m:
+        client = _json_str(m.group(4)) if m.group(4) is not None else None
+        return float(m.group(1)), _json_str(m.group(2)), m.group(3) == b"true", client
+    # Lines written before the fixed key order (or by other writers)
+    try:
+        rec = json.loads(line)
+        return float(rec.get("ts", 0)), str(rec.get("tool", "")), bool(rec.get("ok")), rec.get("client")
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+class AuditIndex:
+    """Sidecar index (`<segment>.idx`) of time buckets per audit log segment.
+    
+    Each bucket covers up to BUCKET_S seconds or BUCKET_BYTES of log and
+    records its byte range, time range, tools, clients and failure count,
+    so queries seek straight to candidate ranges. Indexes are extended
+    from the last indexed offset on demand and rebuilt if the segment was
+    replaced (inode or first-line mismatch).
+    
+    Compressed segments (`.gz`) hold one gzip member per bucket (small
+    neighbouring buckets merged) and their byte ranges are member
+    boundaries, so a bucket is still read on its own.
+    """
+    
+    BUCKET_S = 300
+    BUCKET_BYTES = 1 << 20
+    MEMBER_BYTES = 64 << 10  # sparse buckets are merged up to this size when compressed
+    VERSION = 1
+    
+    def __init__(self):
+        self._cache: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()  # queries run in worker threads alongside the rotator
+        self.stats = {"indexed_bytes": 0, "rebuilds": 0, "scanned_bytes": 0, "skipped_bytes": 0}
+    
+    @staticmethod
+    def _identity(path: Path, st: os.stat_result) -> tuple[int, str]:
+        with open(path, "rb") as f:
+            head = f.read(256)
+        return st.st_ino, hashlib.sha1(head).hexdigest()
+    
+    def _load(self, path: Path, st: os.stat_result) -> Dict[str, Any]:
+        key = str(path)
+        ino, head = self._identity(path, st)
+        idx = self._cache.get(key)
+        if idx is None:
+            try:
+                idx = json.loads(Path(key + ".idx").read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                idx = None
+        if (not idx or idx.get("v") != self.VERSION or idx.get("ino") != ino
+                or idx.get("head") != head or idx.get("size", 0) > st.st_size):
+            if idx:
+                self.stats["rebuilds"] += 1
+            idx = {"v": self.VERSION, "ino": ino, "head": head, "size": 0, "buckets": []}
+        self._cache[key] = idx
+        return idx
+    
+    def _save(self, path: Path, idx: Dict[str, Any]) -> None:
+        try:
+            _atomic_write_text(Path(str(path) + ".idx"), json.dumps(idx, separators=(",", ":")))
+        except OSError:
+            pass
+    
+    def forget(self, path: Path) -> None:
+        with self._lock:
+            self._cache.pop(str(path), None)
+    
+    def index(self, path: Path) -> Dict[str, Any]:
+        """Bring the segment's index up to date and return it."""
+        with self._lock:
+            return self._index(path)
+    
+    def _index(self, path: Path) -> Dict[str, Any]:
+        st = path.stat()
+        idx = self._load(path, st)
+        if idx["size"] >= st.st_size:
+            return idx
+        if path.suffix == ".gz":
+            return self._index_members(path, idx)
+        buckets = idx["buckets"]
+        # Reopen the last bucket so it keeps growing until it is full
+        cur = buckets.pop() if buckets else None
+        offset = idx["size"]
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partially written line; picked up next time
+                head = _audit_line_head(line)
+                end = offset + len(line)
+                if head is not None:
+                    ts, tool, ok, client = head
+                    if cur is None or ts >= cur[0] + self.BUCKET_S or ts < cur[0] or end - cur[1] > self.BUCKET_BYTES:
+                        if cur is not None:
+                            buckets.append(cur)
+                        # [bucket start ts, start offset, end offset, min ts, max ts, tools, clients, failures]
+                        cur = [ts - ts % self.BUCKET_S, offset, end, ts, ts, [], [], 0]
+                    cur[2] = end
+                    cur[3] = min(cur[3], ts)
+                    cur[4] = max(cur[4], ts)
+                    if tool not in cur[5]:
+                        cur[5].append(tool)
+                    if client is not None and client not in cur[6]:
+                        cur[6].append(client)
+                    cur[7] += not ok
+                elif cur is not None:
+                    cur[2] = end
+                offset = end
+        if cur is not None:
+            buckets.append(cur)
+        self.stats["indexed_bytes"] += offset - idx["size"]
+        idx["size"] = offset
+        self._save(path, idx)
+        return idx
+    
+    def _index_members(self, path: Path, idx: Dict[str, Any]) -> Dict[str, Any]:
+        """Rebuild a compressed segment's index with one bucket per gzip member."""
+        raw = path.read_bytes()
+        view = memoryview(raw)
+        buckets = []
+        pos = 0
+        while pos < len(raw):
+            d = zlib.decompressobj(wbits=31)
+            data = d.decompress(view[pos:])
+            if not d.eof:
+                break  # truncated member
+            end = len(raw) - len(d.unused_data)
+            heads = [h for h in map(_audit_line_head, data.splitlines()) if h is not None]
+            if heads:
+                lo = min(h[0] for h in heads)
+                buckets.append([lo - lo % self.BUCKET_S, pos, end, lo, max(h[0] for h in heads),
+                                sorted({h[1] for h in heads}), sorted({h[3] for h in heads if h[3] is not None}),
+                                sum(not h[2] for h in heads)])
+            pos = end
+        idx.update(gz=True, size=len(raw), buckets=buckets)
+        self.stats["indexed_bytes"] += len(raw)
+        self._save(path, idx)
+        return idx
+    
+    def compress(self, src: Path, dst: Path) -> Optional[Path]:
+        """Re-encode segment `src` as `dst`, gzipped one member per bucket, and remove `src`.
+        
+        The new sidecar is written alongside, so the segment stays seekable
+        without a rebuild. Returns None if `src` held no entries.
+        """
+        with self._lock:
+            idx = self._index(src)
+            st = src.stat()
+            groups: List[list] = []
+            for b in idx["buckets"]:
+                if groups and groups[-1][2] - groups[-1][1] < self.MEMBER_BYTES:
+                    g = groups[-1]
+                    g[2], g[3], g[4] = b[2], min(g[3], b[3]), max(g[4], b[4])
+                    g[5].extend(t for t in b[5] if t not in g[5])
+                    g[6].extend(c for c in b[6] if c not in g[6])
+                    g[7] += b[7]
+                else:
+                    groups.append([*b[:5], list(b[5]), list(b[6]), b[7]])
+            buckets = []
+            if groups:
+                tmp = dst.with_name(dst.name + ".tmp")
+                with open(src, "rb") as f, open(tmp, "wb") as out:
+                    for i, b in enumerate(groups):
+                        start = 0 if i == 0 else b[1]  # keep any unparsable leading lines
+                        f.seek(start)
+                        member_start = out.tell()
+                        out.write(gzip.compress(f.read(b[2] - start), compresslevel=6, mtime=0))
+                        buckets.append([b[0], member_start, out.tell(), *b[3:]])
+                # Keep the segment's last-write time; segments are ordered by mtime
+                os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+                tst = tmp.stat()
+                ino, head = self._identity(tmp, tst)
+                cidx = {"v": self.VERSION, "ino": ino, "head": head, "size": tst.st_size, "gz": True, "buckets": buckets}
+                self._save(dst, cidx)
+                tmp.replace(dst)
+                self._cache[str(dst)] = cidx
+            self._cache.pop(str(src), None)
+            src.unlink(missing_ok=True)
+            Path(str(src) + ".idx").unlink(missing_ok=True)
+            return dst if buckets else None
+    
+    def query(self, tool: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+              ok: Optional[bool] = None, client: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
+        """Matching entries, newest first, reading only buckets that can contain a match."""
+        lo = since if since is not None else float("-inf")
+        hi = until if until is not None else float("inf")
+        entries: List[Dict[str, Any]] = []
+        scanned = skipped = 0
+        truncated = False
+        for path in _audit_segments():
+            try:
+                with self._lock:
+                    idx = self._index(path)
+                    buckets, gz = list(idx["buckets"]), bool(idx.get("gz"))
+                f = open(path, "rb")
+            except OSError:
+                continue  # rotated away or expired meanwhile
+            with f:
+                for b in reversed(buckets):
+                    start, end = b[1], b[2]
+                    if (b[4] < lo or b[3] > hi or (tool is not None and tool not in b[5])
+                            or (client is not None and client not in b[6]) or (ok is False and not b[7])):
+                        skipped += end - start
+                        continue
+                    f.seek(start)
+                    data = f.read(end - start)
+                    scanned += len(data)
+                    if gz:
+                        try:
+                            data = gzip.decompress(data)
+                        except (OSError, EOFError, zlib.error):
+                            continue
+                    for line in reversed(data.splitlines()):
+                        head = _audit_line_head(line)
+                        if head is None:
+                            continue
+                        ts, line_tool, line_ok, line_client = head
+                        if not lo <= ts <= hi or (tool is not None and line_tool != tool):
+                            continue
+                        if (ok is not None and line_ok != ok) or (client is not None and line_client != client):
+                            continue
+                        if len(entries) >= limit:
+                            truncated = True
+                            break
+                        try:
+                            entries.append(json.loads(line))
+                        except ValueError:
+                            continue
+                    if truncated:
+                        break
+            if truncated:
+                break
+        self.stats["scanned_bytes"] += scanned
+        self.stats["skipped_bytes"] += skipped
+        return {"entries": entries, "truncated": truncated, "scanned_bytes": scanned, "skipped_bytes": skipped}
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"segments": len(self._cache), **self.stats}
+
+# Global audit index
+_audit_index = AuditIndex()
+
+class AuditRotator:
+    """Rotates the audit log off the tool-call path.
+    
+    write_audit only signals once the live log passes MCP_MAX_AUDIT_BYTES;
+    a daemon thread renames it to `<log>.<UTC stamp>`, re-encodes every
+    uncompressed rotated segment (including legacy `<log>.N` backups) with
+    AuditIndex.compress, then drops the oldest segments beyond
+    MCP_AUDIT_RETAIN_BYTES of compressed history or MCP_AUDIT_RETAIN_DAYS.
+    """
+    
+    INTERVAL_S = 300.0
+    
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._pass_lock = threading.Lock()
+        self.stats = {"rotations": 0, "compressed": 0, "bytes_in": 0, "bytes_out": 0, "expired": 0,
+                      "errors": 0, "last_error": None}
+    
+    def request(self) -> None:
+        """Schedule a pass (starting the thread on first use)."""
+        self._wake.set()
+        if self._thread is None or not self._thread.is_alive():
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="mcp-audit-rotator", daemon=True)
+                    self._thread.start()
+    
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.INTERVAL_S)
+            self._wake.clear()
+            try:
+                self.run_once()
+            except Exception as e:
+                self.stats["errors"] += 1
+                self.stats["last_error"] = f"{type(e).__name__}: {e}"
+                LOG.warning("Audit rotation failed: %s", e)
+    
+    @staticmethod
+    def _segment_path(ts: float) -> Path:
+        stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(ts))
+        for n in itertools.count():
+            p = AUDIT_LOG_PATH.with_name(f"{AUDIT_LOG_PATH.name}.{stamp}" + (f"-{n}" if n else ""))
+            if not p.exists() and not Path(f"{p}.gz").exists():
+                return p
+    
+    def run_once(self) -> None:
+        """Rotate if the live log is over the limit, compress, then apply retention."""
+        with self._pass_lock:
+            with _audit_lock:
+                try:
+                    live = AUDIT_LOG_PATH.stat().st_size
+                except OSError:
+                    live = 0
+                if live > _MAX_AUDIT_BYTES:
+                    pending = self._segment_path(time.time())
+                    AUDIT_LOG_PATH.replace(pending)
+                    idx = Path(f"{AUDIT_LOG_PATH}.idx")
+                    if idx.exists():
+                        idx.replace(Path(f"{pending}.idx"))
+                    _audit_index.forget(AUDIT_LOG_PATH)
+                    self.stats["rotations"] += 1
+            
+            for p, st in _rotated_audit_segments():
+                if p.suffix == ".gz":
+                    continue
+                legacy = p.name[len(AUDIT_LOG_PATH.name) + 1:].isdigit()
+                dst = Path(f"{self._segment_path(st.st_mtime) if legacy else p}.gz")
+                out = _audit_index.compress(p, dst)
+                self.stats["compressed"] += 1
+                self.stats["bytes_in"] += st.st_size
+                self.stats["bytes_out"] += out.stat().st_size if out else 0
+            
+            now = time.time()
+            total = 0
+            for p, st in _rotated_audit_segments():
+                total += st.st_size
+                too_old = AUDIT_RETAIN_DAYS > 0 and now - st.st_mtime > AUDIT_RETAIN_DAYS * 86400
+                if too_old or (AUDIT_RETAIN_BYTES > 0 and total > AUDIT_RETAIN_BYTES):
+                    _audit_index.forget(p)
+                    p.unlink(missing_ok=True)
+                    Path(f"{p}.idx").unlink(missing_ok=True)
+                    self.stats["expired"] += 1
+    
+    def get_status(self) -> Dict[str, Any]:
+        segments = _rotated_audit_segments()
+        return {"segments": len(segments), "bytes": sum(st.st_size for _, st in segments),
+                "retain_bytes": AUDIT_RETAIN_BYTES, "retain_days": AUDIT_RETAIN_DAYS, **self.stats}
+
+# Global audit rotator
+_audit_rotator = AuditRotator()
+
 class FixedWindowRateLimiter:
     def __init__(self, max_ops: int, window_seconds: int):
         self.max_ops = max_ops
@@ -199,20 +704,195 @@ rate_cmd = FixedWindowRateLimiter(*RATE_LIMITS["command"])
 # -----------------------------
 # Logging & Watcher Setup
 # -----------------------------
-# Configure logging to stderr so it's visible in terminal
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] [%(levelname)s] [WATCHER] %(message)s',
-    datefmt='%H:%M:%S',
-    stream=sys.stderr
-)
+def _configure_logging() -> None:
+    """Log to stderr so it's visible in terminal (stdio entry point only; importers keep their own config)."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='[%(asctime)s] [%(levelname)s] [WATCHER] %(message)s',
+        datefmt='%H:%M:%S',
+        stream=sys.stderr
+    )
+
 LOG = logging.getLogger(__name__)
 
+# -----------------------------
+# Command Telemetry
+# -----------------------------
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+class CommandTelemetry:
+    """Persists run_command outcomes to SQLite and aggregates them per whitelist pattern.
+    
+    One row per command (duration, return code, output size, timeout flag);
+    the table is pruned to max_rows. record() only queues the row: a daemon
+    thread batches inserts, so the event loop never waits on SQLite. Stats
+    report count, failure rate, p50/p95/p99 duration and output size per
+    pattern (each percentile is a single-row query), and flag patterns whose
+    recent median is well above their long-run median.
+    """
+    
+    RECENT = 20
+    REGRESSION_FACTOR = 1.5
+    
+    def __init__(self, enabled: bool = COMMAND_TELEMETRY_ENABLED, max_rows: int = COMMAND_TELEMETRY_MAX_ROWS):
+        self.enabled = enabled
+        self.max_rows = max_rows
+        self._db = None
+        self._db_path: Optional[Path] = None
+        self._db_lock = threading.Lock()
+        self._pending: "queue.Queue[tuple]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._inserts = 0
+        self.stats = {"recorded": 0, "errors": 0}
+    
+    def _conn(self):
+        import sqlite3
+        
+        path = _cache_dir("telemetry") / "commands.sqlite"
+        if self._db is None or self._db_path != path:
+            if self._db is not None:
+                self._db.close()
+            db = sqlite3.connect(str(path), check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS commands (ts REAL, pattern TEXT, command TEXT, rc INTEGER,"
+                " ms INTEGER, output_bytes INTEGER, timed_out INTEGER)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS commands_pattern_ts ON commands (pattern, ts)")
+            db.execute("CREATE INDEX IF NOT EXISTS commands_pattern_ms ON commands (pattern, ms)")
+            self._db, self._db_path = db, path
+        return self._db
+    
+    @staticmethod
+    def pattern_for(command: str) -> str:
+        """Source of the first whitelist pattern the command matches ("other" if none)."""
+        command = command.strip()
+        for p in _allowed_patterns():
+            if p.fullmatch(command):
+                return p.pattern
+        return "other"
+    
+    def record(self, command: str, returncode: int, elapsed_ms: int, output_size: int, timed_out: bool = False) -> None:
+        """Queue one outcome for the writer thread (starting it on first use)."""
+        if not self.enabled:
+            return
+        self._pending.put((time.time(), command, returncode, elapsed_ms, output_size, int(timed_out)))
+        if self._thread is None or not self._thread.is_alive():
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="mcp-command-telemetry", daemon=True)
+                    self._thread.start()
+    
+    def flush(self) -> None:
+        """Block until every queued outcome is written."""
+        if self._thread is not None:
+            self._pending.join()
+    
+    def _run(self) -> None:
+        while True:
+            batch = [self._pending.get()]
+            while True:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                self.stats["errors"] += 1
+                LOG.warning(f"command telemetry write failed: {e}")
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+    
+    def _write(self, batch: List[tuple]) -> None:
+        rows = [(ts, self.pattern_for(cmd), cmd[:500], rc, ms, size, timed_out) for ts, cmd, rc, ms, size, timed_out in batch]
+        with self._db_lock:
+            db = self._conn()
+            with db:
+                db.executemany("INSERT INTO commands VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                before, self._inserts = self._inserts, self._inserts + len(rows)
+                if before // 500 != self._inserts // 500:
+                    db.execute("DELETE FROM commands WHERE rowid <= (SELECT MAX(rowid) FROM commands) - ?", (self.max_rows,))
+        self.stats["recorded"] += len(rows)
+    
+    @staticmethod
+    def _nth(db, column: str, where: str, params: tuple, count: int, pct: float) -> int:
+        """Nearest-rank percentile of `column` over `count` matching rows, as one indexed row fetch."""
+        if count <= 0:
+            return 0
+        rank = max(1, -(-count * pct // 100))
+        row = db.execute(f"SELECT {column} FROM commands WHERE {where} ORDER BY {column} LIMIT 1 OFFSET ?",
+                         (*params, int(rank) - 1)).fetchone()
+        return row[0] if row else 0
+    
+    def summary(self, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Per-pattern aggregates over rows newer than `since` (epoch seconds), busiest first."""
+        if not self.enabled:
+            return []
+        self.flush()
+        since = since or 0
+        recent_ids = f"SELECT rowid FROM commands WHERE pattern = ? AND ts >= ? ORDER BY ts DESC, rowid DESC LIMIT {self.RECENT}"
+        out = []
+        try:
+            with self._db_lock:
+                db = self._conn()
+                groups = db.execute(
+                    "SELECT pattern, COUNT(*), SUM(rc != 0), SUM(timed_out), MAX(ms), MAX(output_bytes)"
+                    " FROM commands WHERE ts >= ? GROUP BY pattern",
+                    (since,),
+                ).fetchall()
+                for pattern, count, failures, timeouts, max_ms, max_out in groups:
+                    params = (pattern, since)
+                    where = "pattern = ? AND ts >= ?"
+                    last = db.execute(f"SELECT command FROM commands WHERE {where} ORDER BY ts DESC, rowid DESC LIMIT 1", params).fetchone()
+                    recent = sorted(r[0] for r in db.execute(f"SELECT ms FROM commands WHERE rowid IN ({recent_ids})", params))
+                    older_count = count - len(recent)
+                    older_p50 = self._nth(db, "ms", f"{where} AND rowid NOT IN ({recent_ids})", params * 2, older_count, 50)
+                    out.append({
+                        "pattern": pattern,
+                        "last_command": last[0] if last else "",
+                        "count": count,
+                        "failure_rate": round(failures / count, 3),
+                        "timeouts": timeouts,
+                        "duration_ms": {"p50": self._nth(db, "ms", where, params, count, 50),
+                                        "p95": self._nth(db, "ms", where, params, count, 95),
+                                        "p99": self._nth(db, "ms", where, params, count, 99), "max": max_ms},
+                        "output_bytes": {"p50": self._nth(db, "output_bytes", where, params, count, 50),
+                                         "p95": self._nth(db, "output_bytes", where, params, count, 95), "max": max_out},
+                        "recent_p50_ms": _percentile(recent, 50),
+                        "regressed": older_count >= self.RECENT and _percentile(recent, 50) > self.REGRESSION_FACTOR * max(older_p50, 1),
+                    })
+        except Exception as e:
+            self.stats["errors"] += 1
+            LOG.warning(f"command telemetry read failed: {e}")
+            return []
+        out.sort(key=lambda e: -e["count"])
+        return out
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "db": str(self._db_path) if self._db_path else None,
+                "pending": self._pending.qsize(), **self.stats}
+
+# Global command telemetry
+_command_telemetry = CommandTelemetry()
+
 # -----------------------------
 # Command Watcher
 # -----------------------------
 class CommandWatcher:
-    """Monitors command execution and provides real-time status updates."""
+    """Monitors command execution and provides real-time status updates.
+    
+    Finished commands are also written to the persistent command telemetry,
+    whether or not console logging is enabled.
+    """
     
     def __init__(self, enabled: bool = True):
         self.enabled = enabled
@@ -221,14 +901,14 @@ class CommandWatcher:
     
     def start_command(self, command_id: str, command: str) -> None:
         """Log command start."""
-        if not self.enabled:
-            return
         start_time = time.time()
         self.active_commands[command_id] = {
             "command": command,
             "start_time": start_time,
             "status": "running",
         }
+        if not self.enabled:
+            return
         LOG.info(f"▶️  START: {command[:80]}...")
         sys.stderr.flush()  # Force flush to ensure visibility
     
@@ -242,12 +922,15 @@ class CommandWatcher:
         sys.stderr.flush()
     
     def end_command(self, command_id: str, success: bool, returncode: int = 0, 
-                    elapsed_ms: int = 0, output_size: int = 0) -> None:
+                    elapsed_ms: int = 0, output_size: int = 0, timed_out: bool = False) -> None:
         """Log command completion."""
-        if not self.enabled or command_id not in self.active_commands:
+        if command_id not in self.active_commands:
             return
         cmd_info = self.active_commands.pop(command_id)
         elapsed = time.time() - cmd_info["start_time"]
+        _command_telemetry.record(cmd_info["command"], returncode, elapsed_ms or int(elapsed * 1000), output_size, timed_out)
+        if not self.enabled:
+            return
         status_icon = "✅" if success else "❌"
         LOG.info(f"{status_icon} END: {cmd_info['command'][:60]}... (rc={returncode}, {elapsed_ms}ms, {output_size} bytes)")
         sys.stderr.flush()
@@ -263,9 +946,11 @@ class CommandWatcher:
     
     def get_status(self) -> Dict[str, Any]:
         """Get current watcher status."""
+        now = time.time()
         return {
             "enabled": self.enabled,
             "active_commands": len(self.active_commands),
+            "running": [{"command": c["command"][:80], "seconds": round(now - c["start_time"], 1)} for c in self.active_commands.values()],
             "recent_commands": list(self.command_history)[-10:],
         }
 
@@ -275,7 +960,62 @@ _command_watcher = CommandWatcher(enabled=os.environ.get("MCP_ENABLE_WATCHER", "
 # -----------------------------
 # Server
 # -----------------------------
-server = Server("cursor-mcp-server")
+class _LazyServer:
+    """Collects tool/resource/prompt registrations; the MCP SDK server is built on first use.
+    
+    Decorators return the function unchanged, so the HTTP bridges can call
+    tools directly without importing the SDK. Any other attribute access
+    (e.g. `request_context`) builds the SDK server and replays registrations.
+    The SDK gets each handler wrapped to record the calling client session.
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self._tools: Dict[str, Dict[str, Any]] = {}
+        self._registrations: List[tuple[str, tuple, dict, Callable]] = []
+        self._sdk = None
+    
+    def _register(self, kind: str, args: tuple, kwargs: dict) -> Callable[[Callable], Callable]:
+        def deco(fn: Callable) -> Callable:
+            if kind == "tool":
+                self._tools[fn.__name__] = {"handler": fn, "description": fn.__doc__}
+            self._registrations.append((kind, args, kwargs, fn))
+            if self._sdk is not None:
+                getattr(self._sdk, kind)(*args, **kwargs)(self._tracked(fn))
+            return fn
+        return deco
+    
+    @staticmethod
+    def _tracked(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        async def handler(*args, **kwargs):
+            _fs_watcher.track_session()
+            return await fn(*args, **kwargs)
+        return handler
+    
+    def tool(self, *args, **kwargs):
+        return self._register("tool", args, kwargs)
+    
+    def resource(self, *args, **kwargs):
+        return self._register("resource", args, kwargs)
+    
+    def prompt(self, *args, **kwargs):
+        return self._register("prompt", args, kwargs)
+    
+    @property
+    def sdk(self):
+        if self._sdk is None:
+            from mcp.server import Server
+            sdk = Server(self.name)
+            for kind, args, kwargs, fn in self._registrations:
+                getattr(sdk, kind)(*args, **kwargs)(self._tracked(fn))
+            self._sdk = sdk
+        return self._sdk
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.sdk, name)
+
+server = _LazyServer("cursor-mcp-server")
 
 # -----------------------------
 # Context Tracking & Summarization
@@ -417,17 +1157,673 @@ def _auto_summarize_if_needed(content: str, context_name: str = "content") -> st
 # -----------------------------
 # Helpers
 # -----------------------------
+def _glob_to_regex(pattern: str) -> str:
+    """Translate an fnmatch-style glob. "*" still spans directories, and "**/" also matches zero directories."""
+    out: List[str] = []
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            out.append(".*")
+        elif c == "?":
+            out.append(".")
+        elif c == "[":
+            j = i + 1 if i < n and pattern[i] == "!" else i
+            j = j + 1 if j < n and pattern[j] == "]" else j
+            j = pattern.find("]", j)
+            if j < 0:
+                out.append("\\[")
+                continue
+            stuff = pattern[i:j].replace("\\", "\\\\")
+            i = j + 1
+            if stuff.startswith("!"):
+                stuff = "^" + stuff[1:]
+            elif stuff.startswith("^"):
+                stuff = "\\" + stuff
+            out.append(f"[{stuff}]")
+        else:
+            out.append(re.escape(c))
+    return "(?s:" + "".join(out) + ")\\Z"
+
+@functools.lru_cache(maxsize=256)
+def _compile_globs(patterns: tuple) -> "re.Pattern[str]":
+    return re.compile("|".join(_glob_to_regex(p) for p in patterns))
+
+def _glob_match(rel_posix: str, pattern: str) -> bool:
+    return _compile_globs((pattern,)).match(rel_posix) is not None
+
+def _encode_cursor(tool: str, params: Dict[str, Any], position: Dict[str, Any], generation: Optional[int]) -> str:
+    """Opaque continuation token: resume position, index generation and a hash of the query params."""
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:12]
+    payload = {"v": 1, "t": tool, "q": digest, "g": generation, **position}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str, tool: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:12]
+    if not isinstance(payload, dict) or payload.get("v") != 1 or payload.get("t") != tool:
+        raise ValueError("Invalid cursor")
+    if payload.get("q") != digest:
+        raise ValueError("Cursor does not match this query; repeat the original arguments")
+    return payload
+
+@functools.lru_cache(maxsize=8)
+def _server_owned_globs(workspace: Path, audit_log: Path, cache_dir: str) -> tuple:
+    """Globs for the files the server writes into the workspace itself.
+    
+    That is the audit log with its `.idx` sidecar and rotated `<log>.<stamp>[.gz]`
+    segments, and the cache dir.
+    """
+    escape = lambda rel: re.sub(r"([*?\[])", r"[\1]", rel)
+    globs = []
+    for path, suffixes in ((audit_log, ("", ".*")), (workspace / cache_dir, ("/**",))):
+        try:
+            rel = Path(os.path.abspath(path)).relative_to(workspace).as_posix()
+        except ValueError:
+            continue  # outside the workspace
+        if rel != ".":
+            globs.extend(escape(rel) + suffix for suffix in suffixes)
+    return tuple(globs)
+
 def _denylisted(rel_posix: str) -> bool:
-    return any(fnmatch.fnmatch(rel_posix, pat) for pat in READ_DENYLIST)
+    # One compiled alternation; a leading "**/" also matches at the workspace root (".git/...", ".env").
+    # Server-owned files are always excluded, so our own writes never look like workspace changes.
+    patterns = tuple(READ_DENYLIST) + _server_owned_globs(WORKSPACE_DIR, AUDIT_LOG_PATH, CACHE_DIR)
+    return _compile_globs(patterns).match(rel_posix) is not None
+
+def _iter_workspace_files(base_abs: Optional[Path] = None, include_denied: bool = False,
+                          respect_ignore: bool = False, start: Optional[str] = None) -> Iterator[tuple[str, os.DirEntry]]:
+    """Yield (workspace-relative posix path, DirEntry) for files under base_abs, sorted per directory.
+    
+    Unless include_denied, denylisted directories are pruned instead of walked
+    and denylisted files are skipped. With respect_ignore, untracked paths
+    matched by .gitignore/.ignore rules are pruned the same way. Symlinks are
+    not followed. start resumes the walk at the first path at or after it in
+    walk order; subtrees entirely before it are skipped without listing.
+    """
+    # Walk order: a directory's files (sorted), then its subdirectories (sorted, depth first)
+    def walk_key(rel: str, is_dir: bool) -> tuple:
+        parts = rel.split("/")
+        return tuple((1, p) for p in parts[:-1]) + ((int(is_dir), parts[-1]),)
+    
+    start_key = walk_key(start, False) if start else None
+    root = WORKSPACE_DIR
+    base_abs = base_abs or root
+    base_rel = base_abs.relative_to(root).as_posix()
+    base_rel = "" if base_rel == "." else base_rel
+    chain = _ignore_engine.chain_for(base_rel) if respect_ignore else ()
+    stack = [(str(base_abs), base_rel + "/" if base_rel else "", chain)]
+    while stack:
+        dir_path, prefix, chain = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        if respect_ignore:
+            rules = _ignore_engine.rules_for(prefix.rstrip("/"), [e.name for e in entries if e.name in IgnoreEngine.FILENAMES])
+            chain = chain + (rules,) if rules else chain
+        subdirs = []
+        for entry in entries:
+            rel = prefix + entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if start_key:
+                        key = walk_key(rel, True)
+                        if key < start_key[:len(key)]:
+                            continue
+                    # Patterns like "**/node_modules/**" also match the directory itself + "/"
+                    if (include_denied or not _denylisted(rel + "/")) and not (
+                            chain and _ignored_by(chain, rel, True) and not _workspace_index.is_tracked_dir(rel)):
+                        subdirs.append((entry.path, rel + "/", chain))
+                    continue
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            if start_key and walk_key(rel, False) < start_key:
+                continue
+            if (include_denied or not _denylisted(rel)) and not (
+                    chain and _ignored_by(chain, rel, False) and not _workspace_index.is_tracked(rel)):
+                yield rel, entry
+        stack.extend(reversed(subdirs))
 
-def _read_text_guarded(p: Path) -> str:
+def _read_text_guarded(p: Path, encoding: str = "utf-8") -> str:
     data = p.read_bytes()
     if len(data) > MAX_FILE_BYTES:
         raise ValueError(f"File exceeds byte limit: {p} ({len(data)} bytes > {MAX_FILE_BYTES})")
     try:
-        return data.decode("utf-8")
+        return data.decode(encoding)
     except UnicodeDecodeError:
-        return data.decode("utf-8", errors="replace")
+        return data.decode(encoding, errors="replace")
+
+class FileClassifier:
+    """Sniffs the first few KB of a file to tell text from binary, cached per (path, mtime, size).
+    
+    BOMs pick the text encoding; known magic numbers, NUL bytes or a high
+    share of control characters mark a file binary, so searches skip it
+    without reading it in full.
+    """
+    
+    SNIFF_BYTES = 8192
+    MAX_ENTRIES = 200_000
+    BOMS = ((b"\xef\xbb\xbf", "utf-8-sig"), (b"\xff\xfe", "utf-16"), (b"\xfe\xff", "utf-16"))
+    # Common binary signatures, checked before scanning for NUL bytes
+    MAGIC = (
+        b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"%PDF-", b"PK\x03\x04", b"\x1f\x8b", b"BZh", b"7z\xbc\xaf",
+        b"\x7fELF", b"\xcf\xfa\xed\xfe", b"\xca\xfe\xba\xbe", b"wOFF", b"wOF2", b"RIFF", b"OggS", b"ID3",
+    )
+    _CONTROL = bytes(set(range(32)) - {9, 10, 12, 13, 27})
+    
+    def __init__(self):
+        self._cache: Dict[str, tuple[int, int, str, str]] = {}
+        self.stats = {"sniffed": 0, "cached": 0, "binary": 0}
+    
+    def classify(self, p: Path, st: Optional[os.stat_result] = None) -> tuple[str, str]:
+        """Return ("text", encoding) or ("binary", "")."""
+        st = st or p.stat()
+        key = str(p)
+        cached = self._cache.get(key)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            self.stats["cached"] += 1
+            return cached[2], cached[3]
+        with open(p, "rb") as f:
+            head = f.read(self.SNIFF_BYTES)
+        kind, encoding = self.sniff(head)
+        if len(self._cache) >= self.MAX_ENTRIES:
+            self._cache.clear()
+        self._cache[key] = (st.st_mtime_ns, st.st_size, kind, encoding)
+        self.stats["sniffed"] += 1
+        if kind == "binary":
+            self.stats["binary"] += 1
+        return kind, encoding
+    
+    @classmethod
+    def sniff(cls, head: bytes) -> tuple[str, str]:
+        for bom, encoding in cls.BOMS:
+            if head.startswith(bom):
+                return "text", encoding
+        if head.startswith(cls.MAGIC) or b"\x00" in head:
+            return "binary", ""
+        if head and len(head) - len(head.translate(None, cls._CONTROL)) > len(head) // 10:
+            return "binary", ""
+        return "text", "utf-8"
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"entries": len(self._cache), **self.stats}
+
+# Global file classifier
+_file_classifier = FileClassifier()
+
+def _trie_regex(words: List[str]) -> str:
+    """Factor literals into a prefix-trie regex: shared prefixes are matched once, longest match first."""
+    if any(len(w) > 200 for w in words):  # keep recursion shallow
+        return "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+    trie: Dict[str, Any] = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+    
+    def build(node: Dict[str, Any]) -> str:
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if "" in node else body
+    
+    return build(trie)
+
+_REGEX_META = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+class MultiPattern:
+    """Named regexes and literals matched against one buffer per file.
+    
+    Literals are factored into one trie regex (the Aho-Corasick idea within
+    the `re` engine) run as a lookahead, so every literal starting at a
+    position is reported, including ones that are prefixes of a longer hit.
+    Each regex is its own finditer over the same text; the streams are merged
+    by offset, so overlapping patterns never hide each other's matches. Within
+    one pattern, matches don't overlap (as with re.finditer).
+    """
+    
+    def __init__(self, specs: List[Dict[str, Any]]):
+        self.names: List[str] = []
+        self._literals: Dict[bool, Dict[str, str]] = {False: {}, True: {}}  # ignore_case -> text -> name
+        self._regexes: List[tuple[str, "re.Pattern[str]"]] = []
+        for spec in specs:
+            literal, regex = spec.get("literal"), spec.get("regex")
+            if (literal is None) == (regex is None) or not (literal or regex):
+                raise ValueError("Each pattern needs exactly one non-empty 'regex' or 'literal'")
+            name = str(spec.get("name") or literal or regex)
+            ignore_case = bool(spec.get("ignore_case", False))
+            self.names.append(name)
+            if regex is not None and not _REGEX_META.search(regex):
+                literal = regex  # plain words like "TODO" take the literal path
+            if literal is not None:
+                self._literals[ignore_case].setdefault(literal.lower() if ignore_case else literal, name)
+                continue
+            flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+            try:
+                self._regexes.append((name, re.compile(regex, flags)))
+            except re.error as e:
+                raise ValueError(f"Invalid regex {name!r}: {e}")
+        self._tries: List[tuple[bool, "re.Pattern[str]"]] = []
+        self._prefixes: Dict[bool, Dict[str, List[str]]] = {}
+        for ignore_case, lits in self._literals.items():
+            if lits:
+                body = _trie_regex(list(lits))
+                self._tries.append((ignore_case, re.compile(f"(?=({'(?i:' + body + ')' if ignore_case else body}))")))
+                # Literals that also match where a longer one does, shortest first
+                self._prefixes[ignore_case] = {
+                    lit: [lit[:k] for k in range(1, len(lit) + 1) if lit[:k] in lits] for lit in lits}
+    
+    def _literal_hits(self, ignore_case: bool, trie: "re.Pattern[str]",
+                      text: str) -> Iterator[tuple[str, int, str]]:
+        lits = self._literals[ignore_case]
+        prefixes = self._prefixes[ignore_case]
+        ends: Dict[str, int] = {}
+        for m in trie.finditer(text):
+            start, found = m.start(), m.group(1)
+            key = found.lower() if ignore_case else found
+            if key in prefixes:
+                matches = [(lits[lit], len(lit)) for lit in prefixes[key]]
+            else:  # case folding changed the length; report the longest literal only
+                matches = [(next(name for lit, name in lits.items() if lit.casefold() == found.casefold()), len(found))]
+            for name, length in matches:
+                if ends.get(name, 0) <= start:
+                    ends[name] = start + length
+                    yield name, start, text[start:start + length]
+    
+    @staticmethod
+    def _regex_hits(name: str, rx: "re.Pattern[str]", text: str) -> Iterator[tuple[str, int, str]]:
+        for m in rx.finditer(text):
+            yield name, m.start(), m.group(0)
+    
+    def finditer(self, text: str) -> Iterator[tuple[str, int, str]]:
+        """Yield (pattern name, offset, matched text) in text order."""
+        streams: List[Iterator[tuple[str, int, str]]] = [
+            self._literal_hits(ignore_case, trie, text) for ignore_case, trie in self._tries]
+        streams.extend(self._regex_hits(name, rx, text) for name, rx in self._regexes)
+        if len(streams) == 1:
+            return streams[0]
+        return heapq.merge(*streams, key=lambda item: item[1])
+    
+    @property
+    def literal_only(self) -> bool:
+        return not self._regexes
+
+def _scan_text(pattern: MultiPattern, rel: str, text: str, context_lines: int, tagged: bool,
+               skip: int = 0, limit: int = 1 << 62) -> tuple[List[Dict[str, Any]], int]:
+    """Hits in one file after skipping `skip` matches, stopping at `limit` hits; returns (hits, matches consumed)."""
+    hits: List[Dict[str, Any]] = []
+    lines: Optional[List[str]] = None
+    newlines: List[int] = []
+    count = 0
+    for name, start, match in pattern.finditer(text):
+        count += 1
+        if count <= skip:
+            continue
+        if lines is None:
+            # Split once per file; line numbers come from a bisect over newline offsets
+            lines = text.splitlines()
+            newlines = [nm.start() for nm in re.finditer("\n", text)]
+        line_no = bisect.bisect_left(newlines, start) + 1
+        lo = max(1, line_no - context_lines)
+        hi = min(len(lines), line_no + context_lines)
+        hit = {
+            "file": rel,
+            "line": line_no,
+            "match": match,
+            "context": "\n".join(lines[lo-1:hi]),
+        }
+        if tagged:
+            hit["pattern"] = name
+        hits.append(hit)
+        if len(hits) >= limit:
+            break
+    return hits, count
+
+try:
+    import re._parser as _sre_parse  # Python 3.11+
+except ImportError:  # pragma: no cover
+    import sre_parse as _sre_parse  # type: ignore[no-redef]
+
+def _regex_risk(regex: str) -> Optional[str]:
+    """Describe a catastrophic-backtracking shape in regex, or None.
+    
+    Flags an unbounded repeat whose body holds another unbounded repeat and
+    no mandatory literal to split the ways the input can be divided:
+    (a+)+, (\\s*\\w+)*, (x+x+)+y. Delimited repeats like (\\d+,)* pass.
+    """
+    P = _sre_parse
+    try:
+        tree = P.parse(regex)
+    except Exception:
+        return None
+    repeats = (P.MAX_REPEAT, P.MIN_REPEAT)
+    
+    def children(op: Any, av: Any) -> List[Any]:
+        if op in repeats:
+            return [av[2]]
+        if op is P.SUBPATTERN:
+            return [av[-1]]
+        if op is P.BRANCH:
+            return list(av[1])
+        if op in (P.ASSERT, P.ASSERT_NOT):
+            return [av[1]]
+        return []
+    
+    def has_unbounded(items: Any) -> bool:
+        for op, av in items:
+            if op in repeats and av[1] == P.MAXREPEAT:
+                return True
+            if any(has_unbounded(c) for c in children(op, av)):
+                return True
+        return False
+    
+    def has_literal(items: Any) -> bool:
+        for op, av in items:
+            if op is P.LITERAL:
+                return True
+            if op is P.SUBPATTERN and has_literal(av[-1]):
+                return True
+        return False
+    
+    def walk(items: Any) -> Optional[str]:
+        for op, av in items:
+            if op in repeats and av[1] == P.MAXREPEAT and has_unbounded(av[2]) and not has_literal(av[2]):
+                return "nested unbounded quantifiers"
+            for child in children(op, av):
+                found = walk(child)
+                if found:
+                    return found
+        return None
+    
+    return walk(tree)
+
+def _regex_worker(conn: Any, progress: Any) -> None:
+    """Worker-process loop for RegexSandbox: scans chunks of files and streams hits back."""
+    pattern: Optional[MultiPattern] = None
+    root = Path(".")
+    tagged, context_lines, resume_file, resume_skip = False, 1, None, 0
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            return
+        if msg[0] == "begin":
+            _, specs, tagged, root_s, context_lines, (resume_file, resume_skip) = msg
+            root = Path(root_s)
+            pattern = MultiPattern(specs)
+            continue
+        _, chunk, remaining = msg
+        for idx, (rel, encoding) in enumerate(chunk):
+            progress.value = idx
+            try:
+                text = _read_text_guarded(root / rel, encoding)
+            except Exception:
+                continue
+            hits, consumed = _scan_text(pattern, rel, text, context_lines, tagged,
+                                        resume_skip if rel == resume_file else 0, remaining)
+            if hits:
+                conn.send(("hits", rel, hits, consumed))
+                remaining -= len(hits)
+                if remaining <= 0:
+                    break
+        progress.value = -1
+        conn.send(("done",))
+
+class RegexSandbox:
+    """Runs search_code regex scans in worker processes that are killed at the query deadline.
+    
+    `re` holds the GIL for the whole match, so a runaway pattern can only be
+    stopped by killing the process running it. Workers are reused across
+    queries; the parent streams files in chunks and keeps every hit received
+    before a kill, so a timed-out query still returns partial results.
+    """
+    
+    CHUNK = 256
+    MAX_IDLE = 2
+    
+    def __init__(self):
+        self._idle: List[tuple] = []
+        self._lock = threading.Lock()
+        self.stats = {"queries": 0, "timeouts": 0, "spawned": 0, "killed": 0}
+    
+    def _spawn(self) -> tuple:
+        ctx = multiprocessing.get_context("spawn")
+        parent, child = ctx.Pipe()
+        progress = ctx.RawValue("i", -1)
+        proc = ctx.Process(target=_regex_worker, args=(child, progress), daemon=True, name="mcp-regex-worker")
+        proc.start()
+        child.close()
+        self.stats["spawned"] += 1
+        return proc, parent, progress
+    
+    def _acquire(self) -> tuple:
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker[0].is_alive():
+                    return worker
+        return self._spawn()
+    
+    def _release(self, worker: tuple) -> None:
+        with self._lock:
+            if len(self._idle) < self.MAX_IDLE:
+                self._idle.append(worker)
+                return
+        self._kill(worker)
+    
+    def _kill(self, worker: tuple) -> None:
+        proc, conn, _ = worker
+        proc.kill()
+        proc.join(1)
+        conn.close()
+        self.stats["killed"] += 1
+    
+    def scan(self, specs: List[Dict[str, Any]], tagged: bool, files: Iterator[tuple[str, str]], context_lines: int,
+             limit: int, resume: tuple, timeout: float) -> tuple[List[tuple[str, List[Dict[str, Any]], int]], Optional[str]]:
+        """Scan (rel, encoding) files; returns ([(rel, hits, matches consumed)], rel being scanned at the deadline or None)."""
+        self.stats["queries"] += 1
+        worker = self._acquire()
+        proc, conn, progress = worker
+        deadline = time.monotonic() + timeout
+        results: List[tuple[str, List[Dict[str, Any]], int]] = []
+        remaining = limit
+        try:
+            conn.send(("begin", specs, tagged, str(WORKSPACE_DIR), context_lines, resume))
+            while remaining > 0:
+                chunk = list(itertools.islice(files, self.CHUNK))
+                if not chunk:
+                    break
+                conn.send(("chunk", chunk, remaining))
+                while True:
+                    left = deadline - time.monotonic()
+                    if left <= 0 or not conn.poll(left):
+                        idx = progress.value
+                        self._kill(worker)
+                        worker = None
+                        self.stats["timeouts"] += 1
+                        return results, chunk[idx][0] if 0 <= idx < len(chunk) else chunk[0][0]
+                    msg = conn.recv()
+                    if msg[0] == "done":
+                        break
+                    results.append((msg[1], msg[2], msg[3]))
+                    remaining -= len(msg[2])
+        except (EOFError, OSError) as e:
+            if worker:
+                self._kill(worker)
+                worker = None
+            raise RuntimeError(f"Regex worker failed: {e}")
+        finally:
+            if worker:
+                self._release(worker)
+        return results, None
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"enabled": REGEX_SANDBOX_ENABLED, "timeout_s": REGEX_TIMEOUT_S, "idle_workers": len(self._idle), **self.stats}
+
+# Global regex sandbox
+_regex_sandbox = RegexSandbox()
+
+def _atomic_write_text(p: Path, text: str, newline: Optional[str] = None) -> None:
+    """Write text to a temp file next to p, fsync it and rename it over p.
+    
+    Readers see either the old or the new content, never a truncated file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=str(p.parent), prefix=f".{p.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline=newline) as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if p.exists():
+            os.chmod(tmp, p.stat().st_mode & 0o7777)
+        os.replace(tmp, p)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+# -----------------------------
+# Patch helpers (write_file mode="patch")
+# -----------------------------
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+def _line_ending(lines: List[str]) -> str:
+    for line in lines:
+        if line.endswith("\r\n"):
+            return "\r\n"
+        if line.endswith("\n"):
+            return "\n"
+    return "\n"
+
+def _find_block(src: List[str], block: List[str], expected: int, lo: int) -> Optional[int]:
+    """Find block in src at or after lo, preferring the index closest to expected."""
+    want = [l.rstrip("\r\n") for l in block]
+    n = len(want)
+    
+    def fits(i: int) -> bool:
+        return all(src[i + k].rstrip("\r\n") == want[k] for k in range(n))
+    
+    hi = len(src) - n
+    if lo <= expected <= hi and fits(expected):
+        return expected
+    for off in range(1, len(src) + 1):
+        for i in (expected - off, expected + off):
+            if lo <= i <= hi and fits(i):
+                return i
+        if expected - off < lo and expected + off > hi:
+            break
+    return None
+
+def _apply_unified_diff(original: str, diff: str) -> tuple[str, Dict[str, int]]:
+    """Apply a single-file unified diff to original text.
+    
+    Hunks are located at their stated line, or the nearest offset where their
+    context matches (like `patch` without fuzz). Raises ValueError if a hunk
+    does not apply.
+    """
+    src = original.splitlines(keepends=True)
+    eol = _line_ending(src)
+    out: List[str] = []
+    pos = 0
+    stats = {"hunks": 0, "added": 0, "removed": 0}
+    lines = diff.splitlines(keepends=True)
+    i = 0
+    while i < len(lines):
+        m = _HUNK_HEADER.match(lines[i])
+        i += 1
+        if not m:
+            continue  # diff/---/+++ headers and preamble
+        old_start = int(m.group(1))
+        old_len = int(m.group(2)) if m.group(2) is not None else 1
+        new_len = int(m.group(4)) if m.group(4) is not None else 1
+        old_block: List[str] = []
+        new_block: List[str] = []
+        last: Optional[List[str]] = None
+        while i < len(lines) and (len(old_block) < old_len or len(new_block) < new_len or lines[i].startswith("\\")):
+            line = lines[i]
+            i += 1
+            tag, body = line[:1], line[1:]
+            if tag == "\\":  # "\ No newline at end of file" applies to the previous line
+                for blk in last or []:
+                    blk[-1] = blk[-1].rstrip("\r\n")
+                continue
+            if line in ("\n", "\r\n"):  # context line whose leading space was stripped
+                tag, body = " ", line
+            body = body.rstrip("\r\n") + eol
+            if tag == " ":
+                old_block.append(body)
+                new_block.append(body)
+                last = [old_block, new_block]
+            elif tag == "-":
+                old_block.append(body)
+                last = [old_block]
+                stats["removed"] += 1
+            elif tag == "+":
+                new_block.append(body)
+                last = [new_block]
+                stats["added"] += 1
+            else:
+                raise ValueError(f"Malformed hunk line {i}: {line[:80]!r}")
+        if len(old_block) != old_len or len(new_block) != new_len:
+            raise ValueError(f"Truncated hunk at diff line {i}")
+        expected = old_start if old_len == 0 else old_start - 1
+        idx = _find_block(src, old_block, expected, pos)
+        if idx is None:
+            raise ValueError(f"Hunk {stats['hunks'] + 1} does not apply (expected at line {old_start})")
+        out.extend(src[pos:idx])
+        out.extend(new_block)
+        pos = idx + len(old_block)
+        stats["hunks"] += 1
+    if stats["hunks"] == 0:
+        raise ValueError("Patch contains no hunks")
+    out.extend(src[pos:])
+    return "".join(out), stats
+
+def _apply_line_edits(original: str, edits: List[Dict[str, Any]]) -> tuple[str, Dict[str, int]]:
+    """Apply line-range edits: [{"start_line": 3, "end_line": 5, "text": "..."}].
+    
+    Lines are 1-based and inclusive; end_line = start_line - 1 inserts before
+    start_line. Ranges refer to the original file and must not overlap.
+    """
+    src = original.splitlines(keepends=True)
+    eol = _line_ending(src)
+    stats = {"hunks": 0, "added": 0, "removed": 0}
+    norm = []
+    for e in edits:
+        start = int(e["start_line"])
+        end = int(e.get("end_line", start))
+        if start < 1 or end < start - 1 or end > len(src):
+            raise ValueError(f"Edit range out of bounds: {start}-{end} (file has {len(src)} lines)")
+        text = e.get("text", e.get("content", ""))
+        new_lines = text.splitlines(keepends=True)
+        if new_lines and not new_lines[-1].endswith("\n") and (end < len(src) or src[-1:] and src[-1].endswith("\n")):
+            new_lines[-1] += eol
+        norm.append((start, end, new_lines))
+    norm.sort(key=lambda t: (t[0], t[1]))
+    for (s1, e1, _), (s2, _, _) in zip(norm, norm[1:]):
+        if s2 <= e1:
+            raise ValueError(f"Overlapping edits at lines {s1}-{e1} and {s2}")
+    if norm and norm[-1][0] > len(src) and src and not src[-1].endswith("\n"):
+        src[-1] += eol  # appending after a last line without a newline
+    for start, end, new_lines in reversed(norm):
+        src[start - 1:end] = new_lines
+        stats["hunks"] += 1
+        stats["removed"] += end - start + 1
+        stats["added"] += len(new_lines)
+    return "".join(src), stats
 
 # -----------------------------
 # Command validation helpers
@@ -435,7 +1831,10 @@ def _read_text_guarded(p: Path) -> str:
 # Reject obvious shell chaining/redirection. We keep Windows & POSIX symbols.
 _DANGEROUS_CHARS = re.compile(r"[;&|><`$]")
 
-_ALLOWED_PATTERNS = [re.compile(p) for p in ALLOWED_COMMANDS]
+@functools.lru_cache(maxsize=1)
+def _allowed_patterns() -> List[re.Pattern]:
+    """Compiled whitelist, built on the first command check rather than at import."""
+    return [re.compile(p) for p in ALLOWED_COMMANDS]
 
 def is_allowed_command(cmd: str) -> bool:
     """Check if command is allowed (no shell chaining, strict full-match)."""
@@ -443,59 +1842,3115 @@ def is_allowed_command(cmd: str) -> bool:
     if _DANGEROUS_CHARS.search(cmd):
         return False
     # Strict full-match against anchored patterns
-    return any(p.fullmatch(cmd) for p in _ALLOWED_PATTERNS)
+    return any(p.fullmatch(cmd) for p in _allowed_patterns())
 
 # -----------------------------
-# Tools — full
+# On-demand Profiling
 # -----------------------------
-@server.tool()
-async def read_file(path: str, allow_denied_explicit: bool = False) -> str:
-    """Read a UTF-8 text file from the workspace.
+class ToolProfiler:
+    """Captures cProfile stats for the next N calls of a tool, or for a time window.
     
-    Args:
-        path: File path relative to workspace
-        allow_denied_explicit: If True, allow reading denylisted paths (default: False)
+    Armed through get_diagnostics. When disarmed, the per-call cost in `_profiled`
+    is an in-flight counter and a single attribute check.
+    
+    cProfile stays enabled while the captured call awaits, so a capture also
+    contains whatever other tasks ran on the event loop meanwhile (work pushed
+    to worker threads is not captured). Each capture reports how many other
+    tool calls overlapped it as `concurrent_calls`.
     """
-    if not rate_read.allow():
-        raise RuntimeError("Rate limit exceeded for reads")
-    abs_path = safe_join(path)
-    if not abs_path.is_file():
-        raise FileNotFoundError(f"Not a file: {path}")
-    rel = abs_path.relative_to(WORKSPACE_DIR).as_posix()
-    if _denylisted(rel) and not allow_denied_explicit:
-        raise PermissionError("Path is denylisted (set allow_denied_explicit=true to override)")
-    try:
-        text = _read_text_guarded(abs_path)
-        # Auto-summarize if context threshold reached
-        text = _auto_summarize_if_needed(text, context_name=f"file:{path}")
-        write_audit(AuditEntry(time.time(), "read_file", {"path": path, "allow_denied": allow_denied_explicit}, True, {"size": len(text), "context_pct": _context_tracker.get_usage_pct()}))
-        return text
-    except Exception as e:
-        write_audit(AuditEntry(time.time(), "read_file", {"path": path}, False, {"error": str(e)}))
-        raise
-
-@server.tool()
-async def list_files(base: str = ".", pattern: str = "**/*", max_results: int = 2000, include_denied: bool = False) -> List[str]:
-    """List files under a base directory with glob pattern."""
-    if not rate_read.allow():
-        raise RuntimeError("Rate limit exceeded for reads")
-    base_abs = safe_join(base)
-    if not base_abs.exists():
-        raise FileNotFoundError(f"Base not found: {base}")
-    results: List[str] = []
-    for p in base_abs.rglob("*"):
-        if not p.is_file():
-            continue
-        rel = p.relative_to(WORKSPACE_DIR).as_posix()
-        if not fnmatch.fnmatch(rel, pattern):
-            continue
-        if not include_denied and _denylisted(rel):
-            continue
-        results.append(rel)
-        if len(results) >= max_results:
-            break
     
-    # Auto-summarize file list if context threshold reached
+    NOTE = ("cProfile stays enabled across awaits: captures include other tasks that ran on the event loop "
+            "meanwhile (see concurrent_calls) and exclude work done in worker threads")
+    
+    def __init__(self, max_captures: int = 10):
+        self.armed = False
+        self.tool: Optional[str] = None
+        self.remaining_calls = 0
+        self.until = 0.0
+        self.top_n = 15
+        self.captures: deque = deque(maxlen=max_captures)
+        self._busy = False  # cProfile can't nest; skip tools called from a profiled tool
+        self.in_flight = 0  # tool calls currently running
+        self.overlapped = 0  # other tool calls seen during the current capture
+    
+    def arm(self, tool: str, calls: int = 0, seconds: float = 0.0, top_n: int = 15) -> None:
+        """Profile the next `calls` calls of `tool`, or every call for `seconds` (whichever ends first)."""
+        if calls <= 0 and seconds <= 0:
+            calls = 1
+        self.tool = tool
+        self.remaining_calls = calls if calls > 0 else -1  # -1: unlimited within the window
+        self.until = time.time() + seconds if seconds > 0 else 0.0
+        self.top_n = max(1, top_n)
+        self.armed = True
+    
+    def disarm(self) -> None:
+        self.armed = False
+        self.tool = None
+        self.remaining_calls = 0
+        self.until = 0.0
+    
+    def should_capture(self, tool: str) -> bool:
+        if self._busy or tool != self.tool:
+            return False
+        if self.until and time.time() > self.until:
+            self.disarm()
+            return False
+        return True
+    
+    def record(self, tool: str, prof: Any, elapsed_ms: int, ok: bool, concurrent_calls: int = 0) -> Dict[str, Any]:
+        """Dump a finished capture to the cache dir and keep a top-functions summary."""
+        import pstats
+        
+        if self.remaining_calls > 0:
+            self.remaining_calls -= 1
+            if self.remaining_calls == 0:
+                self.disarm()
+        # Runs from _profiled's finally: a read-only cache dir must not replace the tool's result
+        try:
+            out = _cache_dir("profiles") / f"{tool}-{int(time.time() * 1000)}.prof"
+            prof.dump_stats(str(out))
+        except Exception as e:
+            LOG.warning(f"Could not write profile for {tool}: {e}")
+            out = None
+        stats = pstats.Stats(prof)
+        stats.sort_stats("cumulative")
+        top = []
+        for func in stats.fcn_list[: self.top_n]:
+            cc, nc, tt, ct, _ = stats.stats[func]
+            filename, line, name = func
+            top.append({
+                "function": f"{filename}:{line}({name})",
+                "ncalls": nc,
+                "tottime_ms": round(tt * 1000, 3),
+                "cumtime_ms": round(ct * 1000, 3),
+            })
+        capture = {
+            "tool": tool,
+            "ts": time.time(),
+            "elapsed_ms": elapsed_ms,
+            "ok": ok,
+            "concurrent_calls": concurrent_calls,
+            "profile_path": str(out) if out else None,
+            "top_functions": top,
+        }
+        self.captures.append(capture)
+        return capture
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "armed": self.armed,
+            "tool": self.tool,
+            "remaining_calls": self.remaining_calls if self.remaining_calls >= 0 else None,
+            "until": self.until or None,
+            "note": self.NOTE,
+            "captures": list(self.captures),
+        }
+
+# Global profiler
+_profiler = ToolProfiler()
+
+# Tools that can be targeted by the profiler (filled by @_profiled)
+_PROFILABLE_TOOLS: Dict[str, Callable] = {}
+
+# Set inside a capture, so calls nested in the profiled tool are not counted as concurrent
+_in_capture: ContextVar[bool] = ContextVar("mcp_in_capture", default=False)
+
+def _profiled(fn: Callable) -> Callable:
+    """Wrap a tool/resource coroutine so the profiler can capture it on demand."""
+    name = fn.__name__
+    
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        _profiler.in_flight += 1
+        try:
+            if not _profiler.armed or not _profiler.should_capture(name):
+                if _profiler._busy and not _in_capture.get():
+                    _profiler.overlapped += 1
+                return await fn(*args, **kwargs)
+            return await _capture(*args, **kwargs)
+        finally:
+            _profiler.in_flight -= 1
+    
+    async def _capture(*args, **kwargs):
+        import cProfile
+        
+        prof = cProfile.Profile()
+        _profiler._busy = True
+        _profiler.overlapped = _profiler.in_flight - 1  # calls already running when the capture starts
+        token = _in_capture.set(True)
+        ok = False
+        t0 = time.perf_counter()
+        prof.enable()
+        try:
+            result = await fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            prof.disable()
+            _in_capture.reset(token)
+            _profiler._busy = False
+            _profiler.record(name, prof, int((time.perf_counter() - t0) * 1000), ok, _profiler.overlapped)
+    
+    _PROFILABLE_TOOLS[name] = wrapper
+    return wrapper
+
+# -----------------------------
+# Per-stage Timing
+# -----------------------------
+class StageMetrics:
+    """Cumulative per-(tool, stage) duration histograms (Prometheus/OTel compatible)."""
+    
+    def __init__(self, buckets_ms: tuple = STAGE_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        # (tool, stage) -> [bucket counts..., +Inf count, sum_ms]
+        self.series: Dict[tuple, List[float]] = {}
+    
+    def observe(self, tool: str, stage: str, ms: float) -> None:
+        row = self.series.get((tool, stage))
+        if row is None:
+            row = self.series[(tool, stage)] = [0] * (len(self.buckets_ms) + 1) + [0.0]
+        for i, le in enumerate(self.buckets_ms):
+            if ms <= le:
+                row[i] += 1
+        row[-2] += 1
+        row[-1] += ms
+    
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        out: Dict[str, Dict[str, Any]] = {}
+        for (tool, stage), row in sorted(self.series.items()):
+            out.setdefault(tool, {})[stage] = {
+                "count": int(row[-2]),
+                "sum_ms": round(row[-1], 3),
+                "buckets": {str(le): int(c) for le, c in zip(self.buckets_ms, row)},
+            }
+        return out
+    
+    def prometheus_lines(self, name: str = "cursor_tool_stage_duration_ms") -> List[str]:
+        lines = [f"# TYPE {name} histogram"]
+        for (tool, stage), row in sorted(self.series.items()):
+            labels = f'tool="{tool}",stage="{stage}"'
+            for le, c in zip(self.buckets_ms, row):
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {int(c)}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {int(row[-2])}')
+            lines.append(f"{name}_sum{{{labels}}} {row[-1]:.3f}")
+            lines.append(f"{name}_count{{{labels}}} {int(row[-2])}")
+        return lines
+    
+    def reset(self) -> None:
+        self.series.clear()
+
+# Global stage histograms
+_stage_metrics = StageMetrics()
+
+# Per-request sink for stage timings, installed by callers via collect_stage_timings()
+_stage_sink: ContextVar[Optional[Dict[str, Dict[str, float]]]] = ContextVar("mcp_stage_sink", default=None)
+
+@contextmanager
+def collect_stage_timings() -> Iterator[Dict[str, Dict[str, float]]]:
+    """Collect stage timings (tool -> stage -> ms) for tool calls made inside the block."""
+    sink: Dict[str, Dict[str, float]] = {}
+    token = _stage_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _stage_sink.reset(token)
+
+class StageTimer:
+    """Times the stages of a single tool call.
+    
+    Use `stage(name)` around a block, or `lap(name)` inside loops to attribute the
+    time since the previous lap (e.g. directory walk vs. glob matching per file).
+    """
+    
+    def __init__(self, tool: str):
+        self.tool = tool
+        self.t_start = time.perf_counter()
+        self.wall_start_ns = time.time_ns()
+        self._last = self.t_start
+        # stage -> [offset of first start (s), total seconds]
+        self.stages: Dict[str, List[float]] = {}
+    
+    def add(self, name: str, seconds: float, started: Optional[float] = None) -> None:
+        rec = self.stages.get(name)
+        if rec is None:
+            begin = (started if started is not None else time.perf_counter() - seconds) - self.t_start
+            self.stages[name] = [begin, seconds]
+        else:
+            rec[1] += seconds
+    
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0, started=t0)
+            self._last = time.perf_counter()
+    
+    def mark(self) -> None:
+        """Restart the lap clock without attributing the elapsed time."""
+        self._last = time.perf_counter()
+    
+    def lap(self, name: str) -> None:
+        now = time.perf_counter()
+        self.add(name, now - self._last, started=self._last)
+        self._last = now
+    
+    def finish(self) -> Dict[str, float]:
+        """Record into histograms, the request sink and (if available) OpenTelemetry."""
+        total = time.perf_counter() - self.t_start
+        timings = {name: round(sec * 1000, 3) for name, (_, sec) in self.stages.items()}
+        timings["total"] = round(total * 1000, 3)
+        for name, ms in timings.items():
+            _stage_metrics.observe(self.tool, name, ms)
+        sink = _stage_sink.get()
+        if sink is not None:
+            sink[self.tool] = timings
+        if STAGE_SPANS_ENABLED and _otel_trace() is not None:
+            self._export_spans(total)
+        return timings
+    
+    def _export_spans(self, total: float) -> None:
+        # Loop stages are accumulated, so child spans start at the first lap and last
+        # for the summed duration; they may overlap each other.
+        try:
+            trace = _otel_trace()
+            tracer = trace.get_tracer("cursor-mcp-server")
+            parent = tracer.start_span(f"mcp.tool.{self.tool}", start_time=self.wall_start_ns)
+            ctx = trace.set_span_in_context(parent)
+            for name, (begin, sec) in self.stages.items():
+                t0 = self.wall_start_ns + int(begin * 1e9)
+                child = tracer.start_span(f"mcp.stage.{name}", context=ctx, start_time=t0,
+                                          attributes={"mcp.tool": self.tool, "mcp.stage": name})
+                child.end(end_time=t0 + int(sec * 1e9))
+            parent.end(end_time=self.wall_start_ns + int(total * 1e9))
+        except Exception:
+            # Telemetry must never break a tool call
+            pass
+
+# -----------------------------
+# Git index reader
+# -----------------------------
+class GitIndexEntry(NamedTuple):
+    path: str
+    mtime_s: int
+    mtime_ns: int
+    ino: int
+    mode: int
+    size: int
+    sha1: str
+    stage: int
+
+def _git_dir(root: Path) -> Optional[Path]:
+    """Return the git dir for a workspace root (.git directory or `gitdir:` file), if any."""
+    dot_git = root / ".git"
+    if dot_git.is_dir():
+        return dot_git
+    if dot_git.is_file():
+        try:
+            line = dot_git.read_text(encoding="utf-8").strip()
+        except OSError:
+            return None
+        if line.startswith("gitdir:"):
+            p = Path(line[len("gitdir:"):].strip())
+            p = p if p.is_absolute() else (root / p)
+            return p.resolve() if p.is_dir() else None
+    return None
+
+def _read_git_index(index_path: Path) -> List[GitIndexEntry]:
+    """Parse .git/index (DIRC v2/v3/v4) without invoking git. Extensions are ignored."""
+    import struct
+    
+    data = index_path.read_bytes()
+    if len(data) < 12 or data[:4] != b"DIRC":
+        raise ValueError(f"Not a git index: {index_path}")
+    version, count = struct.unpack(">II", data[4:12])
+    if version not in (2, 3, 4):
+        raise ValueError(f"Unsupported git index version: {version}")
+    entries: List[GitIndexEntry] = []
+    pos = 12
+    prev = b""
+    for _ in range(count):
+        start = pos
+        (_cs, _cn, ms, mn, _dev, ino, mode, _uid, _gid, size) = struct.unpack(">10I", data[pos:pos + 40])
+        sha1 = data[pos + 40:pos + 60].hex()
+        flags = struct.unpack(">H", data[pos + 60:pos + 62])[0]
+        pos += 62
+        if version >= 3 and flags & 0x4000:
+            pos += 2  # extended flags
+        if version == 4:
+            # Path is prefix-compressed against the previous entry: varint strip count + NUL-terminated suffix
+            c = data[pos]
+            pos += 1
+            strip = c & 0x7F
+            while c & 0x80:
+                c = data[pos]
+                pos += 1
+                strip = ((strip + 1) << 7) | (c & 0x7F)
+            end = data.index(b"\0", pos)
+            name = prev[:len(prev) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b"\0", pos)
+            name = data[pos:end]
+            # Entries are NUL-padded to a multiple of 8 bytes
+            pos = start + ((pos - start + len(name) + 8) & ~7)
+        prev = name
+        entries.append(GitIndexEntry(name.decode("utf-8", errors="surrogateescape"), ms, mn, ino, mode, size, sha1, (flags >> 12) & 3))
+    return entries
+
+def _git_blob_sha1(path: Path) -> str:
+    with open(path, "rb") as f:
+        h = hashlib.sha1(b"blob %d\0" % os.fstat(f.fileno()).st_size)
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# -----------------------------
+# Git object store (loose + packed objects, read-only)
+# -----------------------------
+_GIT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+
+class GitObjectStore:
+    """Reads git objects in-process: zlib loose objects and v2 pack files with
+    OFS/REF delta resolution. Enough for HEAD/tree/blob lookups behind
+    git_status and git_diff; it never writes to the repository.
+    """
+    
+    def __init__(self, git_dir: Path, cache_size: int = 256):
+        self.git_dir = git_dir
+        self.objects_dir = git_dir / "objects"
+        self._packs: Dict[str, tuple] = {}  # idx path -> (mtime_ns, fanout, shas, offsets, pack path)
+        self._cache: Dict[tuple, tuple[str, bytes]] = {}  # (pack, offset) -> (type, data)
+        self._cache_size = cache_size
+        self._tree_cache: Dict[str, Dict[str, tuple[int, str]]] = {}
+    
+    # ---- refs ----
+    def head(self) -> tuple[Optional[str], Optional[str]]:
+        """Return (branch name or None if detached, commit sha or None if unborn)."""
+        try:
+            head = (self.git_dir / "HEAD").read_text(encoding="utf-8").strip()
+        except OSError:
+            return None, None
+        if not head.startswith("ref:"):
+            return None, head
+        ref = head[4:].strip()
+        branch = ref[len("refs/heads/"):] if ref.startswith("refs/heads/") else ref
+        return branch, self.resolve_ref(ref)
+    
+    def resolve_ref(self, ref: str) -> Optional[str]:
+        for _ in range(10):  # follow symbolic refs
+            # Linked worktrees keep refs in the common dir
+            common = self.git_dir
+            try:
+                common = (self.git_dir / (self.git_dir / "commondir").read_text(encoding="utf-8").strip()).resolve()
+            except OSError:
+                pass
+            for base in (self.git_dir, common):
+                p = base / ref
+                if p.is_file():
+                    val = p.read_text(encoding="utf-8").strip()
+                    if val.startswith("ref:"):
+                        ref = val[4:].strip()
+                        break
+                    return val
+            else:
+                for base in (self.git_dir, common):
+                    packed = base / "packed-refs"
+                    if packed.is_file():
+                        for line in packed.read_text(encoding="utf-8").splitlines():
+                            if line and line[0] not in "#^" and line.endswith(" " + ref):
+                                return line.split(" ", 1)[0]
+                return None
+        return None
+    
+    # ---- packs ----
+    def _load_packs(self) -> None:
+        import struct
+        
+        pack_dir = self.objects_dir / "pack"
+        try:
+            idx_files = [p for p in pack_dir.iterdir() if p.suffix == ".idx"]
+        except OSError:
+            idx_files = []
+        current = {str(p) for p in idx_files}
+        for stale in [k for k in self._packs if k not in current]:
+            del self._packs[stale]
+        for idx in idx_files:
+            try:
+                mtime_ns = idx.stat().st_mtime_ns
+            except OSError:
+                continue
+            cached = self._packs.get(str(idx))
+            if cached and cached[0] == mtime_ns:
+                continue
+            data = idx.read_bytes()
+            if data[:4] != b"\377tOc" or struct.unpack(">I", data[4:8])[0] != 2:
+                continue  # v1 idx files predate 2006 git; not supported
+            fanout = struct.unpack(">256I", data[8:8 + 1024])
+            n = fanout[255]
+            sha_start = 8 + 1024
+            shas = [data[sha_start + 20 * i: sha_start + 20 * (i + 1)] for i in range(n)]
+            off_start = sha_start + 24 * n  # shas + crc32s
+            offsets = list(struct.unpack(f">{n}I", data[off_start:off_start + 4 * n]))
+            large_start = off_start + 4 * n
+            for i, off in enumerate(offsets):
+                if off & 0x80000000:
+                    j = off & 0x7FFFFFFF
+                    offsets[i] = struct.unpack(">Q", data[large_start + 8 * j: large_start + 8 * (j + 1)])[0]
+            self._packs[str(idx)] = (mtime_ns, fanout, shas, offsets, idx.with_suffix(".pack"))
+    
+    def _find_packed(self, sha: str) -> Optional[tuple[Path, int]]:
+        raw = bytes.fromhex(sha)
+        for _, fanout, shas, offsets, pack in self._packs.values():
+            lo = fanout[raw[0] - 1] if raw[0] else 0
+            hi = fanout[raw[0]]
+            i = bisect.bisect_left(shas, raw, lo, hi)
+            if i < hi and shas[i] == raw:
+                return pack, offsets[i]
+        return None
+    
+    def _read_packed(self, pack: Path, offset: int) -> tuple[str, bytes]:
+        import zlib
+        
+        key = (str(pack), offset)
+        hit = self._cache.get(key)
+        if hit:
+            return hit
+        with open(pack, "rb") as f:
+            f.seek(offset)
+            head = f.read(32)
+            c = head[0]
+            typ = (c >> 4) & 7
+            pos = 1
+            while c & 0x80:
+                c = head[pos]
+                pos += 1
+            base_ref: Any = None
+            if typ == 6:  # OFS_DELTA
+                c = head[pos]
+                pos += 1
+                rel = c & 0x7F
+                while c & 0x80:
+                    c = head[pos]
+                    pos += 1
+                    rel = ((rel + 1) << 7) | (c & 0x7F)
+                base_ref = offset - rel
+            elif typ == 7:  # REF_DELTA
+                base_ref = head[pos:pos + 20].hex()
+                pos += 20
+            f.seek(offset + pos)
+            d = zlib.decompressobj()
+            chunks = []
+            while not d.eof:
+                buf = f.read(65536)
+                if not buf:
+                    break
+                chunks.append(d.decompress(buf))
+            data = b"".join(chunks)
+        if typ == 6:
+            base_type, base = self._read_packed(pack, base_ref)
+            result = (base_type, _git_apply_delta(base, data))
+        elif typ == 7:
+            base_type, base = self.read(base_ref)
+            result = (base_type, _git_apply_delta(base, data))
+        else:
+            result = (_GIT_TYPES.get(typ, "unknown"), data)
+        if len(self._cache) >= self._cache_size:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[key] = result
+        return result
+    
+    # ---- objects ----
+    def read(self, sha: str) -> tuple[str, bytes]:
+        """Return (type, content) for an object id; raises KeyError if missing."""
+        import zlib
+        
+        loose = self.objects_dir / sha[:2] / sha[2:]
+        if loose.is_file():
+            raw = zlib.decompress(loose.read_bytes())
+            header, _, body = raw.partition(b"\0")
+            return header.split(b" ", 1)[0].decode("ascii"), body
+        found = self._find_packed(sha)
+        if found is None:
+            self._load_packs()
+            found = self._find_packed(sha)
+        if found is None:
+            raise KeyError(f"git object not found: {sha}")
+        return self._read_packed(*found)
+    
+    def commit_tree(self, commit_sha: str) -> str:
+        typ, body = self.read(commit_sha)
+        if typ != "commit":
+            raise ValueError(f"Not a commit: {commit_sha}")
+        first = body.split(b"\n", 1)[0]
+        if not first.startswith(b"tree "):
+            raise ValueError(f"Malformed commit: {commit_sha}")
+        return first[5:].decode("ascii")
+    
+    def flatten_tree(self, tree_sha: str) -> Dict[str, tuple[int, str]]:
+        """Map every blob/gitlink path in a tree to (mode, sha), recursively."""
+        cached = self._tree_cache.get(tree_sha)
+        if cached is not None:
+            return cached
+        out: Dict[str, tuple[int, str]] = {}
+        stack = [("", tree_sha)]
+        while stack:
+            prefix, sha = stack.pop()
+            _, body = self.read(sha)
+            pos = 0
+            while pos < len(body):
+                sp = body.index(b" ", pos)
+                nul = body.index(b"\0", sp)
+                mode = int(body[pos:sp], 8)
+                name = body[sp + 1:nul].decode("utf-8", errors="surrogateescape")
+                child = body[nul + 1:nul + 21].hex()
+                pos = nul + 21
+                if mode == 0o040000:
+                    stack.append((prefix + name + "/", child))
+                else:
+                    out[prefix + name] = (mode, child)
+        self._tree_cache = {tree_sha: out}  # keep only the latest HEAD tree
+        return out
+
+def _git_apply_delta(base: bytes, delta: bytes) -> bytes:
+    def varint(pos: int) -> tuple[int, int]:
+        val = shift = 0
+        while True:
+            c = delta[pos]
+            pos += 1
+            val |= (c & 0x7F) << shift
+            shift += 7
+            if not c & 0x80:
+                return val, pos
+    
+    _, pos = varint(0)  # source size
+    size, pos = varint(pos)
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:  # copy from base
+            off = n = 0
+            for i in range(4):
+                if op & (1 << i):
+                    off |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    n |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[off:off + (n or 0x10000)]
+        elif op:  # insert literal bytes
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise ValueError("Invalid delta opcode 0")
+    if len(out) != size:
+        raise ValueError("Delta size mismatch")
+    return bytes(out)
+
+def _diff_hunks(old: bytes, new: bytes, context_lines: int, max_lines: int) -> Dict[str, Any]:
+    """Structured unified-diff hunks between two blobs (line-based, via difflib)."""
+    import difflib
+    
+    if b"\0" in old[:8192] or b"\0" in new[:8192]:
+        return {"binary": True, "hunks": [], "added": 0, "removed": 0, "truncated": False}
+    a = old.decode("utf-8", errors="replace").splitlines()
+    b = new.decode("utf-8", errors="replace").splitlines()
+    hunks: List[Dict[str, Any]] = []
+    added = removed = emitted = 0
+    truncated = False
+    for line in difflib.unified_diff(a, b, n=context_lines, lineterm=""):
+        if line.startswith(("---", "+++")) and not hunks:
+            continue
+        if line.startswith("@@"):
+            hunks.append({"header": line, "lines": []})
+            continue
+        if line.startswith("+"):
+            added += 1
+        elif line.startswith("-"):
+            removed += 1
+        if emitted < max_lines:
+            hunks[-1]["lines"].append(line)
+            emitted += 1
+        else:
+            truncated = True
+    return {"binary": False, "hunks": [h for h in hunks if h["lines"]], "added": added, "removed": removed, "truncated": truncated}
+
+# -----------------------------
+# Ignore files (.gitignore / .ignore)
+# -----------------------------
+def _gitignore_to_regex(line: str) -> Optional[tuple[str, bool, bool]]:
+    """Parse one ignore-file line into (regex, negate, dir_only), or None for blanks/comments."""
+    line = line.rstrip("\r\n")
+    if not line or line.startswith("#"):
+        return None
+    while line.endswith(" ") and not line.endswith("\\ "):
+        line = line[:-1]
+    negate = line.startswith("!")
+    if negate or line.startswith(("\\!", "\\#")):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    # A slash anywhere but the end anchors the pattern to the ignore file's directory
+    anchored = "/" in line
+    line = line.lstrip("/")
+    out: List[str] = []
+    i, n = 0, len(line)
+    while i < n:
+        if line.startswith("**/", i) and (i == 0 or line[i - 1] == "/"):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if line.startswith("**", i) and i + 2 == n and (i == 0 or line[i - 1] == "/"):
+            out.append(".*")
+            i += 2
+            continue
+        c = line[i]
+        i += 1
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "\\" and i < n:
+            out.append(re.escape(line[i]))
+            i += 1
+        elif c == "[":
+            j = i + 1 if i < n and line[i] in "!^" else i
+            j = j + 1 if j < n and line[j] == "]" else j
+            j = line.find("]", j)
+            if j < 0:
+                out.append("\\[")
+                continue
+            stuff = line[i:j].replace("\\", "\\\\")
+            i = j + 1
+            if stuff[:1] in ("!", "^"):
+                stuff = "^" + stuff[1:]
+            out.append(f"[{stuff}]")
+        else:
+            out.append(re.escape(c))
+    body = "".join(out)
+    return ("" if anchored else "(?:.*/)?") + body + "\\Z", negate, dir_only
+
+class IgnoreRules:
+    """Compiled rules of one directory's ignore files.
+    
+    All rules compile into one alternation listed last-rule-first, so the
+    first alternative that matches is the rule git would apply (last match
+    wins) and `lastgroup` tells whether it was a negation.
+    """
+    
+    _versions = iter(range(1, sys.maxsize))
+    
+    def __init__(self, prefix: str, lines: List[str]):
+        self.prefix = prefix
+        self.version = next(self._versions)
+        parsed = [r for r in map(_gitignore_to_regex, lines) if r]
+        self.count = len(parsed)
+        self.negate = [neg for _, neg, _ in parsed]
+        
+        def compile_rules(include_dir_only: bool) -> Optional["re.Pattern[str]"]:
+            alts = [f"(?P<r{i}>{rx})" for i, (rx, _, dir_only) in reversed(list(enumerate(parsed)))
+                    if include_dir_only or not dir_only]
+            return re.compile("|".join(alts), re.DOTALL) if alts else None
+        
+        self._file_re = compile_rules(False)
+        self._dir_re = compile_rules(True)
+    
+    def match(self, rel: str, is_dir: bool) -> Optional[bool]:
+        """True if ignored, False if re-included by a negation, None if no rule matches."""
+        regex = self._dir_re if is_dir else self._file_re
+        m = regex.match(rel[len(self.prefix):]) if regex else None
+        if m is None:
+            return None
+        return not self.negate[int(m.lastgroup[1:])]
+
+def _ignored_by(chain: tuple, rel: str, is_dir: bool) -> bool:
+    # Deeper ignore files take precedence over their parents'
+    for rules in reversed(chain):
+        verdict = rules.match(rel, is_dir)
+        if verdict is not None:
+            return verdict
+    return False
+
+class IgnoreEngine:
+    """Per-directory cache of compiled ignore rules, keyed by the ignore files' stat data.
+    
+    Within a directory `.ignore` overrides `.gitignore` (ripgrep's order); the
+    root also picks up `.git/info/exclude` at the lowest precedence.
+    """
+    
+    FILENAMES = (".gitignore", ".ignore")
+    
+    def __init__(self):
+        self.root: Optional[Path] = None
+        self._dirs: Dict[str, tuple[tuple, Optional[IgnoreRules]]] = {}
+        self.stats = {"compiled": 0, "cached": 0}
+    
+    def _reset_if_moved(self) -> None:
+        if self.root != WORKSPACE_DIR:
+            self.root = WORKSPACE_DIR
+            self._dirs.clear()
+    
+    def rules_for(self, rel_dir: str, present: Optional[List[str]] = None) -> Optional[IgnoreRules]:
+        """Compiled rules for one directory. `present` (names seen in a listing) skips stats of absent files."""
+        self._reset_if_moved()
+        if rel_dir and present is not None and not present:
+            self._dirs.pop(rel_dir, None)
+            return None
+        abs_dir = self.root / rel_dir if rel_dir else self.root
+        sources = [abs_dir / name for name in self.FILENAMES if present is None or name in present]
+        if not rel_dir:
+            git_dir = _git_dir(self.root)
+            if git_dir:
+                sources.insert(0, git_dir / "info" / "exclude")
+        sig = []
+        for src in sources:
+            try:
+                st = src.stat()
+            except OSError:
+                continue
+            sig.append((src.name, st.st_mtime_ns, st.st_size))
+        sig_t = tuple(sig)
+        cached = self._dirs.get(rel_dir)
+        if cached and cached[0] == sig_t:
+            self.stats["cached"] += 1
+            return cached[1]
+        lines: List[str] = []
+        for src in sources:
+            if any(src.name == name for name, _, _ in sig):
+                try:
+                    lines.extend(src.read_text(encoding="utf-8", errors="replace").splitlines())
+                except OSError:
+                    pass
+        rules = IgnoreRules(rel_dir + "/" if rel_dir else "", lines) if lines else None
+        if rules is not None and not rules.count:
+            rules = None
+        self._dirs[rel_dir] = (sig_t, rules)
+        self.stats["compiled"] += 1
+        return rules
+    
+    def chain_for(self, rel_dir: str) -> tuple:
+        """Rules of rel_dir's ancestors (root first), excluding rel_dir itself."""
+        if not rel_dir:
+            return ()
+        parts = rel_dir.split("/")
+        chain = []
+        for depth in range(len(parts)):
+            rules = self.rules_for("/".join(parts[:depth]))
+            if rules:
+                chain.append(rules)
+        return tuple(chain)
+    
+    def is_ignored(self, rel: str, is_dir: bool = False) -> bool:
+        """Whether rel (or one of its parent directories) is ignored."""
+        parts = rel.split("/")
+        chain: List[IgnoreRules] = []
+        for depth in range(len(parts)):
+            rules = self.rules_for("/".join(parts[:depth]))
+            if rules:
+                chain.append(rules)
+            if chain and _ignored_by(tuple(chain), "/".join(parts[:depth + 1]), is_dir or depth < len(parts) - 1):
+                return True
+        return False
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"dirs": len(self._dirs), "with_rules": sum(1 for _, r in self._dirs.values() if r), **self.stats}
+
+# Global ignore engine
+_ignore_engine = IgnoreEngine()
+
+# -----------------------------
+# Workspace Index
+# -----------------------------
+class WorkspaceIndex:
+    """Sorted list of (non-denylisted, non-ignored) workspace files, refreshed incrementally.
+    
+    Directory listings are cached by directory mtime, so a refresh stats each
+    directory but only re-lists the ones whose entries changed (git's
+    untracked cache works the same way). Ignore rules prune untracked paths
+    during the walk; the filtered listing is cached per directory until the
+    listing or the chain of applicable rules changes. The listing always comes
+    from this walk. When the workspace is a git repo, `.git/index` is parsed
+    in-process to classify tracked files (kept even when ignore rules match)
+    and to detect modified files from the index's stat data without spawning git.
+    `generation` increases whenever the set of files changes.
+    """
+    
+    # Directories modified this recently may still change within the same mtime tick
+    RACY_NS = 2_000_000_000
+    
+    def __init__(self):
+        self.root: Optional[Path] = None
+        self.generation = 0
+        self.paths: List[str] = []
+        self._path_set: set = set()
+        self._dirs: Dict[str, tuple[Optional[int], List[str], List[str], List[str]]] = {}
+        self._kept: Dict[str, tuple] = {}  # rel_dir -> (listing, rules signature, kept files, kept dirs, ignored files, ignored dirs)
+        self._tracked_dirs: set = set()
+        self.respect_ignore = RESPECT_GITIGNORE
+        self.git_dir: Optional[Path] = None
+        self._git_sig: Optional[tuple] = None
+        self.git_entries: Dict[str, GitIndexEntry] = {}
+        self.last_delta: Dict[str, List[str]] = {"added": [], "removed": []}
+        self._watch_epoch = -1
+        self.stats = {"refreshes": 0, "dirs_listed": 0, "dirs_cached": 0, "git_index_loads": 0, "watch_skips": 0}
+    
+    def _reset_if_moved(self) -> None:
+        if self.root != WORKSPACE_DIR:
+            self.root = WORKSPACE_DIR
+            self.paths = []
+            self._path_set = set()
+            self._dirs.clear()
+            self._kept.clear()
+            self.git_entries = {}
+            self._tracked_dirs = set()
+            self._git_sig = None
+            self._watch_epoch = -1
+            self.generation += 1
+    
+    def _load_git_index(self) -> None:
+        self.git_dir = _git_dir(self.root)
+        if not self.git_dir:
+            self.git_entries = {}
+            self._tracked_dirs = set()
+            self._git_sig = None
+            return
+        index_path = self.git_dir / "index"
+        try:
+            st = index_path.stat()
+        except OSError:
+            self.git_entries = {}
+            self._tracked_dirs = set()
+            self._git_sig = None
+            return
+        sig = (st.st_mtime_ns, st.st_size)
+        if sig == self._git_sig:
+            return
+        try:
+            entries = _read_git_index(index_path)
+        except Exception as e:
+            LOG.warning(f"Could not parse git index {index_path}: {e}")
+            entries = []
+        self.git_entries = {e.path: e for e in entries}
+        tracked_dirs = set()
+        for path in self.git_entries:
+            slash = path.rfind("/")
+            while slash > 0 and path[:slash] not in tracked_dirs:
+                tracked_dirs.add(path[:slash])
+                slash = path.rfind("/", 0, slash)
+        self._tracked_dirs = tracked_dirs
+        self._git_sig = sig
+        self.stats["git_index_loads"] += 1
+    
+    def _list_dir(self, rel_dir: str, abs_dir: str, now_ns: int) -> Optional[tuple[List[str], List[str], List[str]]]:
+        try:
+            mtime_ns = os.stat(abs_dir).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._dirs.get(rel_dir)
+        if cached and cached[0] is not None and cached[0] == mtime_ns:
+            self.stats["dirs_cached"] += 1
+            return cached[1], cached[2], cached[3]
+        files: List[str] = []
+        subdirs: List[str] = []
+        ignore_files: List[str] = []
+        prefix = rel_dir + "/" if rel_dir else ""
+        try:
+            with os.scandir(abs_dir) as it:
+                for entry in it:
+                    rel = prefix + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not _denylisted(rel + "/"):
+                                subdirs.append(entry.name)
+                        elif entry.is_file() and not _denylisted(rel):
+                            files.append(entry.name)
+                            if entry.name in IgnoreEngine.FILENAMES:
+                                ignore_files.append(entry.name)
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        self.stats["dirs_listed"] += 1
+        trusted = now_ns - mtime_ns > self.RACY_NS
+        self._dirs[rel_dir] = (mtime_ns if trusted else None, files, subdirs, ignore_files)
+        return files, subdirs, ignore_files
+    
+    def _filter_ignored(self, rel_dir: str, listing: tuple, chain: tuple, in_ignored: bool) -> tuple:
+        """Split a listing into kept and ignored names, cached per directory by the rules chain."""
+        files, subdirs, _ = listing
+        sig = "ignored" if in_ignored else tuple(r.version for r in chain)
+        cached = self._kept.get(rel_dir)
+        if cached and cached[0] is files and cached[1] == sig:
+            return cached[2:]
+        prefix = rel_dir + "/" if rel_dir else ""
+        if in_ignored:
+            kept_files, kept_dirs, ign_files, ign_dirs = [], [], files, subdirs
+        elif not chain:
+            kept_files, kept_dirs, ign_files, ign_dirs = files, subdirs, [], []
+        else:
+            kept_files, ign_files, kept_dirs, ign_dirs = [], [], [], []
+            for name in files:
+                (ign_files if _ignored_by(chain, prefix + name, False) else kept_files).append(name)
+            for name in subdirs:
+                (ign_dirs if _ignored_by(chain, prefix + name, True) else kept_dirs).append(name)
+        self._kept[rel_dir] = (files, sig, kept_files, kept_dirs, ign_files, ign_dirs)
+        return kept_files, kept_dirs, ign_files, ign_dirs
+    
+    def refresh(self) -> bool:
+        """Bring the file list up to date; returns True if the set of files changed.
+        
+        While the filesystem watcher reports no changes the walk is skipped.
+        """
+        self._reset_if_moved()
+        if self.paths and self.respect_ignore == RESPECT_GITIGNORE and _fs_watcher.quiet_since(self._watch_epoch):
+            self.last_delta = {"added": [], "removed": []}
+            self.stats["watch_skips"] += 1
+            return False
+        self._watch_epoch = _fs_watcher.epoch
+        self._load_git_index()
+        respect = self.respect_ignore = RESPECT_GITIGNORE
+        now_ns = time.time_ns()
+        found: List[str] = []
+        seen_dirs = set()
+        stack: List[tuple[str, tuple, bool]] = [("", (), False)]
+        root = str(self.root)
+        while stack:
+            rel_dir, chain, in_ignored = stack.pop()
+            seen_dirs.add(rel_dir)
+            listing = self._list_dir(rel_dir, os.path.join(root, rel_dir) if rel_dir else root, now_ns)
+            if listing is None:
+                continue
+            if respect and not in_ignored:
+                rules = _ignore_engine.rules_for(rel_dir, listing[2])
+                chain = chain + (rules,) if rules else chain
+            files, subdirs, ign_files, ign_dirs = self._filter_ignored(rel_dir, listing, chain, in_ignored)
+            prefix = rel_dir + "/" if rel_dir else ""
+            found.extend(prefix + f for f in files)
+            stack.extend((prefix + d, chain, in_ignored) for d in subdirs)
+            # Tracked files stay visible even when ignore rules match them (as in git)
+            if ign_files and self.git_entries:
+                found.extend(prefix + f for f in ign_files if prefix + f in self.git_entries)
+            if ign_dirs and self._tracked_dirs:
+                stack.extend((prefix + d, chain, True) for d in ign_dirs if prefix + d in self._tracked_dirs)
+        for stale in [d for d in self._dirs if d not in seen_dirs]:
+            del self._dirs[stale]
+        for stale in [d for d in self._kept if d not in seen_dirs]:
+            del self._kept[stale]
+        self.stats["refreshes"] += 1
+        _fs_watcher.sync_stale()
+        new_set = set(found)
+        if new_set == self._path_set:
+            self.last_delta = {"added": [], "removed": []}
+            return False
+        self.last_delta = {
+            "added": sorted(new_set - self._path_set),
+            "removed": sorted(self._path_set - new_set),
+        }
+        self._path_set = new_set
+        self.paths = sorted(new_set)
+        self.generation += 1
+        return True
+    
+    def iter_under(self, base_rel: str, start: Optional[str] = None) -> Iterator[str]:
+        """Yield indexed paths below base_rel ("" or "." for the whole workspace), in sorted order.
+        
+        start resumes the listing at the first path >= start (a bisect, not a rescan).
+        """
+        paths = self.paths
+        prefix = "" if base_rel in ("", ".") else base_rel.rstrip("/") + "/"
+        i = bisect.bisect_left(paths, max(prefix, start) if start else prefix)
+        while i < len(paths) and paths[i].startswith(prefix):
+            yield paths[i]
+            i += 1
+    
+    def is_tracked(self, rel: str) -> bool:
+        return rel in self.git_entries
+    
+    def is_tracked_dir(self, rel: str) -> bool:
+        return rel in self._tracked_dirs
+    
+    def git_changes(self) -> Dict[str, List[str]]:
+        """Worktree changes against the git index, from stat data (no subprocess).
+        
+        Entries whose stat data can't be trusted (racily clean: modified in the
+        same tick the index was written) are confirmed by hashing the blob.
+        """
+        modified: List[str] = []
+        deleted: List[str] = []
+        index_mtime_ns = self._git_sig[0] if self._git_sig else 0
+        for rel, e in self.git_entries.items():
+            if e.stage or _denylisted(rel):
+                continue
+            p = self.root / rel
+            try:
+                st = os.lstat(p)
+            except OSError:
+                deleted.append(rel)
+                continue
+            if e.mode == 0o160000:  # submodule (gitlink)
+                continue
+            if (st.st_size & 0xFFFFFFFF) != e.size:  # the index stores 32-bit sizes
+                modified.append(rel)
+                continue
+            same_mtime = divmod(st.st_mtime_ns, 1_000_000_000) == (e.mtime_s, e.mtime_ns)
+            racy = e.mtime_s * 1_000_000_000 + e.mtime_ns >= index_mtime_ns
+            if (not same_mtime or racy) and _git_blob_sha1(p) != e.sha1:
+                modified.append(rel)
+        untracked = [rel for rel in self.paths if rel not in self.git_entries]
+        return {"modified": sorted(modified), "deleted": sorted(deleted), "untracked": untracked}
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "generation": self.generation,
+            "git_index": self.git_dir is not None,
+            "files": len(self.paths),
+            "tracked": len(self.git_entries),
+            "dirs": len(self._dirs),
+            "respect_gitignore": self.respect_ignore,
+            "ignore": _ignore_engine.get_status(),
+            **self.stats,
+        }
+
+# Global workspace index
+_workspace_index = WorkspaceIndex()
+
+_git_stores: Dict[str, GitObjectStore] = {}
+
+def _git_store() -> GitObjectStore:
+    """Object store for the current workspace's repository (refreshes the workspace index)."""
+    _workspace_index.refresh()
+    git_dir = _workspace_index.git_dir
+    if not git_dir:
+        raise ValueError("Workspace is not a git repository")
+    store = _git_stores.get(str(git_dir))
+    if store is None:
+        _git_stores.clear()
+        store = _git_stores[str(git_dir)] = GitObjectStore(git_dir)
+    return store
+
+def _git_staged_changes(store: GitObjectStore) -> List[Dict[str, str]]:
+    """Index vs HEAD tree: added (A), modified (M), deleted (D) paths."""
+    _, head = store.head()
+    head_tree = store.flatten_tree(store.commit_tree(head)) if head else {}
+    index = {path: (e.mode, e.sha1) for path, e in _workspace_index.git_entries.items() if e.stage == 0}
+    changes = []
+    for path in sorted(set(head_tree) | set(index)):
+        old, new = head_tree.get(path), index.get(path)
+        if old == new:
+            continue
+        status = "A" if old is None else "D" if new is None else "M"
+        changes.append({"path": path, "status": status})
+    return changes
+
+# -----------------------------
+# Fuzzy File Finder
+# -----------------------------
+# fzf's scoring constants (v1 algorithm): a match is worth 16, gaps cost 3 to open and 1 to extend
+_FZ_MATCH, _FZ_GAP_START, _FZ_GAP_EXT = 16, -3, -1
+_FZ_BOUNDARY, _FZ_BOUNDARY_DELIM, _FZ_CAMEL, _FZ_CONSECUTIVE, _FZ_FIRST_MULT = 8, 9, 7, 4, 2
+_FZ_DELIM, _FZ_NONWORD, _FZ_LOWER, _FZ_UPPER, _FZ_NUMBER = range(5)
+
+def _fz_class(ch: str) -> int:
+    if ch.islower():
+        return _FZ_LOWER
+    if ch.isupper():
+        return _FZ_UPPER
+    if ch.isdigit():
+        return _FZ_NUMBER
+    return _FZ_DELIM if ch in "/ :;,|" else _FZ_NONWORD
+
+def _fz_bonus(prev: int, cur: int) -> int:
+    if cur > _FZ_NONWORD:
+        if prev == _FZ_DELIM:
+            return _FZ_BOUNDARY_DELIM
+        if prev == _FZ_NONWORD:
+            return _FZ_BOUNDARY
+        if (prev == _FZ_LOWER and cur == _FZ_UPPER) or (prev != _FZ_NUMBER and cur == _FZ_NUMBER):
+            return _FZ_CAMEL
+        return 0
+    return _FZ_BOUNDARY
+
+def _fuzzy_score(path: str, target: str, term: str) -> Optional[int]:
+    """fzf v1: find the shortest window holding term as a subsequence of target, then score it.
+    
+    target is path, lower-cased unless the query is case-sensitive.
+    """
+    pos = -1
+    for ch in term:
+        pos = target.find(ch, pos + 1)
+        if pos < 0:
+            return None
+    end = pos = pos + 1
+    for ch in reversed(term):
+        pos = target.rfind(ch, 0, pos)
+    start = pos
+    score = 0
+    qi = 0
+    consecutive = 0
+    first_bonus = 0
+    in_gap = False
+    prev = _fz_class(path[start - 1]) if start > 0 else _FZ_DELIM
+    for idx in range(start, end):
+        cur = _fz_class(path[idx])
+        if qi < len(term) and target[idx] == term[qi]:
+            bonus = _fz_bonus(prev, cur)
+            if consecutive == 0:
+                first_bonus = bonus
+            else:
+                if bonus >= _FZ_BOUNDARY:
+                    first_bonus = bonus
+                bonus = max(bonus, first_bonus, _FZ_CONSECUTIVE)
+            score += _FZ_MATCH + (bonus * _FZ_FIRST_MULT if qi == 0 else bonus)
+            consecutive += 1
+            in_gap = False
+            qi += 1
+        else:
+            score += _FZ_GAP_EXT if in_gap else _FZ_GAP_START
+            consecutive = 0
+            first_bonus = 0
+            in_gap = True
+        prev = cur
+    # Prefer matches inside the file name
+    base_start = path.rfind("/") + 1
+    if start >= base_start:
+        score += _FZ_MATCH
+        base = target[base_start:]
+        if base.startswith(term):
+            score += _FZ_BOUNDARY
+        if base.rsplit(".", 1)[0] == term:
+            score += _FZ_MATCH
+    return score
+
+class FileFinder:
+    """Fuzzy path search over the workspace index.
+    
+    Paths are packed into one newline-joined string (plus a sorted offsets
+    array), rebuilt only when the index generation changes. The index itself
+    is refreshed only when the watcher saw a change or, without the watcher,
+    at most once per `ttl` seconds. A compiled
+    subsequence regex filters the whole blob in one C-level pass; the
+    survivors are scored fzf-style in Python, and the best few get a
+    recency bonus from their mtime.
+    """
+    
+    MAX_CANDIDATES = 5000
+    
+    def __init__(self, ttl: float = FIND_FILE_TTL):
+        self.ttl = ttl
+        self._key: Optional[tuple] = None
+        self.paths: List[str] = []
+        self._blob = ""
+        self._blob_lower = ""
+        self._offsets: List[int] = []
+        self.last_refresh = 0.0
+        self._watch_epoch = -1
+        self.stats = {"queries": 0, "rebuilds": 0, "refreshes": 0}
+    
+    def invalidate(self) -> None:
+        self.last_refresh = 0.0
+        self._watch_epoch = -1
+    
+    def _ensure(self) -> None:
+        if self._key is not None and self._key[0] == WORKSPACE_DIR:
+            if _fs_watcher.covers(self._watch_epoch):
+                if _fs_watcher.quiet_since(self._watch_epoch):
+                    return
+            elif time.time() - self.last_refresh < self.ttl:
+                return
+        self._watch_epoch = _fs_watcher.epoch
+        _workspace_index.refresh()
+        self.last_refresh = time.time()
+        self.stats["refreshes"] += 1
+        key = (_workspace_index.root, _workspace_index.generation)
+        if key == self._key:
+            return
+        import array
+        
+        self.paths = _workspace_index.paths
+        self._blob = "\n".join(self.paths)
+        self._blob_lower = self._blob.lower()
+        offsets = array.array("Q", [0])
+        pos = 0
+        for p in self.paths[:-1]:
+            pos += len(p) + 1
+            offsets.append(pos)
+        self._offsets = offsets  # type: ignore[assignment]
+        self._key = key
+        self.stats["rebuilds"] += 1
+    
+    def _candidates(self, term: str, blob: str, prefix: str) -> List[int]:
+        """Indexes of paths containing term as a subsequence: file-name matches first, capped."""
+        # Leading literal lets `re` skip ahead with its prefix search; "[^c]*c" steps never backtrack
+        chars = [re.escape(ch) for ch in term]
+        in_name = chars[0] + "".join(f"[^{c}\n/]*{c}" for c in chars[1:]) + "[^\n/]*$"
+        in_path = chars[0] + "".join(f"[^{c}\n]*{c}" for c in chars[1:])
+        found: Dict[int, None] = {}
+        for rx in (in_name, in_path):
+            for m in re.finditer(rx, blob, re.MULTILINE):
+                i = bisect.bisect_right(self._offsets, m.start()) - 1
+                if i in found or not self.paths[i].startswith(prefix):
+                    continue
+                found[i] = None
+                if len(found) >= self.MAX_CANDIDATES:
+                    return list(found)
+        return list(found)
+    
+    def search(self, query: str, limit: int = 20, base_rel: str = "") -> List[Dict[str, Any]]:
+        self.stats["queries"] += 1
+        self._ensure()
+        terms = query.split()
+        if not terms:
+            return []
+        case_sensitive = query != query.lower()  # smart case, as in fzf
+        blob = self._blob if case_sensitive else self._blob_lower
+        prefix = "" if base_rel in ("", ".") else base_rel.rstrip("/") + "/"
+        lead = max(terms, key=len)
+        scored = []
+        for i in self._candidates(lead, blob, prefix):
+            path = self.paths[i]
+            target = path if case_sensitive else path.lower()
+            total = 0
+            for term in terms:
+                sc = _fuzzy_score(path, target, term)
+                if sc is None:
+                    break
+                total += sc
+            else:
+                scored.append((total, path))
+        top = heapq.nlargest(max(limit * 4, 50), scored, key=lambda t: (t[0], -len(t[1])))
+        now = time.time()
+        results = []
+        for score, path in top:
+            try:
+                age_h = (now - (self._key[0] / path).stat().st_mtime) / 3600
+            except OSError:
+                continue
+            # Recently touched files are likelier targets
+            score += 6 if age_h < 1 else 4 if age_h < 24 else 2 if age_h < 24 * 7 else 0
+            results.append({"path": path, "score": score})
+        results.sort(key=lambda r: (-r["score"], len(r["path"]), r["path"]))
+        return results[:limit]
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"paths": len(self.paths), "blob_bytes": len(self._blob), **self.stats}
+
+# Global file finder
+_file_finder = FileFinder()
+
+# -----------------------------
+# Symbol Index
+# -----------------------------
+_SYMBOL_LANGS = {
+    ".py": "python", ".pyi": "python",
+    ".js": "js", ".jsx": "js", ".mjs": "js", ".cjs": "js", ".ts": "js", ".tsx": "js", ".mts": "js", ".cts": "js",
+}
+
+def _python_symbols(text: str) -> List[Dict[str, Any]]:
+    """Definitions, classes, module-level assignments and imports via `ast`."""
+    import ast
+    
+    tree = ast.parse(text)
+    out: List[Dict[str, Any]] = []
+    
+    def visit(nodes: List[Any], parent: Optional[str], in_class: bool) -> None:
+        for node in nodes:
+            if isinstance(node, ast.ClassDef):
+                out.append({"name": node.name, "kind": "class", "line": node.lineno, "end_line": getattr(node, "end_lineno", None), "parent": parent})
+                visit(node.body, f"{parent}.{node.name}" if parent else node.name, True)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                out.append({"name": node.name, "kind": "method" if in_class else "function", "line": node.lineno, "end_line": getattr(node, "end_lineno", None), "parent": parent})
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                module = getattr(node, "module", None) or ""
+                level = getattr(node, "level", 0) or 0
+                for alias in node.names:
+                    name = alias.asname or alias.name
+                    target = alias.name if isinstance(node, ast.Import) else (f"{module}.{alias.name}" if module else alias.name)
+                    out.append({"name": name, "kind": "import", "line": node.lineno, "module": target if isinstance(node, ast.Import) else module,
+                                "target": target, "level": level, "parent": parent})
+            elif parent is None and isinstance(node, (ast.Assign, ast.AnnAssign)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for t in targets:
+                    if isinstance(t, ast.Name):
+                        out.append({"name": t.id, "kind": "variable", "line": node.lineno, "parent": None})
+            elif isinstance(node, (ast.If, ast.Try, ast.With)) and not in_class:
+                # Conditional imports/definitions at module level (try: import x / if TYPE_CHECKING:)
+                inner = list(getattr(node, "body", [])) + list(getattr(node, "orelse", []))
+                for h in getattr(node, "handlers", []):
+                    inner.extend(h.body)
+                inner.extend(getattr(node, "finalbody", []))
+                visit(inner, parent, in_class)
+    
+    visit(tree.body, None, False)
+    return out
+
+_JS_DECL_PATTERNS = [
+    ("function", re.compile(r"^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*([A-Za-z_$][\w$]*)")),
+    ("class", re.compile(r"^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+([A-Za-z_$][\w$]*)")),
+    ("interface", re.compile(r"^\s*(?:export\s+)?(?:declare\s+)?interface\s+([A-Za-z_$][\w$]*)")),
+    ("type", re.compile(r"^\s*(?:export\s+)?(?:declare\s+)?type\s+([A-Za-z_$][\w$]*)\s*(?:<[^=]*>)?\s*=")),
+    ("enum", re.compile(r"^\s*(?:export\s+)?(?:declare\s+)?(?:const\s+)?enum\s+([A-Za-z_$][\w$]*)")),
+    ("function", re.compile(r"^\s*(?:export\s+)?(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*(?::[^=]+)?=\s*(?:async\s+)?(?:function\b|(?:\([^)]*\)|[A-Za-z_$][\w$]*)\s*(?::[^=]+)?=>)")),
+    ("variable", re.compile(r"^(?:export\s+)?(?:const|let|var)\s+([A-Za-z_$][\w$]*)")),
+]
+_JS_METHOD = re.compile(r"^\s*(?:public\s+|private\s+|protected\s+|static\s+|readonly\s+|async\s+|get\s+|set\s+)*\*?\s*([A-Za-z_$][\w$]*)\s*(?:<[^>]*>)?\s*\([^;]*$")
+_JS_IMPORTS = [
+    re.compile(r"^\s*import\s+(?:type\s+)?(.+?)\s+from\s+['\"]([^'\"]+)['\"]"),
+    re.compile(r"^\s*export\s+(?:\*|\{[^}]*\})(?:\s+as\s+\w+)?\s+from\s+['\"]([^'\"]+)['\"]"),
+    re.compile(r"^\s*import\s+['\"]([^'\"]+)['\"]"),
+    re.compile(r"\brequire\(\s*['\"]([^'\"]+)['\"]\s*\)"),
+]
+_JS_KEYWORDS = {"if", "for", "while", "switch", "catch", "return", "function", "constructor", "super", "else", "do", "try", "with", "new", "typeof", "await"}
+
+def _js_symbols(text: str) -> List[Dict[str, Any]]:
+    """Line-based TS/JS declarations; tracks brace depth to attribute class methods."""
+    out: List[Dict[str, Any]] = []
+    depth = 0
+    classes: List[tuple[str, int]] = []  # (name, depth inside its body)
+    for lineno, line in enumerate(text.splitlines(), 1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith(("//", "*", "/*")):
+            continue
+        m = _JS_IMPORTS[0].match(line)
+        if m:
+            out.append({"name": m.group(1).strip(), "kind": "import", "line": lineno, "module": m.group(2), "parent": None})
+        else:
+            for rx in _JS_IMPORTS[1:]:
+                m = rx.search(line)
+                if m:
+                    out.append({"name": m.group(1), "kind": "import", "line": lineno, "module": m.group(1), "parent": None})
+                    break
+        parent = classes[-1][0] if classes else None
+        found = False
+        for kind, rx in _JS_DECL_PATTERNS:
+            m = rx.match(line)
+            if m and (kind != "variable" or depth == 0):
+                out.append({"name": m.group(1), "kind": kind, "line": lineno, "parent": parent})
+                if kind == "class":
+                    classes.append((m.group(1), depth + 1))
+                found = True
+                break
+        if not found and classes and depth == classes[-1][1]:
+            m = _JS_METHOD.match(line)
+            if m and m.group(1) not in _JS_KEYWORDS:
+                out.append({"name": m.group(1), "kind": "method", "line": lineno, "parent": parent})
+        depth += line.count("{") - line.count("}")
+        while classes and depth < classes[-1][1]:
+            classes.pop()
+    return out
+
+class SymbolIndex:
+    """Per-file symbol tables for Python and TS/JS, kept fresh by (mtime, size).
+    
+    A refresh re-stats the workspace but only re-parses files whose stat
+    changed. Paths written through write_file are re-parsed on the next query.
+    """
+    
+    def __init__(self, ttl: float = SYMBOL_INDEX_TTL):
+        self.ttl = ttl
+        self.root: Optional[Path] = None
+        self.files: Dict[str, tuple[int, int, List[Dict[str, Any]]]] = {}
+        self.by_name: Dict[str, set] = {}
+        self.dirty: set = set()
+        self.last_refresh = 0.0
+        self._watch_epoch = -1
+        self.stats = {"parsed": 0, "errors": 0, "refreshes": 0}
+    
+    def _reset_if_moved(self) -> None:
+        if self.root != WORKSPACE_DIR:
+            self.root = WORKSPACE_DIR
+            self.files.clear()
+            self.by_name.clear()
+            self.dirty.clear()
+            self.last_refresh = 0.0
+            self._watch_epoch = -1
+    
+    def invalidate(self, rel: str) -> None:
+        self.dirty.add(rel)
+    
+    def _parse(self, rel: str, path: str) -> List[Dict[str, Any]]:
+        lang = _SYMBOL_LANGS.get(os.path.splitext(rel)[1].lower())
+        try:
+            text = _read_text_guarded(Path(path))
+            syms = _python_symbols(text) if lang == "python" else _js_symbols(text)
+        except Exception:
+            self.stats["errors"] += 1
+            return []
+        self.stats["parsed"] += 1
+        return syms
+    
+    def _store(self, rel: str, mtime_ns: int, size: int, syms: List[Dict[str, Any]]) -> None:
+        self._drop(rel)
+        self.files[rel] = (mtime_ns, size, syms)
+        for sym in syms:
+            self.by_name.setdefault(sym["name"], set()).add(rel)
+    
+    def _drop(self, rel: str) -> None:
+        old = self.files.pop(rel, None)
+        if old:
+            for sym in old[2]:
+                names = self.by_name.get(sym["name"])
+                if names:
+                    names.discard(rel)
+                    if not names:
+                        del self.by_name[sym["name"]]
+    
+    def update_file(self, rel: str) -> Optional[List[Dict[str, Any]]]:
+        """Re-parse a single file if its stat changed; returns its symbols (None if gone)."""
+        self._reset_if_moved()
+        self.dirty.discard(rel)
+        path = WORKSPACE_DIR / rel
+        try:
+            st = path.stat()
+        except OSError:
+            self._drop(rel)
+            return None
+        cached = self.files.get(rel)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return cached[2]
+        syms = self._parse(rel, str(path))
+        self._store(rel, st.st_mtime_ns, st.st_size, syms)
+        return syms
+    
+    def refresh(self, force: bool = False) -> None:
+        self._reset_if_moved()
+        if not force and _fs_watcher.covers(self._watch_epoch):
+            # The watcher reported every change as a dirty path; no re-stat pass needed
+            if self.dirty:
+                _workspace_index.refresh()
+                for rel in list(self.dirty):
+                    if rel in _workspace_index._path_set and os.path.splitext(rel)[1].lower() in _SYMBOL_LANGS:
+                        self.update_file(rel)
+                    else:
+                        self._drop(rel)
+                self.dirty.clear()
+            return
+        if not force and time.time() - self.last_refresh < self.ttl:
+            for rel in list(self.dirty):
+                self.update_file(rel)
+            return
+        self._watch_epoch = _fs_watcher.epoch
+        seen = set()
+        _workspace_index.refresh()
+        root = str(WORKSPACE_DIR)
+        for rel in _workspace_index.paths:
+            if os.path.splitext(rel)[1].lower() not in _SYMBOL_LANGS:
+                continue
+            seen.add(rel)
+            path = os.path.join(root, rel)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            cached = self.files.get(rel)
+            if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                continue
+            self._store(rel, st.st_mtime_ns, st.st_size, self._parse(rel, path))
+        for rel in [r for r in self.files if r not in seen]:
+            self._drop(rel)
+        self.dirty.clear()
+        self.last_refresh = time.time()
+        self.stats["refreshes"] += 1
+    
+    def find(self, name: str, kind: Optional[str] = None, match: str = "exact", max_results: int = 50) -> List[Dict[str, Any]]:
+        if match == "exact":
+            names = [name] if name in self.by_name else []
+        else:
+            needle = name.lower()
+            test = (lambda n: n.lower().startswith(needle)) if match == "prefix" else (lambda n: needle in n.lower())
+            names = sorted(n for n in self.by_name if test(n))
+        hits: List[Dict[str, Any]] = []
+        for n in names:
+            for rel in sorted(self.by_name[n]):
+                for sym in self.files[rel][2]:
+                    if sym["name"] != n or (kind and sym["kind"] != kind):
+                        continue
+                    hits.append({"file": rel, **sym})
+                    if len(hits) >= max_results:
+                        return hits
+        return hits
+
+# Global symbol index
+_symbol_index = SymbolIndex()
+
+# -----------------------------
+# Workspace Statistics
+# -----------------------------
+_STATS_LANGS = {
+    ".py": "Python", ".pyi": "Python", ".ipynb": "Jupyter",
+    ".js": "JavaScript", ".jsx": "JavaScript", ".mjs": "JavaScript", ".cjs": "JavaScript",
+    ".ts": "TypeScript", ".tsx": "TypeScript", ".mts": "TypeScript", ".cts": "TypeScript",
+    ".go": "Go", ".rs": "Rust", ".java": "Java", ".kt": "Kotlin", ".rb": "Ruby", ".php": "PHP",
+    ".c": "C", ".h": "C", ".cc": "C++", ".cpp": "C++", ".hpp": "C++", ".cs": "C#", ".swift": "Swift",
+    ".sh": "Shell", ".bash": "Shell", ".ps1": "PowerShell", ".sql": "SQL",
+    ".html": "HTML", ".css": "CSS", ".scss": "CSS", ".vue": "Vue", ".svelte": "Svelte",
+    ".json": "JSON", ".yaml": "YAML", ".yml": "YAML", ".toml": "TOML", ".ini": "INI", ".cfg": "INI",
+    ".md": "Markdown", ".rst": "reStructuredText", ".txt": "Text",
+}
+
+def _stats_language(rel: str) -> str:
+    name = rel.rsplit("/", 1)[-1]
+    if name == "Dockerfile":
+        return "Dockerfile"
+    return _STATS_LANGS.get(os.path.splitext(name)[1].lower(), "Other")
+
+def _stats_directory(rel: str) -> str:
+    return rel.split("/", 1)[0] if "/" in rel else "."
+
+class WorkspaceStats:
+    """File/byte/line totals per language and top-level directory, maintained incrementally.
+    
+    Each file's (mtime, size, lines) is cached; a refresh re-stats the
+    indexed files but only re-counts lines for new or changed ones, adjusting
+    the running totals instead of recomputing them. The rendered snapshot is
+    cached until a total changes, so serving it is a dict lookup. `summary`
+    counts files per language from the index alone, without stat or reads.
+    """
+    
+    TOP_N = 10
+    CHUNK = 1 << 20
+    
+    def __init__(self, ttl: float = WORKSPACE_STATS_TTL):
+        self.ttl = ttl
+        self.root: Optional[Path] = None
+        self.files: Dict[str, tuple[int, int, int]] = {}  # rel -> (mtime_ns, size, lines)
+        self.by_language: Dict[str, List[int]] = {}  # name -> [files, bytes, lines]
+        self.by_directory: Dict[str, List[int]] = {}
+        self.dirty: set = set()
+        self.last_refresh = 0.0
+        self.version = 0
+        self._snapshot: Optional[tuple[int, Dict[str, Any]]] = None
+        self._summary: Optional[tuple[tuple, Dict[str, Any]]] = None
+        self._watch_epoch = -1
+        self.stats = {"counted": 0, "refreshes": 0, "snapshots": 0}
+    
+    def _reset_if_moved(self) -> None:
+        if self.root != WORKSPACE_DIR:
+            self.root = WORKSPACE_DIR
+            self.files.clear()
+            self.by_language.clear()
+            self.by_directory.clear()
+            self.dirty.clear()
+            self.last_refresh = 0.0
+            self._watch_epoch = -1
+            self.version += 1
+    
+    def invalidate(self, rel: str) -> None:
+        self.dirty.add(rel)
+    
+    def _apply(self, rel: str, rec: tuple[int, int, int], sign: int) -> None:
+        for table, key in ((self.by_language, _stats_language(rel)), (self.by_directory, _stats_directory(rel))):
+            row = table.setdefault(key, [0, 0, 0])
+            row[0] += sign
+            row[1] += sign * rec[1]
+            row[2] += sign * rec[2]
+            if not row[0]:
+                del table[key]
+    
+    def _count_lines(self, path: str, st: os.stat_result) -> int:
+        """Newline count for text files within MAX_FILE_BYTES (binary and oversized files count 0)."""
+        if not st.st_size or st.st_size > MAX_FILE_BYTES:
+            return 0
+        try:
+            if _file_classifier.classify(Path(path), st)[0] == "binary":
+                return 0
+            lines, last = 0, b""
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(self.CHUNK), b""):
+                    lines += chunk.count(b"\n")
+                    last = chunk[-1:]
+        except OSError:
+            return 0
+        self.stats["counted"] += 1
+        return lines + (last != b"\n")
+    
+    def _update(self, rel: str, path: str) -> None:
+        old = self.files.get(rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is not None and old and old[0] == st.st_mtime_ns and old[1] == st.st_size:
+            return
+        if old:
+            self._apply(rel, self.files.pop(rel), -1)
+        if st is not None:
+            rec = (st.st_mtime_ns, st.st_size, self._count_lines(path, st))
+            self.files[rel] = rec
+            self._apply(rel, rec, 1)
+        self.version += 1
+    
+    def refresh(self, force: bool = False) -> None:
+        self._reset_if_moved()
+        root = str(WORKSPACE_DIR)
+        if not force and _fs_watcher.covers(self._watch_epoch):
+            if self.dirty:
+                _workspace_index.refresh()
+                for rel in list(self.dirty):
+                    if rel in _workspace_index._path_set:
+                        self._update(rel, os.path.join(root, rel))
+                    elif rel in self.files:
+                        self._apply(rel, self.files.pop(rel), -1)
+                        self.version += 1
+                self.dirty.clear()
+            return
+        if not force and time.time() - self.last_refresh < self.ttl:
+            for rel in list(self.dirty):
+                self._update(rel, os.path.join(root, rel))
+            self.dirty.clear()
+            return
+        self._watch_epoch = _fs_watcher.epoch
+        _workspace_index.refresh()
+        current = _workspace_index._path_set
+        for rel in [r for r in self.files if r not in current]:
+            self._apply(rel, self.files.pop(rel), -1)
+            self.version += 1
+        for rel in _workspace_index.paths:
+            self._update(rel, os.path.join(root, rel))
+        self.dirty.clear()
+        self.last_refresh = time.time()
+        self.stats["refreshes"] += 1
+    
+    @staticmethod
+    def _rows(table: Dict[str, List[int]], key: str) -> List[Dict[str, Any]]:
+        rows = sorted(table.items(), key=lambda kv: (-kv[1][1], kv[0]))
+        return [{key: name, "files": f, "bytes": b, "lines": n} for name, (f, b, n) in rows]
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Current totals plus the largest and most recently modified files (cached per version)."""
+        self.refresh()
+        if self._snapshot and self._snapshot[0] == self.version:
+            return self._snapshot[1]
+        files = self.files
+        largest = heapq.nlargest(self.TOP_N, files, key=lambda r: (files[r][1], r))
+        recent = heapq.nlargest(self.TOP_N, files, key=lambda r: (files[r][0], r))
+        snap = {
+            "workspace": str(WORKSPACE_DIR),
+            "generation": _workspace_index.generation,
+            "totals": {
+                "files": len(files),
+                "bytes": sum(rec[1] for rec in files.values()),
+                "lines": sum(rec[2] for rec in files.values()),
+            },
+            "languages": self._rows(self.by_language, "language"),
+            "directories": self._rows(self.by_directory, "directory"),
+            "largest": [{"path": r, "bytes": files[r][1], "lines": files[r][2]} for r in largest],
+            "recent": [
+                {"path": r, "modified": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(files[r][0] // 1_000_000_000))}
+                for r in recent
+            ],
+        }
+        self._snapshot = (self.version, snap)
+        self.stats["snapshots"] += 1
+        return snap
+    
+    def summary(self) -> Dict[str, Any]:
+        """File counts in total and per language, from the workspace index (cached per generation)."""
+        _workspace_index.refresh()
+        key = (WORKSPACE_DIR, _workspace_index.generation)
+        if self._summary and self._summary[0] == key:
+            return self._summary[1]
+        counts: Dict[str, int] = {}
+        for rel in _workspace_index.paths:
+            lang = _stats_language(rel)
+            counts[lang] = counts.get(lang, 0) + 1
+        summary = {
+            "files": len(_workspace_index.paths),
+            "languages": [{"language": k, "files": n} for k, n in sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))],
+        }
+        self._summary = (key, summary)
+        return summary
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"files": len(self.files), "version": self.version, **self.stats}
+
+# Global workspace statistics
+_workspace_stats = WorkspaceStats()
+
+def workspace_stats_snapshot() -> Dict[str, Any]:
+    """Per-language/directory totals plus largest and recent files (the workspace_stats resource)."""
+    return _workspace_stats.snapshot()
+
+# -----------------------------
+# Workspace Manifest (Merkle tree)
+# -----------------------------
+class WorkspaceManifest:
+    """Merkle tree of git blob hashes over the indexed files, with a ring of past roots.
+    
+    Clean tracked files reuse the sha1 from .git/index; other files are
+    hashed once per (mtime, size). Directory nodes are content-addressed
+    (`sha1` over their sorted entries) and shared between snapshots, so a
+    delta from an old root only descends into subtrees whose hashes differ.
+    """
+    
+    SNAPSHOTS = 32
+    
+    def __init__(self, snapshots: int = SNAPSHOTS):
+        self.root: Optional[Path] = None
+        self.files: Dict[str, tuple[int, int, str]] = {}  # rel -> (mtime_ns, size, sha1)
+        self.children: Dict[str, Dict[str, tuple[str, str]]] = {"": {}}  # dir -> name -> (kind, hash)
+        self.nodes: Dict[str, tuple] = {}  # dir hash -> ((name, kind, hash), ...)
+        self.roots: deque = deque(maxlen=snapshots)
+        self.dirty: set = set()
+        self._stale_dirs: set = {""}
+        self._watch_epoch = -1
+        self.stats = {"hashed": 0, "from_git_index": 0, "refreshes": 0, "gc": 0}
+    
+    def _reset_if_moved(self) -> None:
+        if self.root != WORKSPACE_DIR:
+            self.root = WORKSPACE_DIR
+            self.files.clear()
+            self.children = {"": {}}
+            self.nodes.clear()
+            self.roots.clear()
+            self.dirty.clear()
+            self._stale_dirs = {""}
+            self._watch_epoch = -1
+    
+    def invalidate(self, rel: str) -> None:
+        self.dirty.add(rel)
+    
+    @property
+    def root_hash(self) -> str:
+        return self.roots[-1] if self.roots else ""
+    
+    def _hash(self, rel: str, path: str, st: os.stat_result) -> str:
+        e = _workspace_index.git_entries.get(rel)
+        if e is not None and not e.stage and (st.st_size & 0xFFFFFFFF) == e.size:
+            index_mtime_ns = _workspace_index._git_sig[0] if _workspace_index._git_sig else 0
+            clean = divmod(st.st_mtime_ns, 1_000_000_000) == (e.mtime_s, e.mtime_ns)
+            if clean and e.mtime_s * 1_000_000_000 + e.mtime_ns < index_mtime_ns:
+                self.stats["from_git_index"] += 1
+                return e.sha1
+        self.stats["hashed"] += 1
+        return _git_blob_sha1(Path(path))
+    
+    def _set(self, rel: str, entry: Optional[tuple[str, str]]) -> None:
+        """Set (or remove, entry=None) a name in its parent directory and mark the chain stale."""
+        parent, _, name = rel.rpartition("/")
+        kids = self.children.setdefault(parent, {})
+        if entry is None:
+            kids.pop(name, None)
+        else:
+            kids[name] = entry
+        self._stale_dirs.add(parent)
+    
+    def _update(self, rel: str, path: str) -> None:
+        old = self.files.get(rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is not None and old and old[0] == st.st_mtime_ns and old[1] == st.st_size:
+            return
+        if st is None:
+            if old:
+                del self.files[rel]
+                self._set(rel, None)
+            return
+        try:
+            sha = self._hash(rel, path, st)
+        except OSError:
+            return
+        self.files[rel] = (st.st_mtime_ns, st.st_size, sha)
+        if not old or old[2] != sha:
+            self._set(rel, ("f", sha))
+    
+    def _rehash(self) -> None:
+        """Recompute stale directory hashes bottom-up, pruning directories left empty."""
+        pending = self._stale_dirs
+        self._stale_dirs = set()
+        while pending:
+            depth = max(d.count("/") + 1 if d else 0 for d in pending)
+            level = [d for d in pending if (d.count("/") + 1 if d else 0) == depth]
+            pending.difference_update(level)
+            for d in level:
+                kids = self.children.get(d, {})
+                parent, _, name = d.rpartition("/")
+                if d and not kids:
+                    self.children.pop(d, None)
+                    siblings = self.children.get(parent, {})
+                    if siblings.get(name, ("f",))[0] == "d":
+                        del siblings[name]
+                    pending.add(parent)
+                    continue
+                node = tuple(sorted((n, kind, h) for n, (kind, h) in kids.items()))
+                listing = "\n".join(f"{kind} {h} {n}" for n, kind, h in node)
+                digest = hashlib.sha1(listing.encode("utf-8", "surrogateescape")).hexdigest()
+                self.nodes.setdefault(digest, node)
+                if d:
+                    self.children.setdefault(parent, {})[name] = ("d", digest)
+                    pending.add(parent)
+                elif not self.roots or self.roots[-1] != digest:
+                    evicted = self.roots[0] if len(self.roots) == self.roots.maxlen else None
+                    self.roots.append(digest)
+                    if evicted and evicted not in self.roots:
+                        self._gc()
+    
+    def _gc(self) -> None:
+        """Drop directory nodes no longer reachable from a retained root."""
+        live: set = set()
+        stack = [r for r in self.roots if r in self.nodes]
+        while stack:
+            h = stack.pop()
+            if h in live:
+                continue
+            live.add(h)
+            stack.extend(child for _, kind, child in self.nodes[h] if kind == "d")
+        for h in [h for h in self.nodes if h not in live]:
+            del self.nodes[h]
+        self.stats["gc"] += 1
+    
+    def _bring_current(self, rel: str, root: str) -> None:
+        if rel in _workspace_index._path_set:
+            self._update(rel, os.path.join(root, rel))
+        elif rel in self.files:
+            del self.files[rel]
+            self._set(rel, None)
+    
+    def refresh(self) -> str:
+        """Update changed files and return the current root hash."""
+        self._reset_if_moved()
+        root = str(WORKSPACE_DIR)
+        if _fs_watcher.covers(self._watch_epoch):
+            if self.dirty:
+                _workspace_index.refresh()
+                for rel in list(self.dirty):
+                    self._bring_current(rel, root)
+        else:
+            self._watch_epoch = _fs_watcher.epoch
+            _workspace_index.refresh()
+            current = _workspace_index._path_set
+            for rel in [r for r in self.files if r not in current]:
+                del self.files[rel]
+                self._set(rel, None)
+            for rel in _workspace_index.paths:
+                self._update(rel, os.path.join(root, rel))
+            self.stats["refreshes"] += 1
+        self.dirty.clear()
+        if self._stale_dirs:
+            self._rehash()
+        return self.root_hash
+    
+    def _walk(self, node_hash: str, prefix: str) -> Iterator[tuple[str, str]]:
+        for name, kind, h in self.nodes[node_hash]:
+            if kind == "d":
+                yield from self._walk(h, prefix + name + "/")
+            else:
+                yield prefix + name, h
+    
+    def diff(self, old: str, new: str) -> Iterator[tuple[str, str, Optional[str]]]:
+        """Yield (status, path, new sha) between two retained roots; status is A, M or D."""
+        stack = [(old, new, "")]
+        while stack:
+            a, b, prefix = stack.pop()
+            if a == b:
+                continue
+            old_entries = {name: (kind, h) for name, kind, h in self.nodes[a]} if a else {}
+            new_entries = {name: (kind, h) for name, kind, h in self.nodes[b]} if b else {}
+            for name in sorted(old_entries.keys() | new_entries.keys(), reverse=True):
+                before, after = old_entries.get(name), new_entries.get(name)
+                if before == after:
+                    continue
+                path = prefix + name
+                if before and after and before[0] == after[0] == "d":
+                    stack.append((before[1], after[1], path + "/"))
+                    continue
+                if before and after and before[0] == after[0] == "f":
+                    yield "M", path, after[1]
+                    continue
+                if before:
+                    if before[0] == "d":
+                        for sub, _ in self._walk(before[1], path + "/"):
+                            yield "D", sub, None
+                    else:
+                        yield "D", path, None
+                if after:
+                    if after[0] == "d":
+                        for sub, h in self._walk(after[1], path + "/"):
+                            yield "A", sub, h
+                    else:
+                        yield "A", path, after[1]
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"root": self.root_hash, "files": len(self.files), "nodes": len(self.nodes), "snapshots": len(self.roots), **self.stats}
+
+# Global workspace manifest
+_workspace_manifest = WorkspaceManifest()
+
+# -----------------------------
+# Workspace tree snapshots
+# -----------------------------
+class TreeSnapshots:
+    """Versioned, pre-rendered workspace_tree listings, rebuilt only when the index generation changes.
+    
+    A snapshot is the first MAX_FILES indexed paths plus their rendered
+    text. Its `version` hashes that text, so it is stable across restarts
+    and when a change falls outside the listing. The last KEEP versions
+    are kept so clients can ask for the diff since the one they hold.
+    """
+    
+    MAX_FILES = 2000
+    KEEP = 16
+    
+    def __init__(self):
+        self._root: Optional[Path] = None
+        self._generation: Optional[int] = None
+        self._current: Optional[tuple[str, tuple, str]] = None  # (version, paths, text)
+        self._versions: Dict[str, tuple] = {}  # version -> paths, oldest first
+        self.stats = {"builds": 0, "hits": 0}
+    
+    def current(self) -> tuple[str, tuple, str]:
+        """(version, paths, text) for the current index generation."""
+        _workspace_index.refresh()
+        generation = _workspace_index.generation
+        if self._current is not None and self._generation == generation and self._root == WORKSPACE_DIR:
+            self.stats["hits"] += 1
+            return self._current
+        if self._root != WORKSPACE_DIR:
+            self._versions.clear()
+        paths = tuple(itertools.islice(_workspace_index.iter_under("."), self.MAX_FILES))
+        text = "\n".join(paths)
+        version = hashlib.sha1(text.encode("utf-8", "surrogateescape")).hexdigest()[:16]
+        self._versions.pop(version, None)
+        self._versions[version] = paths
+        while len(self._versions) > self.KEEP:
+            del self._versions[next(iter(self._versions))]
+        self._current = (version, paths, text)
+        self._root, self._generation = WORKSPACE_DIR, generation
+        self.stats["builds"] += 1
+        return self._current
+    
+    def diff(self, since: str) -> Optional[Dict[str, List[str]]]:
+        """Paths added/removed between snapshot `since` and the current one (None if `since` is unknown)."""
+        old = self._versions.get(since)
+        if old is None or self._current is None:
+            return None
+        new = self._current[1]
+        old_set, new_set = set(old), set(new)
+        return {"added": [p for p in new if p not in old_set], "removed": [p for p in old if p not in new_set]}
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"version": self._current[0] if self._current else None, "generation": self._generation,
+                "retained": len(self._versions), **self.stats}
+
+# Global workspace tree snapshots
+_tree_snapshots = TreeSnapshots()
+
+def workspace_tree_listing() -> tuple[str, str]:
+    """(version, text) of the current workspace_tree snapshot; pass the version as `since` later."""
+    version, _, text = _tree_snapshots.current()
+    return version, text
+
+# -----------------------------
+# Filesystem Change Watcher
+# -----------------------------
+class _Inotify:
+    """Minimal inotify binding over ctypes (Linux only; raises OSError elsewhere)."""
+    
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_ISDIR = 0x4000, 0x8000, 0x01000000, 0x40000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+            | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        import select
+        
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify requires Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._ctypes = ctypes
+        self._select = select.select
+        self.draining = False  # set from the moment events are read until the watcher has recorded them
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    
+    def add(self, path: str) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            err = self._ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+    
+    def remove(self, wd: int) -> None:
+        self._rm_watch(self.fd, wd)
+    
+    def pending(self) -> bool:
+        """True if events are queued that nobody has read yet (never blocks)."""
+        return bool(self._select([self.fd], [], [], 0)[0])
+    
+    def read(self, timeout: float) -> List[tuple[int, int, str]]:
+        """(wd, mask, name) events available within timeout seconds."""
+        import select
+        import struct
+        
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        self.draining = True
+        events: List[tuple[int, int, str]] = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos + 16 <= len(data):
+                wd, mask, _cookie, length = struct.unpack_from("iIII", data, pos)
+                name = data[pos + 16:pos + 16 + length].split(b"\0", 1)[0]
+                events.append((wd, mask, os.fsdecode(name)))
+                pos += 16 + length
+        return events
+    
+    def close(self) -> None:
+        os.close(self.fd)
+
+class FileChangeWatcher:
+    """Watches the indexed workspace directories and publishes debounced change batches.
+    
+    Uses inotify where available and falls back to polling directory
+    listings. Subscribers receive {rel_path: "created" | "modified" |
+    "deleted"} on the event loop thread. `epoch` increases per batch;
+    directory creation/removal, ignore-file edits and queue overflows also
+    advance `rescan_epoch`, which tells caches their per-path view is
+    incomplete and a full pass is due. Watches are then re-synced from the
+    directories that pass walks (`sync_stale`), so publishing a batch never
+    walks the tree itself. Connected clients can be sent `resources/updated`
+    for the workspace resources.
+    """
+    
+    IGNORE_FILES = frozenset(IgnoreEngine.FILENAMES)
+    GIT_LABEL = ".git"
+    RESOURCE_URIS = ("mcp://workspace_tree", "mcp://workspace_summary", "mcp://workspace_stats")
+    
+    def __init__(self, mode: str = FS_WATCH_MODE, debounce_ms: int = FS_WATCH_DEBOUNCE_MS,
+                 poll_s: float = FS_WATCH_POLL_S, notify: bool = FS_WATCH_NOTIFY):
+        self.mode = mode
+        self.debounce_s = debounce_ms / 1000
+        self.poll_s = poll_s
+        self.notify = notify
+        self.backend: Optional[str] = None
+        self.root: Optional[Path] = None
+        self.epoch = 0
+        self.rescan_epoch = 0
+        self.changes = 0  # raw events read, before debouncing
+        self.complete = False
+        self._subscribers: List[Callable[[Dict[str, str]], None]] = []
+        self._sessions: set = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._inotify: Optional[_Inotify] = None
+        self._wd_dirs: Dict[int, str] = {}
+        self._dir_wds: Dict[str, int] = {}
+        self._poll_state: Dict[str, tuple[Dict[str, tuple[int, int]], frozenset]] = {}
+        self._pending: Dict[str, str] = {}
+        self._pending_rescan = False
+        self._watches_stale = False
+        self._first_pending = 0.0
+        self._last_event = 0.0
+        self.stats = {"events": 0, "batches": 0, "rescans": 0, "watch_errors": 0, "notified": 0}
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def subscribe(self, callback: Callable[[Dict[str, str]], None]) -> None:
+        self._subscribers.append(callback)
+    
+    def covers(self, epoch: int) -> bool:
+        """True if every change since `epoch` was delivered as a per-path event."""
+        return self.running and self.complete and self.root == WORKSPACE_DIR and epoch >= self.rescan_epoch
+    
+    def quiet_since(self, epoch: int) -> bool:
+        """True if nothing in the workspace changed since `epoch`."""
+        return self.covers(epoch) and epoch == self.epoch
+    
+    def change_token(self) -> Optional[int]:
+        """Raw event counter, or None unless inotify covers the whole workspace."""
+        if self.backend != "inotify" or not self.covers(self.rescan_epoch):
+            return None
+        return self.changes
+    
+    def unread_events(self) -> bool:
+        """True if inotify has queued events the watcher thread hasn't read (or recorded) yet."""
+        ino = self._inotify
+        if ino is None:
+            return False
+        try:
+            return ino.draining or ino.pending()
+        except (OSError, ValueError):
+            return True
+    
+    def watches(self, rel_dir: str) -> bool:
+        """True if entries directly inside `rel_dir` ("" for the root) are watched."""
+        return rel_dir != self.GIT_LABEL and rel_dir in (self._dir_wds if self._inotify else self._poll_state)
+    
+    def track_session(self) -> None:
+        """Remember the current request's client session for resources/updated pushes."""
+        if not self.notify or not self.running:
+            return
+        try:
+            self._sessions.add(server.request_context.session)
+        except (AttributeError, LookupError, TypeError):
+            pass
+    
+    # -- lifecycle --
+    
+    def start(self) -> bool:
+        """Start watching WORKSPACE_DIR; call from the event loop that should receive batches."""
+        if self.mode == "off" or self.running:
+            return self.running
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+        self.root = WORKSPACE_DIR
+        self._stop.clear()
+        self.backend = "poll"
+        if self.mode in ("auto", "inotify"):
+            try:
+                self._inotify = _Inotify()
+                self.backend = "inotify"
+            except OSError as e:
+                if self.mode == "inotify":
+                    raise
+                LOG.info(f"inotify unavailable ({e}); polling every {self.poll_s}s")
+        self._sync_watches()
+        self.epoch += 1
+        self.rescan_epoch = self.epoch
+        self._thread = threading.Thread(target=self._run, name="fs-watcher", daemon=True)
+        self._thread.start()
+        return True
+    
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=max(self.poll_s, self.debounce_s) + 1)
+            self._thread = None
+        with self._lock:
+            if self._inotify:
+                self._inotify.close()
+                self._inotify = None
+            self._wd_dirs.clear()
+            self._dir_wds.clear()
+            self._poll_state.clear()
+        self._watches_stale = False
+        self._sessions.clear()
+    
+    def sync_stale(self) -> None:
+        """After a rescan, re-sync watches with the directories the workspace index just walked."""
+        if self._watches_stale and self.running and self.root == WORKSPACE_DIR:
+            self._watches_stale = False
+            self._sync_watches(refresh=False)
+    
+    def _watch_targets(self, refresh: bool = True) -> Dict[str, str]:
+        """Label -> absolute directory: every directory the workspace index walks, plus the git dir."""
+        if refresh:
+            _workspace_index.refresh()
+        root = str(self.root)
+        targets = {rel: (os.path.join(root, rel) if rel else root) for rel in _workspace_index._dirs}
+        if _workspace_index.git_dir:
+            targets[self.GIT_LABEL] = str(_workspace_index.git_dir)
+        return targets
+    
+    def _sync_watches(self, refresh: bool = True) -> None:
+        targets = self._watch_targets(refresh)
+        complete = True
+        with self._lock:
+            if self._inotify:
+                for label in [d for d in self._dir_wds if d not in targets]:
+                    wd = self._dir_wds.pop(label)
+                    self._wd_dirs.pop(wd, None)
+                    self._inotify.remove(wd)
+                for label, abs_dir in targets.items():
+                    if label in self._dir_wds:
+                        continue
+                    try:
+                        wd = self._inotify.add(abs_dir)
+                    except OSError as e:
+                        self.stats["watch_errors"] += 1
+                        complete = False
+                        LOG.warning(f"fs watcher: cannot watch {abs_dir}: {e}")
+                        continue
+                    self._dir_wds[label] = wd
+                    self._wd_dirs[wd] = label
+            else:
+                for label in [d for d in self._poll_state if d not in targets]:
+                    del self._poll_state[label]
+                for label, abs_dir in targets.items():
+                    if label not in self._poll_state:
+                        self._poll_state[label] = self._scan_dir(abs_dir)
+            self.complete = complete
+    
+    # -- event collection (watcher thread) --
+    
+    def _record(self, rel: str, kind: str) -> None:
+        self.changes += 1
+        now = time.monotonic()
+        if not self._pending and not self._pending_rescan:
+            self._first_pending = now
+        self._last_event = now
+        if kind == "rescan":
+            self._pending_rescan = True
+            return
+        self.stats["events"] += 1
+        if self._pending.get(rel) == "created" and kind == "modified":
+            return
+        self._pending[rel] = kind
+        if rel.rsplit("/", 1)[-1] in self.IGNORE_FILES:
+            self._pending_rescan = True
+    
+    def _read_inotify(self, timeout: float) -> None:
+        ino = self._inotify
+        try:
+            self._record_inotify(ino, ino.read(timeout))
+        finally:
+            ino.draining = False
+    
+    def _record_inotify(self, ino: _Inotify, events: List[tuple[int, int, str]]) -> None:
+        for wd, mask, name in events:
+            if mask & ino.IN_Q_OVERFLOW:
+                self._record("", "rescan")
+                continue
+            with self._lock:
+                label = self._wd_dirs.get(wd)
+                if mask & ino.IN_IGNORED:
+                    self._wd_dirs.pop(wd, None)
+                    if label is not None and self._dir_wds.get(label) == wd:
+                        del self._dir_wds[label]
+            if label is None:
+                continue
+            if label == self.GIT_LABEL:
+                if name == "index":
+                    self._record(".git/index", "modified")
+                continue
+            if mask & (ino.IN_DELETE_SELF | ino.IN_MOVE_SELF):
+                self._record(label, "rescan")
+                continue
+            rel = f"{label}/{name}" if label else name
+            if _denylisted(rel + "/" if mask & ino.IN_ISDIR else rel):
+                # Not a workspace change (e.g. our own audit log appends); entry swaps
+                # still count for the path cache, which resolves denylisted paths too
+                if mask & (ino.IN_CREATE | ino.IN_DELETE | ino.IN_MOVED_FROM | ino.IN_MOVED_TO):
+                    self.changes += 1
+                continue
+            if mask & ino.IN_ISDIR:
+                self._record(label, "rescan")
+                continue
+            if mask & (ino.IN_CREATE | ino.IN_MOVED_TO):
+                self._record(rel, "created")
+            elif mask & (ino.IN_DELETE | ino.IN_MOVED_FROM):
+                self._record(rel, "deleted")
+            else:
+                self._record(rel, "modified")
+    
+    @staticmethod
+    def _scan_dir(abs_dir: str) -> tuple[Dict[str, tuple[int, int]], frozenset]:
+        files: Dict[str, tuple[int, int]] = {}
+        subdirs = []
+        try:
+            with os.scandir(abs_dir) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.is_file():
+                            st = entry.stat()
+                            files[entry.name] = (st.st_mtime_ns, st.st_size)
+                    except OSError:
+                        continue
+        except OSError:
+            return {}, frozenset(("\0missing",))
+        return files, frozenset(subdirs)
+    
+    def _poll(self) -> None:
+        with self._lock:
+            state = list(self._poll_state.items())
+        root = str(self.root)
+        for label, (old_files, old_dirs) in state:
+            abs_dir = str(_workspace_index.git_dir) if label == self.GIT_LABEL else (os.path.join(root, label) if label else root)
+            files, subdirs = self._scan_dir(abs_dir)
+            if label == self.GIT_LABEL:
+                if files.get("index") != old_files.get("index"):
+                    self._record(".git/index", "modified")
+            else:
+                prefix = label + "/" if label else ""
+                for name, sig in files.items():
+                    before = old_files.get(name)
+                    if before == sig or _denylisted(prefix + name):
+                        continue
+                    self._record(prefix + name, "created" if before is None else "modified")
+                for name in old_files.keys() - files.keys():
+                    if not _denylisted(prefix + name):
+                        self._record(prefix + name, "deleted")
+                if any(not _denylisted(prefix + d + "/") for d in subdirs ^ old_dirs):
+                    self._record(label, "rescan")
+            with self._lock:
+                if label in self._poll_state:
+                    self._poll_state[label] = (files, subdirs)
+    
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            pending = bool(self._pending or self._pending_rescan)
+            try:
+                if self._inotify:
+                    self._read_inotify(self.debounce_s if pending else 0.5)
+                else:
+                    self._poll()
+            except Exception as e:
+                LOG.warning(f"fs watcher error: {e}")
+                self._record("", "rescan")
+            now = time.monotonic()
+            # Flush once events go quiet for the debounce window (or have waited 10x that);
+            # a poll pass already spans poll_s, so its changes flush straight away
+            if (self._pending or self._pending_rescan) and (
+                not self._inotify
+                or now - self._last_event >= self.debounce_s
+                or now - self._first_pending >= 10 * self.debounce_s
+            ):
+                batch, rescan = self._pending, self._pending_rescan
+                self._pending, self._pending_rescan = {}, False
+                if self._loop and not self._loop.is_closed():
+                    self._loop.call_soon_threadsafe(self._publish, batch, rescan)
+                else:
+                    self._publish(batch, rescan)
+            if not self._inotify:
+                self._stop.wait(self.poll_s)
+    
+    # -- publishing (event loop thread) --
+    
+    def _publish(self, batch: Dict[str, str], rescan: bool) -> None:
+        self.epoch += 1
+        self.stats["batches"] += 1
+        if rescan:
+            # Not complete until the next index walk re-syncs the watches
+            self.rescan_epoch = self.epoch
+            self.stats["rescans"] += 1
+            self.complete = False
+            self._watches_stale = True
+        for callback in self._subscribers:
+            try:
+                callback(batch)
+            except Exception as e:
+                LOG.warning(f"fs watcher subscriber failed: {e}")
+        if self.notify and self._sessions and self._loop:
+            uris = self.RESOURCE_URIS if rescan or any(k != "modified" for k in batch.values()) else self.RESOURCE_URIS[1:]
+            self._loop.create_task(self._notify_clients(uris))
+    
+    async def _notify_clients(self, uris: tuple) -> None:
+        for session in list(self._sessions):
+            try:
+                for uri in uris:
+                    await session.send_resource_updated(uri)
+                    self.stats["notified"] += 1
+            except Exception:
+                self._sessions.discard(session)
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "backend": self.backend,
+            "running": self.running,
+            "complete": self.complete,
+            "epoch": self.epoch,
+            "watched_dirs": len(self._dir_wds) if self._inotify else len(self._poll_state),
+            "sessions": len(self._sessions),
+            **self.stats,
+        }
+
+def _invalidate_changed(batch: Dict[str, str]) -> None:
+    """Mark watcher-reported paths dirty in the per-file caches."""
+    for rel in batch:
+        if rel.startswith(".git/"):
+            continue
+        if os.path.splitext(rel)[1].lower() in _SYMBOL_LANGS:
+            _symbol_index.invalidate(rel)
+        _workspace_stats.invalidate(rel)
+        _workspace_manifest.invalidate(rel)
+
+# Global filesystem watcher
+_fs_watcher = FileChangeWatcher()
+_fs_watcher.subscribe(_invalidate_changed)
+
+# -----------------------------
+# Test Impact (Python import graph)
+# -----------------------------
+# Changes to these files can alter every test's outcome, so they select the whole suite
+_TEST_CONFIG_FILES = frozenset({"pytest.ini", "pyproject.toml", "setup.cfg", "tox.ini", "setup.py", "requirements.txt"})
+_SAFE_TEST_PATH = re.compile(r"[\w/\.\-]+")
+
+def _is_test_module(rel: str) -> bool:
+    name = rel.rsplit("/", 1)[-1]
+    return name.endswith(".py") and (name.startswith("test_") or name.endswith("_test.py"))
+
+def _module_name(rel: str) -> str:
+    """Dotted module path of a .py/.pyi file relative to the workspace root (packages drop __init__)."""
+    stem = rel.rsplit(".", 1)[0]
+    if stem.endswith("/__init__") or stem == "__init__":
+        stem = stem[:-len("__init__")].rstrip("/")
+    return stem.replace("/", ".")
+
+class ImportGraph:
+    """Python import dependency graph built from the symbol index's import records.
+    
+    Imports resolve against every dotted suffix of each file's path, so
+    `src/` layouts and pytest's rootdir imports both work; an import that
+    matches several files depends on all of them. A file's edges are
+    re-resolved only when the symbol index re-parsed it, unless the set of
+    workspace files changed. Test modules also depend on the conftest.py
+    files above them. Import names that match no file are kept too, so a
+    deleted module still maps to the files that imported it.
+    """
+    
+    def __init__(self):
+        self.root: Optional[Path] = None
+        self.generation = -1
+        self.by_suffix: Dict[str, List[str]] = {}
+        self.by_module: Dict[str, str] = {}
+        self.deps: Dict[str, tuple[tuple[int, int], set, set]] = {}  # rel -> ((mtime_ns, size), imported files, unresolved names)
+        self.rdeps: Dict[str, set] = {}
+        self.missing: Dict[str, set] = {}  # dotted prefix of an unresolved import -> importing files
+        self.stats = {"resolved": 0, "rebuilds": 0}
+    
+    def _index_modules(self, files: List[str]) -> None:
+        self.by_suffix = {}
+        self.by_module = {}
+        for rel in files:
+            name = _module_name(rel)
+            if not name:
+                continue
+            self.by_module[name] = rel
+            parts = name.split(".")
+            for i in range(len(parts)):
+                self.by_suffix.setdefault(".".join(parts[i:]), []).append(rel)
+    
+    def _resolve(self, rel: str, syms: List[Dict[str, Any]]) -> tuple[set, set]:
+        deps: set = set()
+        unresolved: set = set()
+        own = _module_name(rel)
+        package = own if rel.endswith(("/__init__.py", "/__init__.pyi")) else own.rpartition(".")[0]
+        stdlib = getattr(sys, "stdlib_module_names", ())
+        for sym in syms:
+            if sym["kind"] != "import":
+                continue
+            level = sym.get("level") or 0
+            module, target = sym.get("module") or "", sym.get("target") or ""
+            if level:
+                base = package.split(".") if package else []
+                base = base[:len(base) - (level - 1)] if level > 1 else base
+                prefix = ".".join(base)
+                for name in (target, module):
+                    full = f"{prefix}.{name}" if prefix and name else prefix or name
+                    if full in self.by_module:
+                        deps.add(self.by_module[full])
+                        break
+                    if full:
+                        unresolved.add(full)
+                continue
+            for name in (target, module):
+                if not name:
+                    continue
+                if name.split(".")[0] in stdlib and name not in self.by_module:
+                    break
+                hits = self.by_suffix.get(name)
+                if hits:
+                    deps.update(hits)
+                    break
+                unresolved.add(name)
+        # Importing pkg.sub.mod runs pkg/__init__.py and pkg/sub/__init__.py too
+        for dep in list(deps):
+            parts = _module_name(dep).split(".")
+            for i in range(1, len(parts)):
+                init = self.by_module.get(".".join(parts[:i]))
+                if init:
+                    deps.add(init)
+        if _is_test_module(rel):
+            parts = rel.split("/")[:-1]
+            for i in range(len(parts) + 1):
+                conftest = "/".join(parts[:i] + ["conftest.py"])
+                if conftest in _symbol_index.files:
+                    deps.add(conftest)
+        deps.discard(rel)
+        self.stats["resolved"] += 1
+        return deps, unresolved
+    
+    def refresh(self) -> None:
+        _symbol_index.refresh()
+        files = {rel: rec for rel, rec in _symbol_index.files.items() if rel.endswith((".py", ".pyi"))}
+        rebuild = self.root != WORKSPACE_DIR or self.generation != _workspace_index.generation
+        if rebuild:
+            self.root = WORKSPACE_DIR
+            self.generation = _workspace_index.generation
+            self._index_modules(sorted(files))
+            self.stats["rebuilds"] += 1
+        changed = False
+        for rel in [r for r in self.deps if r not in files]:
+            del self.deps[rel]
+            changed = True
+        for rel, (mtime_ns, size, syms) in files.items():
+            cached = self.deps.get(rel)
+            if not rebuild and cached and cached[0] == (mtime_ns, size):
+                continue
+            deps, unresolved = self._resolve(rel, syms)
+            if not cached or cached[1] != deps or cached[2] != unresolved:
+                changed = True
+            self.deps[rel] = ((mtime_ns, size), deps, unresolved)
+        if changed or rebuild:
+            self.rdeps = {}
+            self.missing = {}
+            for rel, (_, deps, unresolved) in self.deps.items():
+                for dep in deps:
+                    self.rdeps.setdefault(dep, set()).add(rel)
+                for name in unresolved:
+                    parts = name.split(".")
+                    for i in range(1, len(parts) + 1):
+                        self.missing.setdefault(".".join(parts[:i]), set()).add(rel)
+    
+    def importers_of_missing(self, rel: str) -> set:
+        """Files with an import that no longer resolves but would resolve to `rel` (e.g. after it was deleted)."""
+        parts = _module_name(rel).split(".")
+        found: set = set()
+        for i in range(len(parts)):
+            found |= self.missing.get(".".join(parts[i:]), set())
+        return found
+    
+    def affected(self, changed: List[str]) -> set:
+        """Files that (transitively) import any of `changed`, including the changed files.
+        
+        Changed files missing from the graph (deleted) map to their importers
+        through the import names those importers could not resolve.
+        """
+        seen = set(changed)
+        for rel in changed:
+            if rel not in self.deps:
+                seen |= self.importers_of_missing(rel)
+        stack = list(seen)
+        while stack:
+            for rel in self.rdeps.get(stack.pop(), ()):
+                if rel not in seen:
+                    seen.add(rel)
+                    stack.append(rel)
+        return seen
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"files": len(self.deps), "edges": sum(len(d) for _, d, _ in self.deps.values()),
+                "unresolved": sum(len(u) for _, _, u in self.deps.values()), **self.stats}
+
+# Global import graph
+_import_graph = ImportGraph()
+
+def _last_green_path() -> Path:
+    return _cache_dir("test_impact") / "last_green.json"
+
+def _load_last_green() -> Optional[Dict[str, str]]:
+    try:
+        data = json.loads(_last_green_path().read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    return data.get("files") if data.get("workspace") == str(WORKSPACE_DIR) else None
+
+def _save_last_green(files: Dict[str, str]) -> None:
+    _atomic_write_text(_last_green_path(), json.dumps({"workspace": str(WORKSPACE_DIR), "saved": time.time(), "files": files}))
+
+# -----------------------------
+# Command slots & test sharding
+# -----------------------------
+class CommandSlots:
+    """Caps how many subprocesses run_command (including test shards) runs at once."""
+    
+    def __init__(self, capacity: int = MAX_CONCURRENT_COMMANDS):
+        self.capacity = max(1, capacity)
+        self.in_use = 0
+        self._cond: Optional[asyncio.Condition] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats = {"acquired": 0, "waited": 0}
+    
+    def _condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._cond is None or self._loop is not loop:
+            self._cond, self._loop = asyncio.Condition(), loop
+        return self._cond
+    
+    def free(self) -> int:
+        return max(0, self.capacity - self.in_use)
+    
+    @asynccontextmanager
+    async def acquire(self, n: int = 1):
+        """Hold n slots (clamped to capacity) for the duration of the block; yields n."""
+        n = min(max(1, n), self.capacity)
+        cond = self._condition()
+        async with cond:
+            if self.in_use + n > self.capacity:
+                self.stats["waited"] += 1
+                await cond.wait_for(lambda: self.in_use + n <= self.capacity)
+            self.in_use += n
+        self.stats["acquired"] += 1
+        try:
+            yield n
+        finally:
+            async with cond:
+                self.in_use -= n
+                cond.notify_all()
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"capacity": self.capacity, "in_use": self.in_use, **self.stats}
+
+# Global command slots
+_command_slots = CommandSlots()
+
+# -----------------------------
+# Admission control (HTTP bridges)
+# -----------------------------
+class AdmissionRejected(RuntimeError):
+    """Raised when a request cannot be queued (or waited too long); bridges answer 429."""
+    
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Server busy ({reason}); retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Per-client concurrency caps with round-robin queuing across clients.
+    
+    A request runs at once if a global slot is free, its client is under
+    its own cap and has nobody queued. Otherwise it waits in its client's
+    bounded queue. Freed slots go to queued clients in turn, so one busy
+    client cannot starve the others. Full queues and waits longer than
+    the timeout raise AdmissionRejected, with a Retry-After estimate
+    derived from the recent service time.
+    """
+    
+    def __init__(self, max_concurrent: int = ADMISSION_MAX_CONCURRENT, per_client: int = ADMISSION_PER_CLIENT,
+                 queue_per_client: int = ADMISSION_QUEUE_PER_CLIENT, queue_total: int = ADMISSION_QUEUE_TOTAL,
+                 queue_timeout_s: float = ADMISSION_QUEUE_TIMEOUT_S):
+        self.max_concurrent = max(1, max_concurrent)
+        self.per_client = max(1, per_client)
+        self.queue_per_client = max(0, queue_per_client)
+        self.queue_total = max(0, queue_total)
+        self.queue_timeout_s = queue_timeout_s
+        self.in_flight = 0
+        self.queued = 0
+        self._running: Dict[str, int] = {}
+        self._waiters: Dict[str, deque] = {}
+        self._turns: deque = deque()  # clients with waiters, in round-robin order
+        self._service_s = 0.5  # EWMA of request duration, for Retry-After
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0, "max_wait_ms": 0.0}
+    
+    def retry_after(self) -> int:
+        backlog = (self.in_flight + self.queued + 1) / self.max_concurrent
+        return max(1, min(60, int(self._service_s * backlog + 0.999)))
+    
+    def _grant(self, client: str) -> None:
+        self.in_flight += 1
+        self._running[client] = self._running.get(client, 0) + 1
+        self.stats["admitted"] += 1
+    
+    def _dispatch(self) -> None:
+        """Hand free slots to queued clients, one waiter per client per turn."""
+        blocked = 0
+        while self._turns and self.in_flight < self.max_concurrent and blocked < len(self._turns):
+            client = self._turns.popleft()
+            waiters = self._waiters[client]
+            if self._running.get(client, 0) >= self.per_client:
+                self._turns.append(client)
+                blocked += 1
+                continue
+            fut = waiters.popleft()
+            self.queued -= 1
+            self._grant(client)
+            fut.set_result(None)
+            blocked = 0
+            if waiters:
+                self._turns.append(client)
+            else:
+                del self._waiters[client]
+    
+    def _release(self, client: str, started: Optional[float]) -> None:
+        self.in_flight -= 1
+        left = self._running[client] - 1
+        if left:
+            self._running[client] = left
+        else:
+            del self._running[client]
+        if started is not None:
+            self._service_s = 0.8 * self._service_s + 0.2 * (time.monotonic() - started)
+        self._dispatch()
+    
+    def _withdraw(self, client: str, fut: asyncio.Future) -> None:
+        waiters = self._waiters.get(client)
+        if waiters is None or fut not in waiters:
+            return
+        waiters.remove(fut)
+        self.queued -= 1
+        if not waiters:
+            del self._waiters[client]
+            self._turns.remove(client)
+    
+    @asynccontextmanager
+    async def admit(self, client: Optional[str]):
+        """Hold one request slot for `client` for the duration of the block."""
+        client = client or "anonymous"
+        if (self.in_flight < self.max_concurrent and self._running.get(client, 0) < self.per_client
+                and client not in self._waiters):
+            self._grant(client)
+        else:
+            waiters = self._waiters.get(client)
+            if self.queued >= self.queue_total or len(waiters or ()) >= self.queue_per_client:
+                self.stats["rejected"] += 1
+                raise AdmissionRejected("queue full", self.retry_after())
+            fut = asyncio.get_running_loop().create_future()
+            if waiters is None:
+                waiters = self._waiters[client] = deque()
+                self._turns.append(client)
+            waiters.append(fut)
+            self.queued += 1
+            self.stats["queued"] += 1
+            t0 = time.monotonic()
+            try:
+                await asyncio.wait_for(asyncio.shield(fut), self.queue_timeout_s)
+            except BaseException as e:
+                if fut.done() and not fut.cancelled():
+                    self._release(client, None)  # granted just as we gave up
+                else:
+                    fut.cancel()
+                    self._withdraw(client, fut)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.stats["timed_out"] += 1
+                    raise AdmissionRejected("queue wait timed out", self.retry_after()) from None
+                raise
+            self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], round((time.monotonic() - t0) * 1000, 1))
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(client, started)
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {"max_concurrent": self.max_concurrent, "per_client": self.per_client, "in_flight": self.in_flight,
+                "queued": self.queued, "clients_waiting": len(self._waiters), **self.stats}
+
+# Global admission controller (used by the HTTP bridges)
+_admission = AdmissionController()
+
+_PYTEST_COMMAND = re.compile(r"^(?:python(?:3)?\s+-m\s+)?pytest(?:\s|$)")
+_COLLECTED_LINE = re.compile(r"^([^\s:][^:]*\.py)(?:::\S.*|: (\d+))$")
+# pytest options whose value may follow as a separate argument
+_PYTEST_VALUE_OPTS = frozenset({
+    "-k", "-m", "-p", "-c", "-o", "-W", "-r", "--ignore", "--ignore-glob", "--deselect", "--rootdir",
+    "--confcutdir", "--basetemp", "--junitxml", "--junit-xml", "--tb", "--maxfail", "--durations",
+    "--override-ini", "--import-mode", "--log-level", "--log-file", "--capture", "--cov", "--cov-report",
+})
+
+def _durations_path() -> Path:
+    return _cache_dir("test_impact") / "durations.json"
+
+def _load_durations() -> Dict[str, float]:
+    try:
+        return json.loads(_durations_path().read_text(encoding="utf-8")).get(str(WORKSPACE_DIR), {})
+    except (OSError, ValueError):
+        return {}
+
+def _save_durations(measured: Dict[str, float]) -> None:
+    """Fold measured per-file seconds into the stored table (EWMA, alpha 0.5)."""
+    try:
+        data = json.loads(_durations_path().read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        data = {}
+    table = data.setdefault(str(WORKSPACE_DIR), {})
+    for rel, secs in measured.items():
+        table[rel] = round(secs if rel not in table else (table[rel] + secs) / 2, 4)
+    _atomic_write_text(_durations_path(), json.dumps(data))
+
+def _balance_shards(weights: Dict[str, float], n: int) -> List[List[str]]:
+    """Longest-processing-time-first: assign each file, heaviest first, to the lightest shard."""
+    bins: List[tuple[float, int, List[str]]] = [(0.0, i, []) for i in range(n)]
+    for rel, w in sorted(weights.items(), key=lambda kv: (-kv[1], kv[0])):
+        load, i, files = heapq.heappop(bins)
+        files.append(rel)
+        heapq.heappush(bins, (load + w, i, files))
+    return [files for _, _, files in sorted(bins, key=lambda b: b[1]) if files]
+
+def _parse_junit(path: Path, files: List[str]) -> Dict[str, Any]:
+    """Totals, per-file seconds and failed test ids from a pytest --junitxml report."""
+    import xml.etree.ElementTree as ET
+    
+    out: Dict[str, Any] = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0, "durations": {}, "failed": []}
+    try:
+        root = ET.parse(path).getroot()
+    except (OSError, ET.ParseError):
+        return out
+    modules = {_module_name(rel): rel for rel in files}
+    for suite in root.iter("testsuite"):
+        for key in ("tests", "failures", "errors", "skipped"):
+            out[key] += int(suite.get(key, 0) or 0)
+    for case in root.iter("testcase"):
+        classname = case.get("classname", "")
+        rel, parts = None, classname.split(".")
+        for i in range(len(parts), 0, -1):
+            rel = modules.get(".".join(parts[:i]))
+            if rel:
+                cls = ".".join(parts[i:])
+                break
+        if rel is None and len(files) == 1:
+            rel, cls = files[0], ""
+        if rel is None:
+            continue
+        out["durations"][rel] = out["durations"].get(rel, 0.0) + float(case.get("time", 0) or 0)
+        if case.find("failure") is not None or case.find("error") is not None:
+            out["failed"].append("::".join(p for p in (rel, cls, case.get("name", "")) if p))
+    return out
+
+def _split_command(command: str) -> List[str]:
+    import shlex
+    
+    return shlex.split(command, posix=os.name != "nt")
+
+def _split_pytest_args(argv: List[str]) -> tuple[List[str], List[str]]:
+    """Split a pytest argv into (command and options, positional test paths)."""
+    start = next((i + 1 for i, arg in enumerate(argv) if arg == "pytest" or arg.endswith(("/pytest", "\\pytest"))), len(argv))
+    options, paths = list(argv[:start]), []
+    takes_value = False
+    for arg in argv[start:]:
+        if takes_value or arg.startswith("-"):
+            options.append(arg)
+            takes_value = not takes_value and arg in _PYTEST_VALUE_OPTS
+        else:
+            paths.append(arg)
+    return options, paths
+
+async def _collect_test_files(argv: List[str], timeout_seconds: float) -> Optional[Dict[str, int]]:
+    """Test files and their test counts from `pytest --collect-only -q` (None if collection failed)."""
+    proc = await asyncio.create_subprocess_exec(
+        *argv, "--collect-only", "-q", cwd=str(WORKSPACE_DIR), env=_command_env(),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, stdin=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout_seconds)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return None
+    if proc.returncode not in (0, 5):
+        return None
+    counts: Dict[str, int] = {}
+    for line in stdout.decode("utf-8", errors="replace").splitlines():
+        m = _COLLECTED_LINE.match(line.strip())
+        if m:
+            counts[m.group(1)] = counts.get(m.group(1), 0) + (int(m.group(2)) if m.group(2) else 1)
+    # Node ids are rootdir-relative; only shard when they are workspace paths
+    if not counts or not all((WORKSPACE_DIR / rel).is_file() for rel in counts):
+        return None
+    return counts
+
+def _merge_returncodes(codes: List[int]) -> int:
+    """pytest exit codes across shards: the worst failure wins; 5 (nothing collected) only if every shard had it."""
+    failing = [c for c in codes if c not in (0, 5)]
+    if failing:
+        return max(failing)
+    return 0 if 0 in codes else 5
+
+async def _run_sharded(command: str, shards: int, timeout_seconds: int, timer: StageTimer) -> Optional[Dict[str, Any]]:
+    """Run a whitelisted pytest command as parallel shards; None means run it unsharded instead."""
+    import shutil
+    
+    argv = _split_command(command)
+    options, paths = _split_pytest_args(argv)
+    if any("::" in p for p in paths):
+        return None  # node ids select tests within files; shards only split by file
+    with timer.stage("collect"):
+        async with _command_slots.acquire():
+            counts = await _collect_test_files(argv, timeout_seconds)
+    if not counts:
+        return None
+    known = _load_durations()
+    total_known = sum(known.get(rel, 0.0) for rel in counts if rel in known)
+    tests_known = sum(counts[rel] for rel in counts if rel in known)
+    per_test = total_known / tests_known if tests_known else 0.1
+    weights = {rel: known.get(rel, counts[rel] * per_test) for rel in counts}
+    wanted = min(shards if shards > 0 else (os.cpu_count() or 1), _command_slots.capacity, len(counts))
+    wanted = min(wanted, max(1, _command_slots.free()))
+    if wanted < 2:
+        return None
+    report_dir = Path(tempfile.mkdtemp(prefix="shards-", dir=_cache_dir("test_impact")))
+    t0 = time.perf_counter()
+    try:
+        async with _command_slots.acquire(wanted) as n:
+            groups = _balance_shards(weights, n)
+            procs = []
+            # Each shard gets only its own files in place of the command's test paths
+            for i, files in enumerate(groups):
+                procs.append(await asyncio.create_subprocess_exec(
+                    *options, *files, f"--junitxml={report_dir / f'shard-{i}.xml'}", cwd=str(WORKSPACE_DIR), env=_command_env(),
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, stdin=asyncio.subprocess.DEVNULL,
+                ))
+            try:
+                outputs = await asyncio.wait_for(asyncio.gather(*(p.communicate() for p in procs)), timeout=timeout_seconds)
+            except asyncio.TimeoutError:
+                for p in procs:
+                    if p.returncode is None:
+                        p.kill()
+                await asyncio.gather(*(p.wait() for p in procs))
+                write_audit(AuditEntry(time.time(), "run_command", {"command": command, "shards": len(groups)}, False, {"timeout": timeout_seconds}))
+                raise TimeoutError(f"Command timed out after {timeout_seconds} seconds")
+    except BaseException:
+        shutil.rmtree(report_dir, ignore_errors=True)
+        raise
+    elapsed_ms = int((time.perf_counter() - t0) * 1000)
+    timer.add("execute", elapsed_ms / 1000, started=t0)
+    shard_info: List[Dict[str, Any]] = []
+    measured: Dict[str, float] = {}
+    totals = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0}
+    failed: List[str] = []
+    stdout_parts: List[str] = []
+    stderr_parts: List[str] = []
+    for i, (files, proc, (out, err)) in enumerate(zip(groups, procs, outputs)):
+        report = _parse_junit(report_dir / f"shard-{i}.xml", files)
+        measured.update(report["durations"])
+        failed.extend(report["failed"])
+        for key in totals:
+            totals[key] += report[key]
+        shard_info.append({"shard": i + 1, "files": len(files), "returncode": proc.returncode,
+                           "tests": report["tests"], "seconds": round(sum(report["durations"].values()), 3)})
+        stdout_parts.append(f"===== shard {i + 1}/{len(groups)}: {len(files)} files, rc={proc.returncode} =====\n"
+                            + out.decode("utf-8", errors="replace"))
+        if err:
+            stderr_parts.append(f"===== shard {i + 1}/{len(groups)} =====\n" + err.decode("utf-8", errors="replace"))
+    shutil.rmtree(report_dir, ignore_errors=True)
+    if measured:
+        _save_durations(measured)
+    summary = (f"{totals['tests']} tests, {totals['failures']} failed, {totals['errors']} errors, "
+               f"{totals['skipped']} skipped in {len(groups)} shards ({elapsed_ms} ms)")
+    return {
+        "returncode": _merge_returncodes([p.returncode for p in procs]),
+        "stdout": summary + "\n" + "".join(stdout_parts),
+        "stderr": "".join(stderr_parts),
+        "elapsed_ms": elapsed_ms,
+        "summary": totals,
+        "failed": failed,
+        "shards": shard_info,
+    }
+
+# -----------------------------
+# Tools — full
+# -----------------------------
+@server.tool()
+@_profiled
+async def read_file(path: str, allow_denied_explicit: bool = False) -> str:
+    """Read a UTF-8 text file from the workspace.
+    
+    Args:
+        path: File path relative to workspace
+        allow_denied_explicit: If True, allow reading denylisted paths (default: False)
+    """
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    timer = StageTimer("read_file")
+    with timer.stage("safe_join"):
+        abs_path = safe_join(path)
+        if not abs_path.is_file():
+            raise FileNotFoundError(f"Not a file: {path}")
+        rel = abs_path.relative_to(WORKSPACE_DIR).as_posix()
+    with timer.stage("match"):
+        denied = _denylisted(rel)
+    if denied and not allow_denied_explicit:
+        raise PermissionError("Path is denylisted (set allow_denied_explicit=true to override)")
+    try:
+        with timer.stage("read_decode"):
+            text = _read_text_guarded(abs_path)
+        # Auto-summarize if context threshold reached
+        with timer.stage("summarize"):
+            text = _auto_summarize_if_needed(text, context_name=f"file:{path}")
+        with timer.stage("audit_write"):
+            write_audit(AuditEntry(time.time(), "read_file", {"path": path, "allow_denied": allow_denied_explicit}, True, {"size": len(text), "context_pct": _context_tracker.get_usage_pct()}))
+        timer.finish()
+        return text
+    except Exception as e:
+        write_audit(AuditEntry(time.time(), "read_file", {"path": path}, False, {"error": str(e)}))
+        raise
+
+@server.tool()
+@_profiled
+async def list_files(base: str = ".", pattern: str = "**/*", max_results: int = 2000, include_denied: bool = False,
+                     changed_only: bool = False, respect_gitignore: Optional[bool] = None, cursor: Optional[str] = None,
+                     paginate: bool = False) -> Union[List[str], Dict[str, Any]]:
+    """List files under a base directory with glob pattern.
+    
+    Served from the incremental workspace index (a directory walk cached by
+    directory mtime; in git workspaces .git/index supplies tracked status).
+    include_denied walks the tree directly. changed_only lists
+    modified and untracked files, detected from git index stat data.
+    Untracked files matched by .gitignore/.ignore are skipped unless
+    respect_gitignore=False (default: MCP_RESPECT_GITIGNORE); a base that is
+    itself ignored is listed in full.
+    
+    With paginate=True (or a cursor) the result is {"files", "next_cursor",
+    "index_changed"}; pass next_cursor back with the same arguments to
+    continue after the last file instead of listing from the start.
+    """
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    timer = StageTimer("list_files")
+    with timer.stage("safe_join"):
+        base_abs = safe_join(base)
+        if not base_abs.exists():
+            raise FileNotFoundError(f"Base not found: {base}")
+        base_rel = base_abs.relative_to(WORKSPACE_DIR).as_posix()
+    respect = RESPECT_GITIGNORE if respect_gitignore is None else respect_gitignore
+    if respect and base_rel != "." and _ignore_engine.is_ignored(base_rel, base_abs.is_dir()):
+        respect = False
+    page_params = {"base": base_rel, "pattern": pattern, "include_denied": include_denied,
+                   "changed_only": changed_only, "respect": respect}
+    state = _decode_cursor(cursor, "list_files", page_params) if cursor else {}
+    after = state.get("after")
+    results: List[str] = []
+    generation: Optional[int] = None
+    if include_denied or respect != RESPECT_GITIGNORE:
+        candidates: Any = (rel for rel, _ in _iter_workspace_files(base_abs, include_denied=include_denied, respect_ignore=respect, start=after))
+    else:
+        with timer.stage("index_refresh"):
+            _workspace_index.refresh()
+        generation = _workspace_index.generation
+        if changed_only:
+            if not _workspace_index.git_dir:
+                raise ValueError("changed_only requires a git workspace")
+            with timer.stage("git_changes"):
+                changes = _workspace_index.git_changes()
+            prefix = "" if base_rel == "." else base_rel + "/"
+            candidates = (rel for rel in sorted(changes["modified"] + changes["untracked"])
+                          if rel.startswith(prefix) and (after is None or rel > after))
+        else:
+            candidates = _workspace_index.iter_under(base_rel, start=after)
+    timer.mark()
+    for rel in candidates:
+        timer.lap("walk")
+        if rel == after:
+            continue
+        matched = _glob_match(rel, pattern)
+        timer.lap("match")
+        if not matched:
+            continue
+        results.append(rel)
+        if len(results) >= max_results:
+            break
+    timer.lap("walk")
+    
+    # Auto-summarize file list if context threshold reached
+    timer.mark()
     result_text = "\n".join(results)
     _context_tracker.add(result_text)
     if _context_tracker.should_summarize():
@@ -520,20 +4975,55 @@ async def list_files(base: str = ".", pattern: str = "**/*", max_results: int =
         result_text = "\n".join(summary_parts)
         _context_tracker.reset()
         _context_tracker.add(result_text)
+    timer.lap("summarize")
     
-    write_audit(AuditEntry(time.time(), "list_files", {"base": base, "pattern": pattern}, True, {"count": len(results), "context_pct": _context_tracker.get_usage_pct()}))
-    return results
+    with timer.stage("audit_write"):
+        write_audit(AuditEntry(time.time(), "list_files", {"base": base, "pattern": pattern, "cursor": bool(cursor)}, True, {"count": len(results), "context_pct": _context_tracker.get_usage_pct()}))
+    timer.finish()
+    if not (paginate or cursor):
+        return results
+    next_cursor = None
+    if results and len(results) >= max_results:
+        next_cursor = _encode_cursor("list_files", page_params, {"after": results[-1]}, generation)
+    return {
+        "files": results,
+        "next_cursor": next_cursor,
+        "index_changed": bool(cursor) and state.get("g") != generation,
+    }
 
 @server.tool()
-async def write_file(path: str, content: str, mode: str = "replace", require_confirmation: bool = True, create_dirs: bool = True) -> str:
+@_profiled
+async def write_file(path: str, content: str = "", mode: str = "replace", require_confirmation: bool = True, create_dirs: bool = True,
+                     edits: Optional[List[Dict[str, Any]]] = None) -> str:
     """Write a text file.
-    mode: "replace" | "append" | "create" (fail if exists)
+    mode: "replace" | "append" | "create" (fail if exists) | "patch"
+    patch: `content` is a unified diff for this file, or pass `edits` as
+           [{"start_line", "end_line", "text"}] line-range replacements.
     require_confirmation: when True, returns a preview plan; call again with False to apply.
+    replace/create/patch are written to a temp file and atomically renamed over the target.
     """
     if not rate_write.allow():
         raise RuntimeError("Rate limit exceeded for writes")
     abs_path = safe_join(path)
     rel = abs_path.relative_to(WORKSPACE_DIR).as_posix()
+    patch_stats: Optional[Dict[str, int]] = None
+    if mode == "patch":
+        if not abs_path.is_file():
+            raise FileNotFoundError(f"Not a file: {path}")
+        data = abs_path.read_bytes()
+        if len(data) > MAX_FILE_BYTES:
+            raise ValueError(f"File exceeds byte limit: {abs_path} ({len(data)} bytes > {MAX_FILE_BYTES})")
+        try:
+            original = data.decode("utf-8")
+        except UnicodeDecodeError:
+            raise ValueError("Patch mode requires a UTF-8 file")
+        if edits:
+            content, patch_stats = _apply_line_edits(original, edits)
+        else:
+            content, patch_stats = _apply_unified_diff(original, content)
+        patch_stats["bytes_before"] = len(data)
+    elif edits:
+        raise ValueError('edits require mode="patch"')
     if require_confirmation:
         plan = {
             "action": "WRITE_PREVIEW",
@@ -542,6 +5032,8 @@ async def write_file(path: str, content: str, mode: str = "replace", require_con
             "mode": mode,
             "note": "Resend with require_confirmation=false to apply",
         }
+        if patch_stats is not None:
+            plan["diff"] = patch_stats
         write_audit(AuditEntry(time.time(), "write_file", {"path": path, "mode": mode}, True, {"preview": True}))
         return json.dumps(plan)
     abs_path.parent.mkdir(parents=True, exist_ok=create_dirs)
@@ -552,12 +5044,21 @@ async def write_file(path: str, content: str, mode: str = "replace", require_con
         with abs_path.open("a", encoding="utf-8") as f:
             f.write(content)
     else:
-        with abs_path.open("w", encoding="utf-8") as f:
-            f.write(content)
-    write_audit(AuditEntry(time.time(), "write_file", {"path": path, "mode": mode}, True, {"applied": True, "bytes": len(content)}))
+        # Patched text keeps the file's own line endings
+        _atomic_write_text(abs_path, content, newline="" if mode == "patch" else None)
+    if not exists:
+        _file_finder.invalidate()
+    _symbol_index.invalidate(rel)
+    _workspace_stats.invalidate(rel)
+    _workspace_manifest.invalidate(rel)
+    meta: Dict[str, Any] = {"applied": True, "bytes": len(content)}
+    if patch_stats is not None:
+        meta["diff"] = patch_stats
+    write_audit(AuditEntry(time.time(), "write_file", {"path": path, "mode": mode}, True, meta))
     return "OK"
 
 @server.tool()
+@_profiled
 async def reset_context() -> Dict[str, Any]:
     """Reset soft state like rate windows (keeps audit log)."""
     old_chars = _context_tracker.current_chars
@@ -574,31 +5075,65 @@ async def reset_context() -> Dict[str, Any]:
         "rate_limiters_reset": True,
     }
 
+_command_ids = itertools.count(1)
+
+def _command_env() -> Dict[str, str]:
+    """Environment for spawned commands: pagers and credential prompts disabled."""
+    # Fix for Windows/PowerShell hanging: disable paging and ensure non-interactive
+    env = os.environ.copy()
+    env.update({
+        "GIT_PAGER": "cat",  # Disable git pager
+        "PAGER": "cat",  # Disable system pager
+        "GIT_TERMINAL_PROMPT": "0",  # Disable terminal prompts
+        "GIT_ASKPASS": "",  # Disable credential prompts
+        "GCM_INTERACTIVE": "never",  # Disable Git Credential Manager prompts
+    })
+    return env
+
 @server.tool()
-async def run_command(command: str, timeout_seconds: int = 60) -> Dict[str, Any]:
-    """Run a whitelisted shell command within the workspace."""
+@_profiled
+async def run_command(command: str, timeout_seconds: int = 60, shards: Optional[int] = None) -> Dict[str, Any]:
+    """Run a whitelisted shell command within the workspace.
+    
+    shards runs a pytest command as parallel worker processes (0 = one per
+    core), split by file and balanced on recorded durations; it is capped by
+    MCP_MAX_CONCURRENT_COMMANDS. Other commands ignore it.
+    """
     if not rate_cmd.allow():
         raise RuntimeError("Rate limit exceeded for commands")
     
-    if not is_allowed_command(command):
+    timer = StageTimer("run_command")
+    with timer.stage("validate"):
+        allowed = is_allowed_command(command)
+    if not allowed:
         raise PermissionError("Command not allowed by whitelist")
     
     # Generate unique command ID for tracking
-    command_id = f"cmd_{int(time.time() * 1000)}"
+    command_id = f"cmd_{int(time.time() * 1000)}_{next(_command_ids)}"
     
     # Start watching
     _command_watcher.start_command(command_id, command)
     
     try:
-        # Fix for Windows/PowerShell hanging: disable paging and ensure non-interactive
-        env = os.environ.copy()
-        env.update({
-            "GIT_PAGER": "cat",  # Disable git pager
-            "PAGER": "cat",  # Disable system pager
-            "GIT_TERMINAL_PROMPT": "0",  # Disable terminal prompts
-            "GIT_ASKPASS": "",  # Disable credential prompts
-            "GCM_INTERACTIVE": "never",  # Disable Git Credential Manager prompts
-        })
+        if shards is not None and shards != 1 and _PYTEST_COMMAND.match(command.strip()):
+            _command_watcher.update_command(command_id, "sharding", "Collecting tests...")
+            result = await _run_sharded(command, shards, timeout_seconds, timer)
+            if result is not None:
+                success = result["returncode"] == 0
+                output_size = len(result["stdout"]) + len(result["stderr"])
+                _command_watcher.end_command(command_id, success, returncode=result["returncode"],
+                                             elapsed_ms=result["elapsed_ms"], output_size=output_size)
+                with timer.stage("audit_write"):
+                    write_audit(AuditEntry(time.time(), "run_command", {"command": command, "shards": len(result["shards"])}, success, {
+                        "rc": result["returncode"],
+                        "ms": result["elapsed_ms"],
+                        "output_size": output_size,
+                    }))
+                timer.finish()
+                return result
+            _command_watcher.update_command(command_id, "unsharded", "Running as a single process")
+        
+        env = _command_env()
         
         # For git commands, ensure --no-pager flag if not already present
         original_command = command
@@ -613,38 +5148,42 @@ async def run_command(command: str, timeout_seconds: int = 60) -> Dict[str, Any]
         
         _command_watcher.update_command(command_id, "spawning", f"Creating subprocess...")
         
-        proc = await asyncio.create_subprocess_shell(
-            command,
-            cwd=str(WORKSPACE_DIR),
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            env=env,
-            stdin=asyncio.subprocess.DEVNULL,  # Prevent waiting for input
-        )
-        
-        _command_watcher.update_command(command_id, "executing", f"PID: {proc.pid}")
-        
-        t0 = time.perf_counter()
-        
-        # Use asyncio.wait_for with timeout
-        try:
-            stdout, stderr = await asyncio.wait_for(
-                proc.communicate(), 
-                timeout=timeout_seconds
-            )
-            dt = time.perf_counter() - t0
-            _command_watcher.update_command(command_id, "completed", f"Finished in {int(dt*1000)}ms")
-        except asyncio.TimeoutError:
-            _command_watcher.update_command(command_id, "timeout", f"Exceeded {timeout_seconds}s timeout")
-            proc.kill()
-            await proc.wait()  # Wait for process to actually terminate
-            write_audit(AuditEntry(time.time(), "run_command", {"command": original_command}, False, {"timeout": timeout_seconds}))
-            _command_watcher.end_command(command_id, False, returncode=-1, elapsed_ms=int(timeout_seconds * 1000))
-            raise TimeoutError(f"Command timed out after {timeout_seconds} seconds")
+        async with _command_slots.acquire():
+            with timer.stage("spawn"):
+                proc = await asyncio.create_subprocess_shell(
+                    command,
+                    cwd=str(WORKSPACE_DIR),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    env=env,
+                    stdin=asyncio.subprocess.DEVNULL,  # Prevent waiting for input
+                )
+            
+            _command_watcher.update_command(command_id, "executing", f"PID: {proc.pid}")
+            
+            t0 = time.perf_counter()
+            
+            # Use asyncio.wait_for with timeout
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    proc.communicate(), 
+                    timeout=timeout_seconds
+                )
+                dt = time.perf_counter() - t0
+                timer.add("execute", dt, started=t0)
+                _command_watcher.update_command(command_id, "completed", f"Finished in {int(dt*1000)}ms")
+            except asyncio.TimeoutError:
+                _command_watcher.update_command(command_id, "timeout", f"Exceeded {timeout_seconds}s timeout")
+                proc.kill()
+                await proc.wait()  # Wait for process to actually terminate
+                write_audit(AuditEntry(time.time(), "run_command", {"command": original_command}, False, {"timeout": timeout_seconds}))
+                _command_watcher.end_command(command_id, False, returncode=-1, elapsed_ms=int(timeout_seconds * 1000), timed_out=True)
+                raise TimeoutError(f"Command timed out after {timeout_seconds} seconds")
         
         # Decode output
-        stdout_text = stdout.decode("utf-8", errors="replace")
-        stderr_text = stderr.decode("utf-8", errors="replace")
+        with timer.stage("decode"):
+            stdout_text = stdout.decode("utf-8", errors="replace")
+            stderr_text = stderr.decode("utf-8", errors="replace")
         output_size = len(stdout_text) + len(stderr_text)
         
         success = proc.returncode == 0
@@ -659,11 +5198,13 @@ async def run_command(command: str, timeout_seconds: int = 60) -> Dict[str, Any]
             output_size=output_size
         )
         
-        write_audit(AuditEntry(time.time(), "run_command", {"command": original_command}, success, {
-            "rc": proc.returncode, 
-            "ms": elapsed_ms,
-            "output_size": output_size
-        }))
+        with timer.stage("audit_write"):
+            write_audit(AuditEntry(time.time(), "run_command", {"command": original_command}, success, {
+                "rc": proc.returncode, 
+                "ms": elapsed_ms,
+                "output_size": output_size
+            }))
+        timer.finish()
         
         return {
             "returncode": proc.returncode,
@@ -672,22 +5213,121 @@ async def run_command(command: str, timeout_seconds: int = 60) -> Dict[str, Any]
             "elapsed_ms": elapsed_ms,
         }
     except Exception as e:
-        _command_watcher.end_command(command_id, False, returncode=-1)
+        _command_watcher.end_command(command_id, False, returncode=-1, timed_out=isinstance(e, TimeoutError))
         LOG.error(f"❌ ERROR: {str(e)}")
         raise
 
 @server.tool()
-async def get_diagnostics() -> Dict[str, Any]:
-    """Return health & security posture and a perf probe."""
+@_profiled
+async def run_impacted_tests(changed: Optional[List[str]] = None, run_all: bool = False,
+                             dry_run: bool = False, timeout_seconds: int = 600,
+                             shards: Optional[int] = None) -> Dict[str, Any]:
+    """Run the pytest modules affected by files changed since the last green run.
+    
+    Selection follows the Python import graph; deleted modules select the
+    tests that imported them. With no recorded green run, when pytest/packaging
+    config changed, or when a non-Python file changed (tests may read it), the
+    whole suite runs. A passing run records the current file hashes as the
+    new baseline.
+    
+    Args:
+        changed: Paths to treat as changed instead of diffing against the last green run
+        run_all: Run the full suite (escape hatch)
+        dry_run: Only report the selection
+        timeout_seconds: Passed through to run_command
+        shards: Passed through to run_command (parallel pytest workers; 0 = one per core)
+    """
+    timer = StageTimer("run_impacted_tests")
+    with timer.stage("snapshot"):
+        _workspace_manifest.refresh()
+        snapshot = {rel: rec[2] for rel, rec in _workspace_manifest.files.items()}
+    reason = "import_graph"
+    if changed is None:
+        baseline = _load_last_green()
+        if baseline is None:
+            changed_paths: List[str] = []
+            reason = "no_baseline"
+        else:
+            changed_paths = sorted(rel for rel in snapshot.keys() | baseline.keys() if snapshot.get(rel) != baseline.get(rel))
+    else:
+        changed_paths = sorted({p.relative_to(WORKSPACE_DIR).as_posix() for p in safe_join_many(changed)})
+    if run_all:
+        reason = "run_all"
+    elif any(rel.rsplit("/", 1)[-1] in _TEST_CONFIG_FILES for rel in changed_paths):
+        reason = "config_changed"
+    with timer.stage("select"):
+        _import_graph.refresh()
+        affected = _import_graph.affected([rel for rel in changed_paths if rel.endswith((".py", ".pyi"))])
+        selected = sorted(rel for rel in affected if _is_test_module(rel) and rel in snapshot)
+    unmapped = [rel for rel in changed_paths if not rel.endswith((".py", ".pyi")) and rel.rsplit("/", 1)[-1] not in _TEST_CONFIG_FILES]
+    if reason == "import_graph" and unmapped:
+        reason = "unmapped_changes"
+    if reason == "import_graph" and not all(_SAFE_TEST_PATH.fullmatch(rel) for rel in selected):
+        reason = "unsafe_paths"
+    full = reason != "import_graph"
+    command = "python -m pytest -q" + ("" if full else "".join(" " + rel for rel in selected))
+    result: Dict[str, Any] = {
+        "reason": reason,
+        "changed": changed_paths[:500],
+        "unmapped": unmapped[:100],
+        "selected": None if full else selected,
+        "command": command,
+        "ran": False,
+        "baseline_updated": False,
+    }
+    if dry_run:
+        write_audit(AuditEntry(time.time(), "run_impacted_tests", {"dry_run": True}, True, {"reason": reason, "selected": len(selected)}))
+        timer.finish()
+        return result
+    if not full and not selected:
+        # Nothing imports the changed files: the suite's outcome can't have changed
+        ok = True
+    else:
+        with timer.stage("pytest"):
+            run = await run_command(command, timeout_seconds=timeout_seconds, shards=shards)
+        result.update(run)
+        result["ran"] = True
+        ok = run["returncode"] in (0, 5)  # 5: no tests collected
+    if ok and (changed is None or full):
+        _save_last_green(snapshot)
+        result["baseline_updated"] = True
+    write_audit(AuditEntry(time.time(), "run_impacted_tests", {"changed": len(changed_paths), "run_all": run_all}, ok,
+                           {"reason": reason, "selected": len(selected), "ran": result["ran"]}))
+    timer.finish()
+    return result
+
+@server.tool()
+@_profiled
+async def get_diagnostics(profile_tool: Optional[str] = None, profile_calls: int = 0,
+                          profile_seconds: float = 0.0, profile_top: int = 15,
+                          profile_stop: bool = False) -> Dict[str, Any]:
+    """Return health & security posture and a perf probe.
+    
+    Args:
+        profile_tool: Arm cProfile capture for this tool (e.g. "search_code")
+        profile_calls: Number of upcoming calls to capture (default 1 if no window is given)
+        profile_seconds: Capture every call of the tool for this many seconds
+        profile_top: Number of functions kept in each capture's summary
+        profile_stop: Disarm the profiler
+    """
+    if profile_stop:
+        _profiler.disarm()
+    if profile_tool:
+        if profile_tool not in _PROFILABLE_TOOLS:
+            raise ValueError(f"Unknown tool for profiling: {profile_tool}")
+        _profiler.arm(profile_tool, calls=profile_calls, seconds=profile_seconds, top_n=profile_top)
+        write_audit(AuditEntry(time.time(), "get_diagnostics", {"profile_tool": profile_tool, "calls": profile_calls, "seconds": profile_seconds}, True, {"profiler_armed": True}))
     t0 = time.perf_counter()
     _ = list((WORKSPACE_DIR).iterdir()) if WORKSPACE_DIR.exists() else []
     elapsed_ms = int((time.perf_counter() - t0) * 1000)
+    command_patterns = await asyncio.to_thread(_command_telemetry.summary)
     return {
         "workspace": str(WORKSPACE_DIR),
         "audit_log": str(AUDIT_LOG_PATH),
         "limits": RATE_LIMITS,
         "allowed_commands": ALLOWED_COMMANDS,
         "denylist": READ_DENYLIST,
+        "server_owned": list(_server_owned_globs(WORKSPACE_DIR, AUDIT_LOG_PATH, CACHE_DIR)),
         "max_file_bytes": MAX_FILE_BYTES,
         "perf_probe_ms": elapsed_ms,
         "context": {
@@ -699,49 +5339,181 @@ async def get_diagnostics() -> Dict[str, Any]:
             "recent_summaries": list(_context_tracker.summaries),
         },
         "watcher": _command_watcher.get_status(),
+        "command_telemetry": {**_command_telemetry.get_status(), "patterns": command_patterns},
+        "profiler": _profiler.get_status(),
+        "stages": _stage_metrics.snapshot(),
+        "workspace_index": _workspace_index.get_status(),
+        "symbol_index": {"files": len(_symbol_index.files), "names": len(_symbol_index.by_name), **_symbol_index.stats},
+        "file_classes": _file_classifier.get_status(),
+        "regex_sandbox": _regex_sandbox.get_status(),
+        "file_finder": _file_finder.get_status(),
+        "workspace_stats": _workspace_stats.get_status(),
+        "fs_watcher": _fs_watcher.get_status(),
+        "manifest": _workspace_manifest.get_status(),
+        "import_graph": _import_graph.get_status(),
+        "command_slots": _command_slots.get_status(),
+        "admission": _admission.get_status(),
+        "tree_snapshots": _tree_snapshots.get_status(),
+        "audit_index": _audit_index.get_status(),
+        "path_resolver": _path_resolver.get_status(),
+        "audit_rotation": _audit_rotator.get_status(),
     }
 
 @server.tool()
-async def search_code(query: str, file_glob: str = "**/*", max_results: int = 200, context_lines: int = 1) -> List[Dict[str, Any]]:
-    """Regex search across text files with context."""
+@_profiled
+async def audit_query(tool: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+                      ok: Optional[bool] = None, client: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
+    """Query the audit log and its rotated segments, newest entries first.
+    
+    Args:
+        tool: Only entries for this tool (e.g. "run_command")
+        since: Earliest timestamp (epoch seconds)
+        until: Latest timestamp (epoch seconds)
+        ok: Only successful (true) or failed (false) entries
+        client: Only entries attributed to this client
+        limit: Maximum entries returned
+    """
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    timer = StageTimer("audit_query")
+    with timer.stage("query"):
+        result = await asyncio.to_thread(_audit_index.query, tool, since, until, ok, client, max(1, limit))
+    write_audit(AuditEntry(time.time(), "audit_query", {"tool": tool, "since": since, "until": until, "ok": ok, "client": client}, True,
+                           {"returned": len(result["entries"]), "scanned_bytes": result["scanned_bytes"]}))
+    timer.finish()
+    return result
+
+@server.tool()
+@_profiled
+async def search_code(query: str = "", file_glob: str = "**/*", max_results: int = 200, context_lines: int = 1,
+                      respect_gitignore: Optional[bool] = None,
+                      patterns: Optional[List[Dict[str, Any]]] = None, cursor: Optional[str] = None,
+                      paginate: bool = False, timeout_s: Optional[float] = None) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
+    """Regex search across text files with context.
+    
+    Files come from the workspace index, so denylisted and (untracked)
+    ignored subtrees are never walked; respect_gitignore=False searches
+    ignored files too.
+    
+    patterns runs several searches in one pass: a list of
+    {"name", "regex" | "literal", "ignore_case"?} entries (plus `query`, if
+    given, as "query"). Each file is read once and every hit carries the
+    "pattern" name that matched.
+    
+    With paginate=True (or a cursor) the result is {"hits", "next_cursor",
+    "index_changed", "timed_out"}; next_cursor resumes at the file where the
+    page ended, so only that one file is scanned again.
+    
+    Regexes run in a killable worker process (MCP_REGEX_SANDBOX) and the
+    query stops at timeout_s (default MCP_REGEX_TIMEOUT). Hits found before
+    the deadline are returned, followed by a "[timeout]" entry (or
+    timed_out=True when paginating; the cursor then skips the file that
+    timed out). Literal-only searches run in-process.
+    """
     if not rate_read.allow():
         raise RuntimeError("Rate limit exceeded for reads")
+    timer = StageTimer("search_code")
+    specs = ([{"name": "query", "regex": query}] if query else []) + list(patterns or [])
+    if not specs:
+        raise ValueError("query or patterns is required")
     try:
-        pattern = re.compile(query, re.MULTILINE)
+        with timer.stage("compile"):
+            pattern = MultiPattern(specs)
     except re.error as e:
         raise ValueError(f"Invalid regex: {e}")
+    if REGEX_PRECHECK == "reject":
+        for spec in specs:
+            risk = _regex_risk(spec["regex"]) if spec.get("regex") else None
+            if risk:
+                raise ValueError(f"Regex {spec['regex']!r} rejected: {risk} can backtrack catastrophically "
+                                 f"(rewrite e.g. (a+)+ as a+, or set MCP_REGEX_PRECHECK=off)")
+    tagged = bool(patterns)
+    timeout = REGEX_TIMEOUT_S if timeout_s is None else timeout_s
+    sandboxed = REGEX_SANDBOX_ENABLED and not pattern.literal_only
     hits: List[Dict[str, Any]] = []
-    for path in WORKSPACE_DIR.rglob("*"):
-        if not path.is_file():
-            continue
-        rel = path.relative_to(WORKSPACE_DIR).as_posix()
-        if _denylisted(rel):
-            continue
-        if not fnmatch.fnmatch(rel, file_glob):
-            continue
-        try:
-            text = _read_text_guarded(path)
-        except Exception:
-            continue
-        for m in pattern.finditer(text):
-            lines = text.splitlines()
-            line_no = text.count("\n", 0, m.start()) + 1
-            lo = max(1, line_no - context_lines)
-            hi = min(len(lines), line_no + context_lines)
-            snippet = "\n".join(lines[lo-1:hi])
-            hits.append({
-                "file": rel,
-                "line": line_no,
-                "match": m.group(0),
-                "context": snippet,
-            })
-            if len(hits) >= max_results:
-                break
-            if len(hits) >= max_results:
+    respect = RESPECT_GITIGNORE if respect_gitignore is None else respect_gitignore
+    page_params = {"specs": specs, "file_glob": file_glob, "context_lines": context_lines, "respect": respect}
+    state = _decode_cursor(cursor, "search_code", page_params) if cursor else {}
+    resume_file, resume_skip = state.get("file"), state.get("skip", 0)
+    generation: Optional[int] = None
+    end_file, end_count = None, 0
+    timer.mark()
+    if respect == RESPECT_GITIGNORE:
+        _workspace_index.refresh()
+        generation = _workspace_index.generation
+        candidates: Any = _workspace_index.iter_under(".", start=resume_file)
+    else:
+        candidates = (rel for rel, _ in _iter_workspace_files(respect_ignore=respect, start=resume_file))
+    lap = (lambda stage: None) if sandboxed else timer.lap  # the worker's time is recorded as one stage
+    
+    def text_files() -> Iterator[tuple[str, str]]:
+        for rel in candidates:
+            lap("walk")
+            if rel == resume_file and resume_skip < 0:
+                continue
+            matched = _glob_match(rel, file_glob)
+            lap("match")
+            if not matched:
+                continue
+            path = WORKSPACE_DIR / rel
+            try:
+                st = path.stat()
+                kind, encoding = ("binary", "") if st.st_size > MAX_FILE_BYTES else _file_classifier.classify(path, st)
+            except OSError:
+                kind = "binary"
+            lap("sniff")
+            if kind == "binary":
+                continue
+            yield rel, encoding
+    
+    def run_scan() -> Optional[tuple[str, int]]:
+        """Fill hits; returns (file, cursor skip) if the deadline stopped the scan.
+        
+        One hit past max_results is fetched so a page that exactly uses up the
+        matches gets no cursor; the cursor resumes at that extra hit.
+        """
+        nonlocal end_file, end_count
+        if sandboxed:
+            with timer.stage("sandbox_scan"):
+                results, stuck = _regex_sandbox.scan(specs, tagged, text_files(), context_lines, max_results + 1,
+                                                     (resume_file, resume_skip), timeout)
+            for rel, file_hits, consumed in results:
+                hits.extend(file_hits)
+                end_file, end_count = rel, consumed
+            if len(hits) > max_results:
+                del hits[max_results:]
+                end_count -= 1
+            else:
+                end_file = None
+            return (stuck, -1) if stuck else None
+        deadline = time.monotonic() + timeout
+        for rel, encoding in text_files():
+            if time.monotonic() > deadline:
+                return rel, 0
+            try:
+                text = _read_text_guarded(WORKSPACE_DIR / rel, encoding)
+            except Exception:
+                timer.lap("read_decode")
+                continue
+            timer.lap("read_decode")
+            file_hits, consumed = _scan_text(pattern, rel, text, context_lines, tagged,
+                                             resume_skip if rel == resume_file else 0, max_results + 1 - len(hits))
+            hits.extend(file_hits)
+            timer.lap("regex_scan")
+            if len(hits) > max_results:
+                del hits[max_results:]
+                end_file, end_count = rel, consumed - 1
                 break
+        return None
+    
+    timed_out = await asyncio.to_thread(run_scan)
+    if timed_out:
+        end_file, end_count = timed_out
     
-    # Auto-summarize search results if context threshold reached
-    if _context_tracker.should_summarize() and hits:
+    # Auto-summarize search results if context threshold reached; pages are
+    # left whole so the cursor's skip counts still match what was returned
+    timer.mark()
+    if not (paginate or cursor) and _context_tracker.should_summarize() and hits:
         # Summarize by grouping by file and showing top matches
         file_groups: Dict[str, List[Dict[str, Any]]] = {}
         for hit in hits:
@@ -775,22 +5547,267 @@ async def search_code(query: str, file_glob: str = "**/*", max_results: int = 20
         # Estimate size for tracking
         hits_text = json.dumps(hits)
         _context_tracker.add(hits_text)
+    timer.lap("summarize")
+    
+    with timer.stage("audit_write"):
+        write_audit(AuditEntry(time.time(), "search_code", {"query": query, "patterns": pattern.names if tagged else None, "cursor": bool(cursor)}, True, {"count": len(hits), "context_pct": _context_tracker.get_usage_pct(), "timed_out": bool(timed_out)}))
+    timer.finish()
+    if not (paginate or cursor):
+        if timed_out:
+            hits.append({
+                "file": "[timeout]",
+                "line": 0,
+                "match": f"... search stopped after {timeout:g}s in {timed_out[0]} ...",
+                "context": f"Partial results: {len(hits)} hits found before the deadline. Narrow file_glob or simplify the regex.",
+            })
+        return hits
+    next_cursor = None
+    if end_file is not None:
+        next_cursor = _encode_cursor("search_code", page_params, {"file": end_file, "skip": end_count}, generation)
+    return {"hits": hits, "next_cursor": next_cursor, "index_changed": bool(cursor) and state.get("g") != generation,
+            "timed_out": bool(timed_out)}
+
+@server.tool()
+@_profiled
+async def find_symbol(name: str, kind: Optional[str] = None, match: str = "exact", max_results: int = 50) -> List[Dict[str, Any]]:
+    """Find definitions, classes, methods and imports by name from the symbol index.
+    
+    Args:
+        name: Symbol name
+        kind: Optional filter: class | function | method | variable | import | interface | type | enum
+        match: "exact" (default) | "prefix" | "substring" (prefix/substring are case-insensitive)
+        max_results: Maximum hits to return
+    """
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    if match not in ("exact", "prefix", "substring"):
+        raise ValueError(f"Invalid match mode: {match}")
+    timer = StageTimer("find_symbol")
+    with timer.stage("index_refresh"):
+        _symbol_index.refresh()
+    with timer.stage("lookup"):
+        hits = _symbol_index.find(name, kind=kind, match=match, max_results=max_results)
+    write_audit(AuditEntry(time.time(), "find_symbol", {"name": name, "kind": kind, "match": match}, True, {"count": len(hits)}))
+    timer.finish()
+    return hits
+
+@server.tool()
+@_profiled
+async def outline(path: str) -> List[Dict[str, Any]]:
+    """Return the symbol outline (classes, functions, methods, imports) of a Python or TS/JS file."""
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    abs_path = safe_join(path)
+    if not abs_path.is_file():
+        raise FileNotFoundError(f"Not a file: {path}")
+    rel = abs_path.relative_to(WORKSPACE_DIR).as_posix()
+    if _denylisted(rel):
+        raise PermissionError("Path is denylisted")
+    if abs_path.suffix.lower() not in _SYMBOL_LANGS:
+        raise ValueError(f"Unsupported file type for outline: {abs_path.suffix or rel}")
+    syms = _symbol_index.update_file(rel) or []
+    write_audit(AuditEntry(time.time(), "outline", {"path": path}, True, {"count": len(syms)}))
+    return sorted(syms, key=lambda sym: sym["line"])
+
+@server.tool()
+@_profiled
+async def find_file(query: str, max_results: int = 20, base: str = ".") -> List[Dict[str, Any]]:
+    """Fuzzy-find files by path (fzf-style subsequence scoring).
     
-    write_audit(AuditEntry(time.time(), "search_code", {"query": query}, True, {"count": len(hits), "context_pct": _context_tracker.get_usage_pct()}))
+    Space-separated terms must all match; an uppercase letter makes the query
+    case-sensitive. File-name matches, word boundaries, consecutive runs and
+    recently modified files rank higher.
+    """
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    base_rel = safe_join(base).relative_to(WORKSPACE_DIR).as_posix()
+    timer = StageTimer("find_file")
+    with timer.stage("search"):
+        hits = _file_finder.search(query, max_results, base_rel)
+    write_audit(AuditEntry(time.time(), "find_file", {"query": query, "base": base}, True, {"count": len(hits)}))
+    timer.finish()
     return hits
 
+@server.tool()
+@_profiled
+async def workspace_delta(since: Optional[str] = None, max_paths: int = 1000) -> Dict[str, Any]:
+    """Paths added, modified and removed since a previous manifest root hash.
+    
+    Args:
+        since: `root` returned by an earlier call; omit (or pass an expired root) for a full listing
+        max_paths: Maximum paths returned across added/modified/removed
+    """
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    timer = StageTimer("workspace_delta")
+    with timer.stage("manifest_refresh"):
+        root = _workspace_manifest.refresh()
+    full = not since or since not in _workspace_manifest.roots
+    added: List[Dict[str, str]] = []
+    modified: List[Dict[str, str]] = []
+    removed: List[str] = []
+    counts = {"added": 0, "modified": 0, "removed": 0}
+    with timer.stage("diff"):
+        changes = _workspace_manifest.diff("" if full else since, root) if root else iter(())
+        for status, path, sha in changes:
+            key = {"A": "added", "M": "modified", "D": "removed"}[status]
+            counts[key] += 1
+            if sum(counts.values()) > max_paths:
+                continue
+            if status == "D":
+                removed.append(path)
+            else:
+                (added if status == "A" else modified).append({"path": path, "sha": sha})
+    result = {
+        "root": root,
+        "since": since,
+        "full": full,
+        "added": sorted(added, key=lambda e: e["path"]),
+        "modified": sorted(modified, key=lambda e: e["path"]),
+        "removed": sorted(removed),
+        "counts": counts,
+        "truncated": sum(counts.values()) > max_paths,
+    }
+    write_audit(AuditEntry(time.time(), "workspace_delta", {"since": since}, True, {"full": full, **counts}))
+    timer.finish()
+    return result
+
+@server.tool()
+@_profiled
+async def workspace_tree_snapshot(since: Optional[str] = None) -> Dict[str, Any]:
+    """The workspace_tree listing as a versioned snapshot, or only what changed since an earlier version.
+    
+    Args:
+        since: `version` from an earlier call; returns added/removed paths instead of the full
+            listing (unknown or expired versions get the full listing)
+    """
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    timer = StageTimer("workspace_tree_snapshot")
+    with timer.stage("snapshot"):
+        version, paths, _ = _tree_snapshots.current()
+    with timer.stage("diff"):
+        changes = _tree_snapshots.diff(since) if since else None
+    result: Dict[str, Any] = {"version": version, "since": since, "full": changes is None,
+                              "truncated": len(paths) >= TreeSnapshots.MAX_FILES}
+    if changes is None:
+        result["files"] = list(paths)
+    else:
+        result.update(changes)
+    write_audit(AuditEntry(time.time(), "workspace_tree_snapshot", {"since": since}, True,
+                           {"full": changes is None, "files": len(paths)}))
+    timer.finish()
+    return result
+
+@server.tool()
+@_profiled
+async def git_status(max_paths: int = 500) -> Dict[str, Any]:
+    """Structured `git status` computed in-process from .git/index, HEAD and worktree stat data.
+    
+    Args:
+        max_paths: Maximum paths reported per category (staged/unstaged/untracked)
+    """
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    timer = StageTimer("git_status")
+    with timer.stage("index_refresh"):
+        store = _git_store()
+    branch, head = store.head()
+    with timer.stage("staged"):
+        staged = _git_staged_changes(store)
+    with timer.stage("worktree"):
+        changes = _workspace_index.git_changes()
+    unstaged = [{"path": p, "status": "M"} for p in changes["modified"]] + [{"path": p, "status": "D"} for p in changes["deleted"]]
+    unstaged.sort(key=lambda c: c["path"])
+    result = {
+        "branch": branch,
+        "head": head,
+        "staged": staged[:max_paths],
+        "unstaged": unstaged[:max_paths],
+        "untracked": changes["untracked"][:max_paths],
+        "counts": {"staged": len(staged), "unstaged": len(unstaged), "untracked": len(changes["untracked"])},
+        "truncated": max(len(staged), len(unstaged), len(changes["untracked"])) > max_paths,
+    }
+    write_audit(AuditEntry(time.time(), "git_status", {}, True, result["counts"]))
+    timer.finish()
+    return result
+
+@server.tool()
+@_profiled
+async def git_diff(paths: Optional[List[str]] = None, staged: bool = False, context_lines: int = 3,
+                   max_files: int = 50, max_lines_per_file: int = 400) -> Dict[str, Any]:
+    """Structured `git diff` (worktree vs index, or index vs HEAD with staged=True), computed in-process.
+    
+    Args:
+        paths: Optional list of paths or directory prefixes to restrict the diff
+        staged: Diff the index against HEAD (like `git diff --staged`)
+        context_lines: Unchanged lines around each change
+        max_files: Maximum files included
+        max_lines_per_file: Maximum hunk lines per file; longer diffs are marked truncated
+    """
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    timer = StageTimer("git_diff")
+    with timer.stage("index_refresh"):
+        store = _git_store()
+    prefixes = [p.relative_to(WORKSPACE_DIR).as_posix() for p in safe_join_many(paths or [])]
+    
+    def wanted(rel: str) -> bool:
+        return not prefixes or any(rel == p or rel.startswith(p.rstrip("/") + "/") or p == "." for p in prefixes)
+    
+    entries = _workspace_index.git_entries
+    with timer.stage("changes"):
+        if staged:
+            changed = [(c["path"], c["status"]) for c in _git_staged_changes(store)]
+        else:
+            ch = _workspace_index.git_changes()
+            changed = sorted([(p, "M") for p in ch["modified"]] + [(p, "D") for p in ch["deleted"]])
+    changed = [(p, st) for p, st in changed if wanted(p) and not _denylisted(p)]
+    head_tree: Dict[str, tuple[int, str]] = {}
+    if staged:
+        _, head = store.head()
+        head_tree = store.flatten_tree(store.commit_tree(head)) if head else {}
+    files: List[Dict[str, Any]] = []
+    timer.mark()
+    for rel, status in changed[:max_files]:
+        try:
+            if staged:
+                old = store.read(head_tree[rel][1])[1] if rel in head_tree else b""
+                new = store.read(entries[rel].sha1)[1] if rel in entries else b""
+            else:
+                old = store.read(entries[rel].sha1)[1]
+                new = (WORKSPACE_DIR / rel).read_bytes() if status != "D" else b""
+        except Exception as e:
+            files.append({"path": rel, "status": status, "error": str(e)})
+            continue
+        if max(len(old), len(new)) > MAX_FILE_BYTES:
+            files.append({"path": rel, "status": status, "too_large": True})
+            continue
+        files.append({"path": rel, "status": status, **_diff_hunks(old, new, context_lines, max_lines_per_file)})
+    timer.lap("diff")
+    result = {"staged": staged, "files": files, "total_files": len(changed), "truncated": len(changed) > max_files}
+    write_audit(AuditEntry(time.time(), "git_diff", {"paths": paths, "staged": staged}, True, {"files": len(files)}))
+    timer.finish()
+    return result
+
 # -----------------------------
 # Resources
 # -----------------------------
 @server.resource()
+@_profiled
 async def workspace_tree() -> ResourceContents:
-    items = await list_files(".", "**/*", 2000)
-    text = "\n".join(items)
+    from mcp.types import ResourceContents
+    if not rate_read.allow():
+        raise RuntimeError("Rate limit exceeded for reads")
+    version, text = workspace_tree_listing()
     text = _auto_summarize_if_needed(text, context_name="workspace_tree")
-    return ResourceContents(text=text)
+    # The snapshot version rides in _meta so clients can later ask workspace_tree_snapshot(since=...)
+    return ResourceContents(text=text, _meta={"version": version})
 
 @server.resource()
+@_profiled
 async def workspace_summary() -> ResourceContents:
+    from mcp.types import ResourceContents
     parts = [f"Workspace: {WORKSPACE_DIR}"]
     readme_p = safe_join("README.md")
     if readme_p.exists():
@@ -804,12 +5821,24 @@ async def workspace_summary() -> ResourceContents:
             parts.append("package.json present")
     except Exception:
         pass
+    summary = _workspace_stats.summary()
+    langs = ", ".join(f"{row['language']} ({row['files']})" for row in summary["languages"][:5])
+    parts.append(f"Files: {summary['files']}; languages: {langs} (sizes and line counts: workspace_stats)")
     text = "\n\n".join(parts)
     text = _auto_summarize_if_needed(text, context_name="workspace_summary")
     return ResourceContents(text=text)
 
 @server.resource()
+@_profiled
+async def workspace_stats() -> ResourceContents:
+    """File, byte and line counts per language and directory, plus largest and recent files."""
+    from mcp.types import ResourceContents
+    return ResourceContents(text=json.dumps(workspace_stats_snapshot(), indent=2))
+
+@server.resource()
+@_profiled
 async def readme() -> ResourceContents:
+    from mcp.types import ResourceContents
     p = safe_join("README.md")
     if p.exists():
         text = _read_text_guarded(p)
@@ -838,14 +5867,102 @@ async def refactor_suggestion() -> str:
         "You propose safe refactors with tests. Prefer small, mechanical changes and explain trade-offs."
     )
 
+# -----------------------------
+# Startup profiling
+# -----------------------------
+STARTUP_BUDGET_MS = float(os.environ.get("MCP_STARTUP_BUDGET_MS", 1500))
+
+# Runs in a fresh interpreter: import the module, then await its `_startup_probe()` (first request) if it has one
+_STARTUP_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+m = __import__(sys.argv[1], fromlist=["_"])  # import statement path, so -X importtime reports it
+t1 = time.perf_counter()
+import asyncio
+probe = getattr(m, "_startup_probe", None)
+if probe is not None:
+    asyncio.run(probe())
+t2 = time.perf_counter()
+print(json.dumps({"import_ms": (t1 - t0) * 1000, "first_call_ms": (t2 - t1) * 1000 if probe else None}))
+"""
+
+def startup_report(module: str = "cursor_mcp_server", top: int = 15, timeout: float = 120.0) -> Dict[str, Any]:
+    """Cold-start `module` in a subprocess under `-X importtime`: import and first-request time plus the slowest imports."""
+    env = {**os.environ, "WORKSPACE_DIR": str(WORKSPACE_DIR)}
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", _STARTUP_SCRIPT, module],
+                          capture_output=True, text=True, timeout=timeout, env=env,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    imports, errors = [], []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            errors.append(line)
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # header row
+        imports.append({"module": parts[2].strip(), "self_ms": int(parts[0]) / 1000, "cumulative_ms": int(parts[1]) / 1000,
+                        "top_level": len(parts[2]) - len(parts[2].lstrip()) <= 1})
+    if proc.returncode != 0:
+        raise RuntimeError(f"startup of {module} failed: " + "\n".join(errors[-20:]))
+    timings = json.loads(proc.stdout.strip().splitlines()[-1])
+    total = timings["import_ms"] + (timings["first_call_ms"] or 0)
+    return {
+        "module": module,
+        "import_ms": round(timings["import_ms"], 1),
+        "first_call_ms": round(timings["first_call_ms"], 1) if timings["first_call_ms"] is not None else None,
+        "total_ms": round(total, 1),
+        "budget_ms": STARTUP_BUDGET_MS,
+        "within_budget": total <= STARTUP_BUDGET_MS,
+        "slowest_imports": [{k: v for k, v in r.items() if k != "top_level"}
+                            for r in heapq.nlargest(top, imports, key=lambda r: r["self_ms"])],
+        "top_level_imports": [{"module": r["module"], "cumulative_ms": r["cumulative_ms"]}
+                              for r in heapq.nlargest(top, (r for r in imports if r["top_level"]), key=lambda r: r["cumulative_ms"])],
+    }
+
+async def asgi_get(app: Any, path: str, query: str = "") -> tuple[int, bytes]:
+    """Issue one GET against an ASGI app in-process (no HTTP client needed); returns (status, body)."""
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+             "headers": [(b"host", b"localhost")], "client": ("127.0.0.1", 0), "server": ("localhost", 80)}
+    status, body = 0, []
+    
+    async def receive() -> Dict[str, Any]:
+        return {"type": "http.request", "body": b"", "more_body": False}
+    
+    async def send(message: Dict[str, Any]) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+    
+    await app(scope, receive, send)
+    return status, b"".join(body)
+
+async def _startup_probe() -> None:
+    """First request for startup_report: build the SDK server (stdio needs it) and list the workspace."""
+    server.sdk
+    await list_files(".", max_results=1)
+
 # -----------------------------
 # Entry
 # -----------------------------
 async def amain() -> None:
     WORKSPACE_DIR.mkdir(parents=True, exist_ok=True)
-    await stdio_server.run(server)
+    _fs_watcher.start()
+    _audit_rotator.request()  # compress leftover segments and apply retention
+    try:
+        from mcp.transport import stdio_server
+        await stdio_server.run(server.sdk)
+    finally:
+        _fs_watcher.stop()
 
 def main() -> None:
+    if "--startup-report" in sys.argv[1:]:
+        print(json.dumps(startup_report(), indent=2))
+        return
+    _configure_logging()
     try:
         asyncio.run(amain())
     except KeyboardInterrupt:
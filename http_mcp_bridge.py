@@ -16,13 +16,13 @@ import json
 import logging
 import os
 import sys
+import time
 from pathlib import Path
 from typing import Any, Dict, Optional, List
 
-from fastapi import FastAPI, HTTPException, Request, Query, Body
+from fastapi import FastAPI, HTTPException, Request, Query, Body, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-import uvicorn
 
 # Import the MCP server and its tools/resources
 from cursor_mcp_server import (
@@ -31,6 +31,7 @@ from cursor_mcp_server import (
     AUDIT_LOG_PATH,
     write_audit,
     AuditEntry,
+    audit_client,
     rate_read,
     rate_write,
     rate_cmd,
@@ -45,6 +46,22 @@ from cursor_mcp_server import (
     get_diagnostics,
     search_code,
     reset_context,
+    find_symbol,
+    outline,
+    find_file,
+    workspace_delta,
+    workspace_tree_snapshot,
+    run_impacted_tests,
+    audit_query,
+    git_status,
+    git_diff,
+    collect_stage_timings,
+    workspace_stats_snapshot,
+    workspace_tree_listing,
+    asgi_get,
+    startup_report,
+    AdmissionRejected,
+    _admission,
 )
 
 # -----------------------------
@@ -96,6 +113,42 @@ def get_client_origin(request: Request) -> str:
     origin = request.headers.get("origin") or request.headers.get("referer", "")
     return origin
 
+def get_client_id(request: Request) -> str:
+    """Client identity recorded on audit entries: the origin, else the peer address."""
+    origin = get_client_origin(request)
+    if origin:
+        return origin
+    return f"ip:{request.client.host}" if request.client else "unknown"
+
+def get_peer_id(request: Request) -> str:
+    """Admission key: the connecting peer address (Origin/Referer are client-supplied)."""
+    return f"ip:{request.client.host}" if request.client else "unknown"
+
+async def require_token(
+    request: Request,
+    token: str = Query(..., description="Authentication token"),
+):
+    """Reject bad tokens before the request can take an admission slot."""
+    if not verify_token(token):
+        tool_name = request.path_params.get("tool_name")
+        write_audit(AuditEntry(
+            ts=time.time(),
+            tool="http_mcp",
+            args={"tool": tool_name} if tool_name else {"path": request.url.path},
+            ok=False,
+            meta={"error": "Invalid token", "origin": get_client_origin(request)},
+            client=get_client_id(request),
+        ))
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+async def admit_request(request: Request):
+    """Hold an admission slot per peer address (after require_token); 429 with Retry-After when saturated."""
+    try:
+        async with _admission.admit(get_peer_id(request)):
+            yield
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
 # -----------------------------
 # MCP Protocol Handler
 # -----------------------------
@@ -129,6 +182,15 @@ class MCPHTTPHandler:
                         {"name": "get_diagnostics", "description": "Return health & security posture and a perf probe."},
                         {"name": "search_code", "description": "Regex search across text files with context."},
                         {"name": "reset_context", "description": "Reset soft state like rate windows (keeps audit log)."},
+                        {"name": "find_symbol", "description": "Find definitions, classes, methods and imports by name from the symbol index."},
+                        {"name": "outline", "description": "Return the symbol outline of a Python or TS/JS file."},
+                        {"name": "find_file", "description": "Fuzzy-find files by path, ranked fzf-style."},
+                        {"name": "workspace_delta", "description": "Paths changed since a previous manifest root hash."},
+                        {"name": "run_impacted_tests", "description": "Run only the pytest modules affected by changes since the last green run."},
+                        {"name": "workspace_tree_snapshot", "description": "Versioned workspace_tree listing, or the paths added/removed since an earlier version."},
+                        {"name": "audit_query", "description": "Query the audit log by tool, time range, success and client."},
+                        {"name": "git_status", "description": "Structured git status (staged, unstaged, untracked) read in-process."},
+                        {"name": "git_diff", "description": "Structured git diff hunks, worktree vs index or index vs HEAD."},
                     ]
                 return {"tools": tools}
             
@@ -145,6 +207,15 @@ class MCPHTTPHandler:
                     "get_diagnostics": get_diagnostics,
                     "search_code": search_code,
                     "reset_context": reset_context,
+                    "find_symbol": find_symbol,
+                    "outline": outline,
+                    "find_file": find_file,
+                    "workspace_delta": workspace_delta,
+                    "run_impacted_tests": run_impacted_tests,
+                    "audit_query": audit_query,
+                    "workspace_tree_snapshot": workspace_tree_snapshot,
+                    "git_status": git_status,
+                    "git_diff": git_diff,
                 }
                 
                 if tool_name not in tool_handlers:
@@ -166,6 +237,7 @@ class MCPHTTPHandler:
                 resources = [
                     {"uri": "mcp://workspace_tree", "name": "workspace_tree", "description": "Full file tree"},
                     {"uri": "mcp://workspace_summary", "name": "workspace_summary", "description": "Workspace overview"},
+                    {"uri": "mcp://workspace_stats", "name": "workspace_stats", "description": "Per-language and per-directory file statistics"},
                     {"uri": "mcp://readme", "name": "readme", "description": "README.md content"},
                 ]
                 return {"resources": resources}
@@ -178,23 +250,30 @@ class MCPHTTPHandler:
                 resource_handlers = {
                     "workspace_tree": self._get_workspace_tree,
                     "workspace_summary": self._get_workspace_summary,
+                    "workspace_stats": self._get_workspace_stats,
                     "readme": self._get_readme,
                 }
                 
                 if resource_name not in resource_handlers:
                     raise HTTPException(status_code=404, detail=f"Resource not found: {resource_name}")
                 
-                resource_handler = resource_handlers[resource_name]
-                result = await resource_handler()
+                content_meta = None
+                if resource_name == "workspace_tree" and params.get("since"):
+                    # Only the paths added/removed since the client's snapshot version
+                    result = await workspace_tree_snapshot(since=params["since"])
+                elif resource_name == "workspace_tree":
+                    version, result = await self._get_workspace_tree()
+                    content_meta = {"version": version}
+                else:
+                    result = await resource_handlers[resource_name]()
                 
-                return {
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": result if isinstance(result, str) else json.dumps(result)
-                        }
-                    ]
+                content = {
+                    "type": "text",
+                    "text": result if isinstance(result, str) else json.dumps(result)
                 }
+                if content_meta:
+                    content["_meta"] = content_meta
+                return {"contents": [content]}
             
             elif method == "prompts/list":
                 prompts = [
@@ -211,10 +290,11 @@ class MCPHTTPHandler:
             LOG.error(f"Error handling MCP request: {e}", exc_info=True)
             raise HTTPException(status_code=500, detail=str(e))
     
-    async def _get_workspace_tree(self) -> str:
-        """Get workspace tree."""
-        files = await list_files(".", "**/*", 2000)
-        return "\n".join(files)
+    async def _get_workspace_tree(self) -> tuple[str, str]:
+        """Get workspace tree (pre-rendered per index generation) and its snapshot version."""
+        if not rate_read.allow():
+            raise RuntimeError("Rate limit exceeded for reads")
+        return workspace_tree_listing()
     
     async def _get_workspace_summary(self) -> str:
         """Get workspace summary."""
@@ -228,6 +308,10 @@ class MCPHTTPHandler:
                 pass
         return "\n\n".join(parts)
     
+    async def _get_workspace_stats(self) -> str:
+        """Get incremental workspace statistics."""
+        return json.dumps(workspace_stats_snapshot(), indent=2)
+    
     async def _get_readme(self) -> str:
         """Get README content."""
         readme_p = WORKSPACE_DIR / "README.md"
@@ -290,49 +374,71 @@ async def mcp_manifest(
         "prompts": prompts_result.get("prompts", []),
     })
 
-@app.post("/mcp/tool/{tool_name}")
+@app.post("/mcp/tool/{tool_name}", dependencies=[Depends(require_token), Depends(admit_request)])
 async def mcp_tool(
     request: Request,
     tool_name: str,
-    token: str = Query(..., description="Authentication token"),
     body: Dict[str, Any] = Body(default={}),
 ):
     """Invoke an MCP tool."""
-    if not verify_token(token):
-        write_audit(AuditEntry(
-            ts=asyncio.get_event_loop().time(),
-            tool="http_mcp",
-            args={"tool": tool_name},
-            ok=False,
-            meta={"error": "Invalid token", "origin": get_client_origin(request)}
-        ))
-        raise HTTPException(status_code=401, detail="Invalid token")
+    client = get_client_id(request)
     
     # Get params from body
     params = body.get("params", {})
     arguments = params if params else body.get("arguments", {})
+    want_timings = bool(body.get("timings", False))
     
-    # Log request
-    write_audit(AuditEntry(
-        ts=asyncio.get_event_loop().time(),
-        tool="http_mcp",
-        args={"tool": tool_name, "arguments": arguments},
-        ok=True,
-        meta={"origin": get_client_origin(request)}
-    ))
-    
-    # Handle tool call
-    result = await _mcp_handler.handle_request("tools/call", {
-        "name": tool_name,
-        "arguments": arguments,
-    })
+    with audit_client(client):
+        # Log request
+        write_audit(AuditEntry(
+            ts=time.time(),
+            tool="http_mcp",
+            args={"tool": tool_name, "arguments": arguments},
+            ok=True,
+            meta={"origin": get_client_origin(request)}
+        ))
+        
+        # Handle tool call
+        with collect_stage_timings() as stages:
+            result = await _mcp_handler.handle_request("tools/call", {
+                "name": tool_name,
+                "arguments": arguments,
+            })
+    if want_timings:
+        result["stages"] = stages
+    return JSONResponse(content=result)
+
+@app.get("/mcp/audit", dependencies=[Depends(require_token), Depends(admit_request)])
+async def mcp_audit(
+    request: Request,
+    tool: Optional[str] = Query(None, description="Only entries for this tool"),
+    since: Optional[float] = Query(None, description="Earliest timestamp (epoch seconds)"),
+    until: Optional[float] = Query(None, description="Latest timestamp (epoch seconds)"),
+    ok: Optional[bool] = Query(None, description="Only successful/failed entries"),
+    client: Optional[str] = Query(None, description="Only entries from this client"),
+    limit: int = Query(100, ge=1, le=10000),
+):
+    """Query the audit log (newest first) through its sidecar index."""
+    with audit_client(get_client_id(request)):
+        result = await audit_query(tool=tool, since=since, until=until, ok=ok, client=client, limit=limit)
     return JSONResponse(content=result)
 
 # -----------------------------
 # Entry Point
 # -----------------------------
+async def _startup_probe() -> None:
+    """First request for startup_report: the authenticated /mcp manifest."""
+    status, body = await asgi_get(app, "/mcp", f"token={MCP_HTTP_TOKEN}")
+    if status != 200:
+        raise RuntimeError(f"/mcp returned {status}: {body[:200]!r}")
+
 def main():
     """Run the HTTP bridge server."""
+    if "--startup-report" in sys.argv[1:]:
+        print(json.dumps(startup_report("http_mcp_bridge"), indent=2))
+        return
+    import uvicorn  # only the server process needs it, not importers or ASGI hosts
+    
     host = os.environ.get("MCP_HTTP_HOST", "127.0.0.1")
     port = int(os.environ.get("MCP_HTTP_PORT", "8001"))
     
@@ -16,14 +16,15 @@ ENV (set in your hosting platform):
 """
 from __future__ import annotations
 
+import json
 import os
+import sys
 import time
 from typing import Any, Dict, Optional
 
-import httpx
+# httpx and jose are imported on first authenticated request to keep cold starts short
 from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.responses import PlainTextResponse
-from jose import jwt
 from pydantic import BaseModel, Field
 
 import cursor_mcp_server as srv
@@ -50,6 +51,7 @@ async def _get_jwks() -> Dict[str, Any]:
     now = time.time()
     if _JWKS and (now - _JWKS_TS) < 3600:
         return _JWKS
+    import httpx
     async with httpx.AsyncClient(timeout=10) as client:
         r = await client.get(AUTH_JWKS_URL)
         r.raise_for_status()
@@ -72,6 +74,7 @@ async def require_oauth(req: Request):
     token = auth.split(" ", 1)[1].strip()
 
     jwks = await _get_jwks()
+    from jose import jwt
     try:
         claims = jwt.decode(
             token,
@@ -85,32 +88,56 @@ async def require_oauth(req: Request):
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Invalid token: {e}")
 
+def _client_id(req: Request) -> Optional[str]:
+    """Audit identity of the caller: the token's client id or subject."""
+    claims = getattr(req.state, "claims", None) or {}
+    return claims.get("azp") or claims.get("client_id") or claims.get("sub")
+
+async def admit_request(req: Request):
+    """Admission slot per token client/subject (after require_oauth); 429 with Retry-After when saturated."""
+    try:
+        async with srv._admission.admit(_client_id(req)):
+            yield
+    except srv.AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
 class ToolCall(BaseModel):
     params: Dict[str, Any] = Field(default_factory=dict)
+    timings: bool = False  # include per-stage timings in the result
 
 class ToolResult(BaseModel):
     ok: bool
     result: Optional[Any] = None
     error: Optional[str] = None
     elapsed_ms: Optional[int] = None
+    stages: Optional[Dict[str, Dict[str, float]]] = None
 
 TOOLS = {
     "read_file": {"description": "Read a UTF-8 file", "params": {"path": "str", "allow_denied_explicit": "bool?"}},
-    "list_files": {"description": "List files with glob", "params": {"base": "str?", "pattern": "str?", "max_results": "int?", "include_denied": "bool?"}},
-    "write_file": {"description": "Write a file (preview by default)", "params": {"path": "str", "content": "str", "mode": "str?", "require_confirmation": "bool?", "create_dirs": "bool?"}},
-    "run_command": {"description": "Run whitelisted command", "params": {"command": "str", "timeout_seconds": "int?"}},
-    "get_diagnostics": {"description": "Health & limits", "params": {}},
-    "search_code": {"description": "Regex search", "params": {"query": "str", "file_glob": "str?", "max_results": "int?", "context_lines": "int?"}},
+    "list_files": {"description": "List files with glob", "params": {"base": "str?", "pattern": "str?", "max_results": "int?", "include_denied": "bool?", "changed_only": "bool?", "respect_gitignore": "bool?", "cursor": "str?", "paginate": "bool?"}},
+    "write_file": {"description": "Write a file (preview by default); mode=patch applies a unified diff or line edits atomically", "params": {"path": "str", "content": "str?", "mode": "str?", "require_confirmation": "bool?", "create_dirs": "bool?", "edits": "list?"}},
+    "run_command": {"description": "Run whitelisted command (pytest can be sharded)", "params": {"command": "str", "timeout_seconds": "int?", "shards": "int?"}},
+    "get_diagnostics": {"description": "Health & limits; can arm on-demand profiling", "params": {"profile_tool": "str?", "profile_calls": "int?", "profile_seconds": "float?", "profile_top": "int?", "profile_stop": "bool?"}},
+    "search_code": {"description": "Regex search; patterns=[{name, regex|literal, ignore_case?}] runs several in one pass", "params": {"query": "str?", "file_glob": "str?", "max_results": "int?", "context_lines": "int?", "respect_gitignore": "bool?", "patterns": "list[dict]?", "cursor": "str?", "paginate": "bool?", "timeout_s": "float?"}},
     "reset_context": {"description": "Reset rate windows", "params": {}},
+    "find_symbol": {"description": "Find definitions by name from the symbol index", "params": {"name": "str", "kind": "str?", "match": "str?", "max_results": "int?"}},
+    "outline": {"description": "Symbol outline of a Python/TS/JS file", "params": {"path": "str"}},
+    "find_file": {"description": "Fuzzy-find files by path", "params": {"query": "str", "max_results": "int?", "base": "str?"}},
+    "workspace_delta": {"description": "Paths changed since a manifest root hash", "params": {"since": "str?", "max_paths": "int?"}},
+    "run_impacted_tests": {"description": "Run pytest modules affected by changes since the last green run", "params": {"changed": "list?", "run_all": "bool?", "dry_run": "bool?", "timeout_seconds": "int?", "shards": "int?"}},
+    "workspace_tree_snapshot": {"description": "Versioned workspace_tree listing or its diff since a version", "params": {"since": "str?"}},
+    "audit_query": {"description": "Query the audit log", "params": {"tool": "str?", "since": "float?", "until": "float?", "ok": "bool?", "client": "str?", "limit": "int?"}},
+    "git_status": {"description": "Structured git status read in-process", "params": {"max_paths": "int?"}},
+    "git_diff": {"description": "Structured git diff hunks", "params": {"paths": "list[str]?", "staged": "bool?", "context_lines": "int?", "max_files": "int?", "max_lines_per_file": "int?"}},
 }
-RESOURCES = {"workspace_tree": "File list", "workspace_summary": "Summary", "readme": "README"}
+RESOURCES = {"workspace_tree": "File list", "workspace_summary": "Summary", "workspace_stats": "Language/directory stats", "readme": "README"}
 PROMPTS = ["code_review", "debug_assistant", "refactor_suggestion"]
 
 @app.get("/mcp", dependencies=[Depends(require_oauth)])
 async def manifest():
     return {"name": "cursor-mcp-oauth", "version": "1.0", "tools": TOOLS, "resources": RESOURCES, "prompts": PROMPTS, "workspace": str(srv.WORKSPACE_DIR)}
 
-@app.get("/mcp/health", dependencies=[Depends(require_oauth)])
+@app.get("/mcp/health", dependencies=[Depends(require_oauth), Depends(admit_request)])
 async def health():
     di = await srv.get_diagnostics()
     return {"ok": True, "diagnostics": di}
@@ -123,29 +150,45 @@ _TOOL_MAP = {
     "get_diagnostics": srv.get_diagnostics,
     "search_code": srv.search_code,
     "reset_context": srv.reset_context,
+    "find_symbol": srv.find_symbol,
+    "outline": srv.outline,
+    "find_file": srv.find_file,
+    "workspace_delta": srv.workspace_delta,
+    "run_impacted_tests": srv.run_impacted_tests,
+    "workspace_tree_snapshot": srv.workspace_tree_snapshot,
+    "audit_query": srv.audit_query,
+    "git_status": srv.git_status,
+    "git_diff": srv.git_diff,
 }
 
 _METRICS = {"tool_calls_total": 0, "tool_ok_total": 0, "tool_error_total": 0, "tool_duration_ms_sum": 0}
 
-@app.post("/mcp/tool/{name}", response_model=ToolResult, dependencies=[Depends(require_oauth)])
+@app.post("/mcp/tool/{name}", response_model=ToolResult, dependencies=[Depends(require_oauth), Depends(admit_request)])
 async def call_tool(name: str, body: ToolCall, req: Request):
     fn = _TOOL_MAP.get(name)
     if not fn:
         raise HTTPException(status_code=404, detail=f"Unknown tool: {name}")
     t0 = time.perf_counter()
-    try:
-        res = await fn(**body.params)
-        dt = int((time.perf_counter() - t0) * 1000)
-        _METRICS["tool_calls_total"] += 1
-        _METRICS["tool_ok_total"] += 1
-        _METRICS["tool_duration_ms_sum"] += dt
-        return ToolResult(ok=True, result=res, elapsed_ms=dt)
-    except Exception as e:
-        dt = int((time.perf_counter() - t0) * 1000)
-        _METRICS["tool_calls_total"] += 1
-        _METRICS["tool_error_total"] += 1
-        _METRICS["tool_duration_ms_sum"] += dt
-        return ToolResult(ok=False, error=str(e), elapsed_ms=dt)
+    with srv.collect_stage_timings() as stages, srv.audit_client(_client_id(req)):
+        try:
+            res = await fn(**body.params)
+            dt = int((time.perf_counter() - t0) * 1000)
+            _METRICS["tool_calls_total"] += 1
+            _METRICS["tool_ok_total"] += 1
+            _METRICS["tool_duration_ms_sum"] += dt
+            return ToolResult(ok=True, result=res, elapsed_ms=dt, stages=stages if body.timings else None)
+        except Exception as e:
+            dt = int((time.perf_counter() - t0) * 1000)
+            _METRICS["tool_calls_total"] += 1
+            _METRICS["tool_error_total"] += 1
+            _METRICS["tool_duration_ms_sum"] += dt
+            return ToolResult(ok=False, error=str(e), elapsed_ms=dt, stages=stages if body.timings else None)
+
+@app.get("/mcp/audit", dependencies=[Depends(require_oauth), Depends(admit_request)])
+async def audit(req: Request, tool: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+                ok: Optional[bool] = None, client: Optional[str] = None, limit: int = 100):
+    with srv.audit_client(_client_id(req)):
+        return await srv.audit_query(tool=tool, since=since, until=until, ok=ok, client=client, limit=min(max(limit, 1), 10000))
 
 @app.get("/metrics")
 async def metrics():
@@ -155,5 +198,16 @@ async def metrics():
         f'cursor_tool_error_total {_METRICS["tool_error_total"]}\n'
         f'cursor_tool_duration_ms_sum {_METRICS["tool_duration_ms_sum"]}\n'
     )
+    text += "\n".join(srv._stage_metrics.prometheus_lines()) + "\n"
     return PlainTextResponse(text, media_type="text/plain")
 
+async def _startup_probe() -> None:
+    """First request for srv.startup_report (/mcp needs a real bearer token, so probe /metrics)."""
+    status, body = await srv.asgi_get(app, "/metrics")
+    if status != 200:
+        raise RuntimeError(f"/metrics returned {status}: {body[:200]!r}")
+
+if __name__ == "__main__":
+    # Serve with an ASGI host (see module docstring); this entry point only reports startup cost
+    if "--startup-report" in sys.argv[1:]:
+        print(json.dumps(srv.startup_report("http_mcp_oauth_bridge"), indent=2))
@@ -0,0 +1,93 @@
+import importlib
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+
+import cursor_mcp_server as srv
+
+@pytest.fixture(autouse=True)
+def _tmp_workspace(tmp_path, monkeypatch):
+    ws = tmp_path / "ws"
+    ws.mkdir()
+    monkeypatch.setattr(srv, "WORKSPACE_DIR", ws.resolve())
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", tmp_path / "audit.log")
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    srv.rate_read.events.clear()
+    return ws
+
+def _saturated() -> srv.AdmissionController:
+    """One slot, no queue, and the slot already held by another client."""
+    ctrl = srv.AdmissionController(max_concurrent=1, per_client=1, queue_per_client=0, queue_total=0)
+    ctrl._grant("ip:elsewhere")
+    return ctrl
+
+@pytest.fixture
+def token_bridge(monkeypatch):
+    bridge = importlib.import_module("http_mcp_bridge")
+    monkeypatch.setattr(bridge, "MCP_HTTP_TOKEN", "secret")
+    return bridge
+
+@pytest.fixture
+def oauth_bridge(monkeypatch):
+    monkeypatch.setenv("AUTH_ISSUER", "https://issuer.example/")
+    monkeypatch.setenv("AUTH_AUDIENCE", "cursor-mcp")
+    bridge = importlib.import_module("http_mcp_oauth_bridge")
+    monkeypatch.setattr(bridge, "REQUIRE_ORIGIN", False)
+    return bridge
+
+def test_token_bridge_rejects_bad_token_before_admission(token_bridge, monkeypatch):
+    ctrl = _saturated()
+    monkeypatch.setattr(token_bridge, "_admission", ctrl)
+    client = TestClient(token_bridge.app)
+    assert client.get("/mcp/audit", params={"token": "wrong"}).status_code == 401
+    assert client.post("/mcp/tool/list_files", params={"token": "wrong"}, json={}).status_code == 401
+    assert ctrl.stats["rejected"] == 0 and ctrl.in_flight == 1
+
+def test_token_bridge_answers_429_with_retry_after(token_bridge, monkeypatch):
+    ctrl = _saturated()
+    monkeypatch.setattr(token_bridge, "_admission", ctrl)
+    resp = TestClient(token_bridge.app).get("/mcp/audit", params={"token": "secret"})
+    assert resp.status_code == 429
+    assert int(resp.headers["Retry-After"]) >= 1
+    assert ctrl.stats["rejected"] == 1
+
+    free = srv.AdmissionController()
+    monkeypatch.setattr(token_bridge, "_admission", free)
+    assert TestClient(token_bridge.app).get("/mcp/audit", params={"token": "secret"}).status_code == 200
+    assert free.stats["admitted"] == 1 and free.in_flight == 0
+
+def test_oauth_bridge_rejects_bad_token_before_admission(oauth_bridge, monkeypatch):
+    ctrl = _saturated()
+    monkeypatch.setattr(srv, "_admission", ctrl)
+    client = TestClient(oauth_bridge.app)
+    assert client.get("/mcp/audit").status_code == 401
+
+    pytest.importorskip("jose")
+    async def jwks():
+        return {"keys": []}
+    monkeypatch.setattr(oauth_bridge, "_get_jwks", jwks)
+    resp = client.get("/mcp/audit", headers={"Authorization": "Bearer not-a-jwt"})
+    assert resp.status_code == 401
+    assert ctrl.stats["rejected"] == 0 and ctrl.in_flight == 1
+
+def test_oauth_bridge_answers_429_with_retry_after(oauth_bridge, monkeypatch):
+    jose_jwt = pytest.importorskip("jose.jwt")
+    async def jwks():
+        return {"keys": []}
+    monkeypatch.setattr(oauth_bridge, "_get_jwks", jwks)
+    monkeypatch.setattr(jose_jwt, "decode", lambda token, *a, **kw: {"sub": "client-a"})
+    ctrl = _saturated()
+    monkeypatch.setattr(srv, "_admission", ctrl)
+    client = TestClient(oauth_bridge.app)
+    resp = client.get("/mcp/audit", headers={"Authorization": "Bearer t"})
+    assert resp.status_code == 429
+    assert int(resp.headers["Retry-After"]) >= 1
+    assert ctrl.stats["rejected"] == 1
+
+    free = srv.AdmissionController()
+    monkeypatch.setattr(srv, "_admission", free)
+    assert client.get("/mcp/audit", headers={"Authorization": "Bearer t"}).status_code == 200
+    assert free.stats["admitted"] == 1 and free.in_flight == 0
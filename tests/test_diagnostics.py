@@ -0,0 +1,188 @@
+import os
+import time
+import json
+from pathlib import Path
+
+import pytest
+import cursor_mcp_server as srv
+
+@pytest.fixture(autouse=True)
+def _tmp_workspace(tmp_path, monkeypatch):
+    ws = tmp_path / "ws"
+    ws.mkdir()
+    (ws / "src").mkdir()
+    (ws / "src" / "a.py").write_text("x = 1\n# TODO\n", encoding="utf-8")
+    monkeypatch.setattr(srv, "WORKSPACE_DIR", ws.resolve())
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", tmp_path / "audit.log")
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    srv.rate_read.events.clear()
+    srv._profiler.disarm()
+    srv._profiler.captures.clear()
+    yield ws
+    srv._profiler.disarm()
+
+@pytest.mark.asyncio
+async def test_profile_next_call_of_tool():
+    di = await srv.get_diagnostics(profile_tool="search_code", profile_calls=1)
+    assert di["profiler"]["armed"] is True
+    
+    await srv.list_files(".")  # other tools are not captured
+    await srv.search_code("TODO")
+    
+    di = await srv.get_diagnostics()
+    prof = di["profiler"]
+    assert prof["armed"] is False
+    assert len(prof["captures"]) == 1
+    cap = prof["captures"][0]
+    assert cap["tool"] == "search_code" and cap["top_functions"]
+    assert cap["profile_path"].startswith(str(srv.WORKSPACE_DIR / ".mcp_cache" / "profiles"))
+    assert cap["concurrent_calls"] == 0 and "across awaits" in prof["note"]
+
+@pytest.mark.asyncio
+async def test_profile_capture_counts_overlapping_calls():
+    import asyncio
+    
+    await srv.get_diagnostics(profile_tool="search_code", profile_calls=1)
+    await asyncio.gather(srv.search_code("TODO"), srv.list_files("."))  # list_files runs while search_code awaits
+    cap = (await srv.get_diagnostics())["profiler"]["captures"][0]
+    assert cap["tool"] == "search_code" and cap["concurrent_calls"] == 1
+    assert srv._profiler.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_profile_write_failure_keeps_tool_result(monkeypatch):
+    def read_only(*parts):
+        raise OSError("read-only file system")
+    monkeypatch.setattr(srv, "_cache_dir", read_only)
+    await srv.get_diagnostics(profile_tool="list_files", profile_calls=1)
+    assert "src/a.py" in await srv.list_files(".")
+    cap = srv._profiler.captures[-1]
+    assert cap["tool"] == "list_files" and cap["profile_path"] is None
+
+@pytest.mark.asyncio
+async def test_profile_unknown_tool_rejected():
+    with pytest.raises(ValueError):
+        await srv.get_diagnostics(profile_tool="nope")
+
+@pytest.mark.asyncio
+async def test_stage_timings_collected():
+    with srv.collect_stage_timings() as stages:
+        await srv.search_code("TODO")
+        await srv.read_file("src/a.py")
+    assert {"walk", "match", "read_decode", "regex_scan", "audit_write", "total"} <= set(stages["search_code"])
+    assert {"safe_join", "read_decode", "audit_write"} <= set(stages["read_file"])
+    
+    di = await srv.get_diagnostics()
+    assert di["stages"]["search_code"]["walk"]["count"] >= 1
+    assert any(line.startswith("cursor_tool_stage_duration_ms_bucket") for line in srv._stage_metrics.prometheus_lines())
+
+@pytest.mark.asyncio
+async def test_command_telemetry_persists_and_aggregates(monkeypatch):
+    telemetry = srv.CommandTelemetry(enabled=True)
+    monkeypatch.setattr(srv, "_command_telemetry", telemetry)
+    monkeypatch.setattr(srv.rate_cmd, "max_ops", 1000)
+    await srv.run_command("python --version")
+    for ms in range(1, 101):
+        telemetry.record("pytest -q", 1 if ms % 10 == 0 else 0, ms, 100 * ms)
+    telemetry.record("pytest -q", -1, 60000, 0, timed_out=True)
+    telemetry.flush()
+    assert telemetry.stats["recorded"] == 102 and telemetry._thread.name == "mcp-command-telemetry"
+
+    # A fresh instance reads the same SQLite file
+    stats = {e["last_command"]: e for e in srv.CommandTelemetry(enabled=True).summary()}
+    assert stats["python --version"]["count"] == 1 and stats["python --version"]["failure_rate"] == 0
+    pytest_stats = stats["pytest -q"]
+    assert pytest_stats["count"] == 101 and pytest_stats["timeouts"] == 1
+    assert pytest_stats["failure_rate"] == round(11 / 101, 3)
+    assert pytest_stats["duration_ms"]["p50"] == 51 and pytest_stats["duration_ms"]["p99"] == 100
+    assert pytest_stats["regressed"] is True  # the last 20 runs are the slowest
+    di = await srv.get_diagnostics()
+    assert di["command_telemetry"]["patterns"][0]["last_command"] == "pytest -q"
+
+@pytest.mark.asyncio
+async def test_audit_query_filters_across_segments(monkeypatch):
+    monkeypatch.setattr(srv, "_audit_index", srv.AuditIndex())
+    log = srv.AUDIT_LOG_PATH
+    # Rotated segment with an old-format line (args before ts) and old timestamps
+    rotated = Path(f"{log}.1")
+    rotated.write_text(
+        json.dumps({"args": {}, "ts": 1000.0, "tool": "read_file", "ok": True, "meta": {}}) + "\n", encoding="utf-8")
+    for i in range(200):
+        srv.write_audit(srv.AuditEntry(2000.0 + i * 10, "list_files", {"i": i}, True, {}))
+    with srv.audit_client("alice"):
+        srv.write_audit(srv.AuditEntry(5000.0, "run_command", {"command": "pytest"}, False, {}))
+    
+    res = await srv.audit_query(tool="run_command")
+    assert [(e["tool"], e["client"], e["ok"]) for e in res["entries"]] == [("run_command", "alice", False)]
+    assert res["skipped_bytes"] > 0
+    
+    res = await srv.audit_query(tool="read_file")
+    assert [e["ts"] for e in res["entries"]] == [1000.0]
+    
+    res = await srv.audit_query(tool="list_files", since=2500, until=2600)
+    assert [e["args"]["i"] for e in res["entries"]] == [60, 59, 58, 57, 56, 55, 54, 53, 52, 51, 50]
+    
+    res = await srv.audit_query(tool="list_files", limit=3)
+    assert res["truncated"] and [e["args"]["i"] for e in res["entries"]] == [199, 198, 197]
+    
+    assert (await srv.audit_query(client="bob"))["entries"] == []
+    assert Path(f"{log}.idx").exists()
+    
+    # Appended lines are indexed incrementally
+    srv.write_audit(srv.AuditEntry(6000.0, "run_command", {}, True, {}))
+    res = await srv.audit_query(tool="run_command", ok=True)
+    assert [e["ts"] for e in res["entries"]] == [6000.0]
+
+@pytest.mark.asyncio
+async def test_audit_rotation_compresses_and_expires(monkeypatch):
+    monkeypatch.setattr(srv, "_audit_index", srv.AuditIndex())
+    rotator = srv.AuditRotator()
+    monkeypatch.setattr(rotator, "request", lambda: None)  # passes run inline below
+    monkeypatch.setattr(srv, "_audit_rotator", rotator)
+    monkeypatch.setattr(srv, "_MAX_AUDIT_BYTES", 2000)
+    log = srv.AUDIT_LOG_PATH
+    legacy = Path(f"{log}.1")
+    legacy.write_text(json.dumps({"ts": 500.0, "tool": "read_file", "ok": True, "args": {}, "meta": {}}) + "\n", encoding="utf-8")
+    os.utime(legacy, (time.time() - 3600, time.time() - 3600))
+    for i in range(60):
+        srv.write_audit(srv.AuditEntry(1000.0 + i * 400, "run_command" if i % 10 == 0 else "list_files", {"i": i}, True, {}))
+    
+    rotator.run_once()
+    rotated = [p for p, _ in srv._rotated_audit_segments()]
+    assert len(rotated) == 2 and all(p.suffix == ".gz" and Path(f"{p}.idx").exists() for p in rotated)
+    assert not log.exists() and not legacy.exists()
+    assert rotator.stats["bytes_out"] < rotator.stats["bytes_in"]
+    
+    srv.write_audit(srv.AuditEntry(99000.0, "run_command", {"i": 60}, True, {}))
+    res = await srv.audit_query(tool="run_command")
+    assert [e["args"]["i"] for e in res["entries"]] == [60, 50, 40, 30, 20, 10, 0]
+    assert res["skipped_bytes"] > 0
+    
+    # A compressed segment whose sidecar is lost is re-indexed from its gzip members
+    for p in rotated:
+        Path(f"{p}.idx").unlink()
+    monkeypatch.setattr(srv, "_audit_index", srv.AuditIndex())
+    res = await srv.audit_query(tool="read_file")
+    assert [e["ts"] for e in res["entries"]] == [500.0]
+    assert (await srv.audit_query(tool="list_files", since=1400, until=1800))["entries"][0]["args"]["i"] == 2
+    
+    monkeypatch.setattr(srv, "AUDIT_RETAIN_DAYS", 1 / 48)  # 30 minutes
+    rotator.run_once()
+    assert [p for p, _ in srv._rotated_audit_segments()] == rotated[:1]
+    assert rotator.stats["expired"] == 1
+
+@pytest.mark.asyncio
+async def test_rotated_audit_segments_in_workspace_are_not_listed(_tmp_workspace, monkeypatch):
+    log = _tmp_workspace / ".mcp_audit.log"  # the default location
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", log)
+    monkeypatch.setattr(srv, "_audit_index", srv.AuditIndex())
+    monkeypatch.setattr(srv, "_audit_rotator", srv.AuditRotator())
+    monkeypatch.setattr(srv, "_workspace_index", srv.WorkspaceIndex())
+    monkeypatch.setattr(srv, "_MAX_AUDIT_BYTES", 2000)
+    for i in range(30):
+        srv.write_audit(srv.AuditEntry(1000.0 + i, "list_files", {"i": i}, True, {}))
+    srv._audit_rotator.run_once()
+    assert srv._rotated_audit_segments() and list(_tmp_workspace.glob(".mcp_audit.log.*.idx"))
+    
+    assert await srv.list_files(".", "**/*") == ["src/a.py"]
+    with pytest.raises(PermissionError):
+        await srv.read_file(srv._rotated_audit_segments()[0][0].name)
@@ -0,0 +1,125 @@
+import asyncio
+import sys
+import pytest
+import cursor_mcp_server as srv
+
+@pytest.fixture
+def ws(tmp_path, monkeypatch):
+    ws = tmp_path / "ws"
+    (ws / "src").mkdir(parents=True)
+    (ws / "src" / "app.py").write_text("def main():\n    pass\n", encoding="utf-8")
+    (ws / "README.md").write_text("# Demo\n", encoding="utf-8")
+    monkeypatch.setattr(srv, "WORKSPACE_DIR", ws.resolve())
+    monkeypatch.setattr(srv, "_workspace_index", srv.WorkspaceIndex())
+    monkeypatch.setattr(srv, "_symbol_index", srv.SymbolIndex(ttl=3600))
+    monkeypatch.setattr(srv, "_workspace_stats", srv.WorkspaceStats(ttl=3600))
+    return ws
+
+async def _wait_for(predicate, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "change batch not published"
+        await asyncio.sleep(0.02)
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["poll", "inotify"])
+async def test_watcher_invalidates_indexes(ws, monkeypatch, mode):
+    if mode == "inotify" and not sys.platform.startswith("linux"):
+        pytest.skip("inotify requires Linux")
+    watcher = srv.FileChangeWatcher(mode=mode, debounce_ms=20, poll_s=0.05, notify=False)
+    monkeypatch.setattr(srv, "_fs_watcher", watcher)
+    watcher.subscribe(srv._invalidate_changed)
+    assert watcher.start()
+    try:
+        srv._symbol_index.refresh()
+        assert srv._workspace_stats.snapshot()["totals"]["files"] == 2
+        # Nothing changed: the index walk is skipped entirely
+        skips = srv._workspace_index.stats["watch_skips"]
+        assert srv._workspace_index.refresh() is False
+        assert srv._workspace_index.stats["watch_skips"] == skips + 1
+
+        (ws / "src" / "app.py").write_text("def main():\n    pass\n\nclass Runner:\n    pass\n", encoding="utf-8")
+        (ws / "src" / "util.py").write_text("def helper():\n    pass\n", encoding="utf-8")
+        await _wait_for(lambda: {"src/app.py", "src/util.py"} <= srv._symbol_index.dirty)
+        refreshes = srv._symbol_index.stats["refreshes"]
+        srv._symbol_index.refresh()
+        assert srv._symbol_index.stats["refreshes"] == refreshes  # served from dirty paths, no full pass
+        assert srv._symbol_index.find("Runner")[0]["file"] == "src/app.py"
+        assert srv._symbol_index.find("helper")[0]["file"] == "src/util.py"
+        assert srv._workspace_stats.snapshot()["totals"]["files"] == 3
+
+        # A new directory forces a rescan; the next index walk adds its watch
+        rescans = watcher.stats["rescans"]
+        (ws / "pkg").mkdir()
+        await _wait_for(lambda: watcher.stats["rescans"] > rescans)
+        assert not watcher.covers(watcher.epoch) and not watcher.watches("pkg")
+        assert srv._workspace_index.refresh() is False
+        assert watcher.watches("pkg") and watcher.covers(watcher.epoch)
+        (ws / "pkg" / "mod.py").write_text("x = 1\n", encoding="utf-8")
+        await _wait_for(lambda: "pkg/mod.py" in srv._symbol_index.dirty)
+        assert "pkg/mod.py" in await srv.list_files(".", "**/*.py")
+        assert srv._workspace_stats.snapshot()["totals"]["files"] == 4
+    finally:
+        watcher.stop()
+    assert not watcher.running
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["poll", "inotify"])
+async def test_audit_log_appends_are_not_workspace_changes(ws, monkeypatch, mode):
+    if mode == "inotify" and not sys.platform.startswith("linux"):
+        pytest.skip("inotify requires Linux")
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", ws.resolve() / ".mcp_audit.log")  # the default location
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    watcher = srv.FileChangeWatcher(mode=mode, debounce_ms=20, poll_s=0.05, notify=False)
+    monkeypatch.setattr(srv, "_fs_watcher", watcher)
+    await srv.list_files(".", "**/*")  # creates the audit log and .mcp_cache before watching
+    assert watcher.start()
+    try:
+        await srv.list_files(".", "**/*")  # first walk under the watcher
+        skips = srv._workspace_index.stats["watch_skips"]
+        for _ in range(5):
+            await srv.list_files(".", "**/*")
+            await asyncio.sleep(0.15)
+        assert watcher.stats["batches"] == 0
+        assert srv._workspace_index.stats["watch_skips"] == skips + 5
+        assert ".mcp_audit.log" not in await srv.list_files(".", "**/*")
+    finally:
+        watcher.stop()
+
+@pytest.mark.asyncio
+async def test_path_cache_tracks_symlink_swaps(ws, monkeypatch, tmp_path):
+    if not sys.platform.startswith("linux"):
+        pytest.skip("inotify requires Linux")
+    watcher = srv.FileChangeWatcher(mode="inotify", debounce_ms=20, notify=False)
+    monkeypatch.setattr(srv, "_fs_watcher", watcher)
+    monkeypatch.setattr(srv, "_path_resolver", srv.PathResolver())
+    outside = tmp_path / "secret.txt"
+    outside.write_text("x", encoding="utf-8")
+    assert watcher.start()
+    try:
+        assert srv.safe_join("src/app.py") == ws.resolve() / "src" / "app.py"
+        assert srv.safe_join("src/app.py") == ws.resolve() / "src" / "app.py"
+        assert srv._path_resolver.stats["hits"] == 1
+        
+        # Replacing a cached path with an escaping symlink is seen by the very next
+        # lookup, before the watcher thread has necessarily read the events
+        (ws / "src" / "app.py").unlink()
+        (ws / "src" / "app.py").symlink_to(outside)
+        with pytest.raises(PermissionError):
+            srv.safe_join("src/app.py")
+        # Paths through symlinks are resolved every time
+        (ws / "link").symlink_to(ws / "src", target_is_directory=True)
+        assert srv.safe_join("link/util.py") == ws.resolve() / "src" / "util.py"
+        assert str(ws.resolve() / "link" / "util.py") not in srv._path_resolver._cache
+    finally:
+        watcher.stop()
+    # Without a watcher nothing is cached
+    hits = srv._path_resolver.stats["hits"]
+    srv.safe_join("README.md")
+    srv.safe_join("README.md")
+    assert srv._path_resolver.stats["hits"] == hits
+
+def test_safe_join_many_rejects_escapes(ws):
+    assert srv.safe_join_many(["README.md", "src"]) == [ws.resolve() / "README.md", ws.resolve() / "src"]
+    with pytest.raises(PermissionError):
+        srv.safe_join_many(["README.md", "../outside"])
@@ -0,0 +1,56 @@
+import pytest
+import cursor_mcp_server as srv
+
+@pytest.fixture(autouse=True)
+def _tmp_workspace(tmp_path, monkeypatch):
+    ws = tmp_path / "ws"
+    for d in ("src/gen", "build/lib", "pkg/logs"):
+        (ws / d).mkdir(parents=True)
+    files = {
+        ".gitignore": "build/\n*.log\n/gen.txt\n",
+        ".ignore": "src/gen/\n",
+        "pkg/.gitignore": "!keep.log\n",
+        "src/app.py": "needle = 1\n",
+        "src/gen/out.py": "needle = 2\n",
+        "build/lib/app.py": "needle = 3\n",
+        "debug.log": "x\n",
+        "pkg/keep.log": "x\n",
+        "pkg/logs/other.log": "x\n",
+        "gen.txt": "x\n",
+        "pkg/gen.txt": "x\n",
+    }
+    for rel, text in files.items():
+        (ws / rel).write_text(text, encoding="utf-8")
+    monkeypatch.setattr(srv, "WORKSPACE_DIR", ws.resolve())
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", tmp_path / "audit.log")
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    srv.rate_read.events.clear()
+    monkeypatch.setattr(srv, "_workspace_index", srv.WorkspaceIndex())
+    monkeypatch.setattr(srv, "_ignore_engine", srv.IgnoreEngine())
+    return ws
+
+@pytest.mark.asyncio
+async def test_list_files_honours_nested_ignore_files(_tmp_workspace):
+    files = await srv.list_files(".", "**/*")
+    assert files == [".gitignore", ".ignore", "pkg/.gitignore", "pkg/gen.txt", "pkg/keep.log", "src/app.py"]
+    everything = await srv.list_files(".", "**/*.py", respect_gitignore=False)
+    assert everything == ["build/lib/app.py", "src/app.py", "src/gen/out.py"]
+    assert await srv.list_files("build", "**/*") == ["build/lib/app.py"]  # explicitly targeted
+    
+    (_tmp_workspace / ".ignore").write_text("", encoding="utf-8")
+    assert "src/gen/out.py" in await srv.list_files(".", "**/*.py")
+
+@pytest.mark.asyncio
+async def test_search_code_skips_ignored(_tmp_workspace):
+    hits = await srv.search_code("needle")
+    assert [h["file"] for h in hits] == ["src/app.py"]
+    hits = await srv.search_code("needle", respect_gitignore=False)
+    assert sorted(h["file"] for h in hits) == ["build/lib/app.py", "src/app.py", "src/gen/out.py"]
+
+def test_ignore_rule_semantics():
+    rules = srv.IgnoreRules("", ["/a/**/b", "doc/*.txt", "**/tmp", "*.o", "!keep.o", "out/"])
+    assert rules.match("a/b", False) and rules.match("a/x/y/b", False)
+    assert rules.match("doc/x.txt", False) and rules.match("sub/doc/x.txt", False) is None
+    assert rules.match("x/y/tmp", True) and rules.match("tmp", False)
+    assert rules.match("src/m.o", False) and rules.match("src/keep.o", False) is False
+    assert rules.match("out", True) and rules.match("out", False) is None
@@ -0,0 +1,117 @@
+import pytest
+import cursor_mcp_server as srv
+
+@pytest.fixture
+def ws(tmp_path, monkeypatch):
+    ws = tmp_path / "ws"
+    (ws / "src" / "pkg").mkdir(parents=True)
+    (ws / "tests").mkdir()
+    (ws / "src" / "pkg" / "__init__.py").write_text("", encoding="utf-8")
+    (ws / "src" / "pkg" / "core.py").write_text("def add(a, b):\n    return a + b\n", encoding="utf-8")
+    (ws / "src" / "pkg" / "api.py").write_text("from .core import add\n\ndef total(xs):\n    return sum(xs)\n", encoding="utf-8")
+    (ws / "src" / "pkg" / "cli.py").write_text("import json\n", encoding="utf-8")
+    (ws / "tests" / "conftest.py").write_text("import sys\nsys.path.insert(0, 'src')\n", encoding="utf-8")
+    (ws / "tests" / "test_core.py").write_text("from pkg.core import add\n\ndef test_add():\n    assert add(1, 2) == 3\n", encoding="utf-8")
+    (ws / "tests" / "test_api.py").write_text("from pkg import api\n\ndef test_total():\n    assert api.total([1, 2]) == 3\n", encoding="utf-8")
+    (ws / "tests" / "test_cli.py").write_text("import pkg.cli\n\ndef test_cli():\n    pass\n", encoding="utf-8")
+    monkeypatch.setattr(srv, "WORKSPACE_DIR", ws.resolve())
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", tmp_path / "audit.log")
+    monkeypatch.setattr(srv.rate_cmd, "max_ops", 1000)
+    monkeypatch.setattr(srv, "_workspace_index", srv.WorkspaceIndex())
+    monkeypatch.setattr(srv, "_symbol_index", srv.SymbolIndex(ttl=0))
+    monkeypatch.setattr(srv, "_workspace_manifest", srv.WorkspaceManifest())
+    monkeypatch.setattr(srv, "_import_graph", srv.ImportGraph())
+    return ws
+
+@pytest.mark.asyncio
+async def test_selection_follows_import_graph(ws):
+    core = await srv.run_impacted_tests(changed=["src/pkg/core.py"], dry_run=True)
+    assert core["selected"] == ["tests/test_api.py", "tests/test_core.py"]  # api imports core relatively
+    cli = await srv.run_impacted_tests(changed=["src/pkg/cli.py"], dry_run=True)
+    assert cli["selected"] == ["tests/test_cli.py"]
+    init = await srv.run_impacted_tests(changed=["src/pkg/__init__.py"], dry_run=True)
+    assert init["selected"] == ["tests/test_api.py", "tests/test_cli.py", "tests/test_core.py"]
+    conf = await srv.run_impacted_tests(changed=["pyproject.toml"], dry_run=True)
+    assert conf["reason"] == "config_changed" and conf["selected"] is None
+
+@pytest.mark.asyncio
+async def test_last_green_baseline(ws):
+    first = await srv.run_impacted_tests()
+    assert first["reason"] == "no_baseline" and first["ran"] and first["returncode"] == 0
+    assert first["baseline_updated"]
+
+    (ws / "src" / "pkg" / "cli.py").write_text("import json\nVERSION = 2\n", encoding="utf-8")
+    second = await srv.run_impacted_tests()
+    assert second["changed"] == ["src/pkg/cli.py"]
+    assert second["command"] == "python -m pytest -q tests/test_cli.py"
+    assert second["returncode"] == 0 and second["baseline_updated"]
+
+    again = await srv.run_impacted_tests(dry_run=True)
+    assert again["changed"] == [] and again["selected"] == []
+
+@pytest.mark.asyncio
+async def test_deleted_and_unmapped_changes_are_not_skipped(ws):
+    assert (await srv.run_impacted_tests())["baseline_updated"]
+    
+    (ws / "src" / "pkg" / "core.py").unlink()
+    gone = await srv.run_impacted_tests()
+    assert gone["changed"] == ["src/pkg/core.py"]
+    assert gone["selected"] == ["tests/test_api.py", "tests/test_core.py"]
+    assert gone["ran"] and gone["returncode"] != 0 and not gone["baseline_updated"]
+    
+    (ws / "src" / "pkg" / "core.py").write_text("def add(a, b):\n    return a + b\n", encoding="utf-8")
+    (ws / "tests" / "data.json").write_text("{}", encoding="utf-8")
+    data = await srv.run_impacted_tests()
+    assert data["reason"] == "unmapped_changes" and data["unmapped"] == ["tests/data.json"]
+    assert data["selected"] is None and data["ran"] and data["baseline_updated"]
+
+@pytest.mark.asyncio
+async def test_audit_log_in_workspace_is_not_a_change(ws, monkeypatch):
+    # The default audit log lives in the workspace; tool calls append to it
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", ws.resolve() / ".mcp_audit.log")
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    assert (await srv.run_impacted_tests(run_all=True))["baseline_updated"]
+    await srv.read_file("src/pkg/core.py")
+    assert (ws / ".mcp_audit.log").stat().st_size > 0
+    again = await srv.run_impacted_tests(dry_run=True)
+    assert again["reason"] == "import_graph" and again["changed"] == [] and again["unmapped"] == []
+
+def test_balance_shards_longest_first():
+    shards = srv._balance_shards({"a": 5.0, "b": 4.0, "c": 3.0, "d": 3.0, "e": 1.0}, 2)
+    loads = sorted(sum({"a": 5.0, "b": 4.0, "c": 3.0, "d": 3.0, "e": 1.0}[f] for f in s) for s in shards)
+    assert loads == [8.0, 8.0]
+    assert srv._merge_returncodes([0, 5]) == 0 and srv._merge_returncodes([5, 1, 0]) == 1
+
+@pytest.mark.asyncio
+async def test_sharded_pytest_run_merges_results(ws, monkeypatch):
+    monkeypatch.setattr(srv, "_command_slots", srv.CommandSlots(4))
+    (ws / "tests" / "test_slow.py").write_text("import time\n\ndef test_slow():\n    time.sleep(0.3)\n", encoding="utf-8")
+    (ws / "tests" / "test_broken.py").write_text("class TestBroken:\n    def test_fails(self):\n        assert False\n", encoding="utf-8")
+    result = await srv.run_command("python -m pytest -q", timeout_seconds=120, shards=2)
+    assert len(result["shards"]) == 2
+    assert result["returncode"] == 1
+    assert result["summary"]["tests"] == 5 and result["summary"]["failures"] == 1
+    assert result["failed"] == ["tests/test_broken.py::TestBroken::test_fails"]
+    assert result["stdout"].startswith("5 tests, 1 failed")
+    durations = srv._load_durations()
+    assert set(durations) == {"tests/test_core.py", "tests/test_api.py", "tests/test_cli.py", "tests/test_slow.py", "tests/test_broken.py"}
+    assert durations["tests/test_slow.py"] >= 0.3
+    assert srv._command_slots.in_use == 0
+
+@pytest.mark.asyncio
+async def test_sharded_run_splits_explicit_paths(ws, monkeypatch):
+    monkeypatch.setattr(srv, "_command_slots", srv.CommandSlots(4))
+    result = await srv.run_command("python -m pytest -q tests/test_core.py tests/test_api.py -k test", timeout_seconds=120, shards=2)
+    assert len(result["shards"]) == 2 and [s["files"] for s in result["shards"]] == [1, 1]
+    assert result["returncode"] == 0 and result["summary"]["tests"] == 2  # each file runs once; test_cli not at all
+
+@pytest.mark.asyncio
+async def test_sharded_timeout_cleans_up(ws, monkeypatch):
+    monkeypatch.setattr(srv, "_command_slots", srv.CommandSlots(4))
+    (ws / "tests" / "test_hang.py").write_text("import time\n\ndef test_hang():\n    time.sleep(30)\n", encoding="utf-8")
+    with pytest.raises(TimeoutError):
+        await srv.run_command("python -m pytest -q", timeout_seconds=5, shards=2)
+    assert not list(srv._cache_dir("test_impact").glob("shards-*"))
+    last = srv.json.loads(srv.AUDIT_LOG_PATH.read_text(encoding="utf-8").splitlines()[-1])
+    assert last["tool"] == "run_command" and not last["ok"] and last["meta"]["timeout"] == 5
+    assert srv._command_slots.in_use == 0
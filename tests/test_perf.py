@@ -1,3 +1,6 @@
+import os
+import subprocess
+import sys
 import time
 import pytest
 import cursor_mcp_server as srv
@@ -18,3 +21,39 @@ async def test_list_perf_budget(tmp_path, monkeypatch):
     assert len(files) == 500
     assert (time.perf_counter() - t0) < 2.0
 
+
+def test_bench_suite_smoke(tmp_path):
+    import bench_mcp_tools as bench
+    
+    ws = tmp_path / "bench_ws"
+    manifest = bench.generate_workspace(ws, files=60, depth=3, vendor_fraction=0.3, large_text=1, large_binary=1)
+    assert (ws / "node_modules").is_dir()
+    
+    doc = bench.run_benchmark(ws, manifest, ["list_files", "read_file"], iterations=3, isolate=False)
+    for tool in ("list_files", "read_file"):
+        r = doc["results"][tool]
+        assert r["errors"] == 0
+        assert r["p50_ms"] <= r["p95_ms"] <= r["p99_ms"]
+    
+    slower = {"results": {"list_files": {"p50_ms": 1e-6, "p95_ms": 1e-6, "p99_ms": 1e-6}}}
+    assert bench.compare_results(doc, slower)
+
+
+def test_import_defers_sdk_and_optional_deps():
+    code = "import sys, cursor_mcp_server; print(sorted(m for m in ('mcp.server', 'mcp.types', 'opentelemetry') if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=60,
+                         cwd=os.path.dirname(srv.__file__))
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.strip() == "[]"
+
+
+@pytest.mark.parametrize("module", ["cursor_mcp_server", "http_mcp_bridge"])
+def test_startup_budget(tmp_path, monkeypatch, module):
+    # The first request builds the MCP SDK server (stdio) or the FastAPI app (bridge)
+    pytest.importorskip("fastapi" if module == "http_mcp_bridge" else "mcp")
+    monkeypatch.setattr(srv, "WORKSPACE_DIR", tmp_path)
+    report = srv.startup_report(module)
+    assert report["first_call_ms"] is not None  # import through first successful request
+    # Shared CI runners are noisy: allow headroom over MCP_STARTUP_BUDGET_MS (tunable per runner)
+    limit = report["budget_ms"] * float(os.environ.get("MCP_STARTUP_BUDGET_HEADROOM", 1.5))
+    assert report["total_ms"] <= limit, f"{report['total_ms']}ms > {limit}ms: {report['slowest_imports'][:5]}"
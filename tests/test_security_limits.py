@@ -1,9 +1,11 @@
+import asyncio
 import pytest
 import cursor_mcp_server as srv
 
 @pytest.mark.asyncio
 async def test_rate_limits(monkeypatch):
-    srv.rate_read.max_ops = 3
+    monkeypatch.setattr(srv.rate_read, "max_ops", 3)
+    srv.rate_read.events.clear()
     for _ in range(3):
         try:
             await srv.list_files(".")
@@ -12,3 +14,47 @@ async def test_rate_limits(monkeypatch):
     with pytest.raises(RuntimeError):
         await srv.list_files(".")
 
+
+@pytest.mark.asyncio
+async def test_admission_round_robin_and_shedding():
+    adm = srv.AdmissionController(max_concurrent=2, per_client=2, queue_per_client=3, queue_total=4, queue_timeout_s=5)
+    gate = asyncio.Event()
+    order = []
+    
+    async def request(client, tag):
+        async with adm.admit(client):
+            order.append(tag)
+            await gate.wait()
+    
+    # "big" fills both slots and queues three more; "small" arrives later with one request
+    tasks = [asyncio.create_task(request("big", f"big{i}")) for i in range(5)]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(request("small", "small0")))
+    await asyncio.sleep(0)
+    assert order == ["big0", "big1"] and adm.queued == 4
+    
+    # Per-client and total queue bounds reject immediately with a retry hint
+    with pytest.raises(srv.AdmissionRejected) as e:
+        async with adm.admit("big"):
+            pass
+    assert e.value.retry_after >= 1
+    with pytest.raises(srv.AdmissionRejected):
+        async with adm.admit("other"):
+            pass
+    
+    gate.set()
+    await asyncio.gather(*tasks)
+    # Freed slots alternate between clients: the late client is not served after big's whole backlog
+    assert order == ["big0", "big1", "big2", "small0", "big3", "big4"]
+    assert adm.in_flight == 0 and adm.queued == 0 and adm.stats["rejected"] == 2
+
+@pytest.mark.asyncio
+async def test_admission_queue_timeout_releases_cleanly():
+    adm = srv.AdmissionController(max_concurrent=1, per_client=1, queue_per_client=2, queue_total=2, queue_timeout_s=0.05)
+    async with adm.admit("a"):
+        with pytest.raises(srv.AdmissionRejected):
+            async with adm.admit("b"):
+                pass
+        assert adm.queued == 0 and adm.stats["timed_out"] == 1
+    async with adm.admit("b"):
+        assert adm.in_flight == 1
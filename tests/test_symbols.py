@@ -0,0 +1,50 @@
+import os
+import pytest
+import cursor_mcp_server as srv
+
+@pytest.fixture(autouse=True)
+def _tmp_workspace(tmp_path, monkeypatch):
+    ws = tmp_path / "ws"
+    (ws / "pkg").mkdir(parents=True)
+    (ws / "web" / "node_modules" / "dep").mkdir(parents=True)
+    (ws / "pkg" / "models.py").write_text(
+        "import os\nfrom .base import Base as B\n\nLIMIT = 3\n\nclass Widget(B):\n    def render(self):\n        pass\n\nasync def load_widget():\n    pass\n",
+        encoding="utf-8",
+    )
+    (ws / "web" / "app.ts").write_text(
+        "import { api } from './api';\n\nexport interface Props { id: number }\n\nexport class Widget {\n  render(p: Props): string {\n    return '';\n  }\n}\n\nexport const loadWidget = async (id: number) => api(id);\n",
+        encoding="utf-8",
+    )
+    (ws / "web" / "node_modules" / "dep" / "index.js").write_text("class Widget {}\n", encoding="utf-8")
+    monkeypatch.setattr(srv, "WORKSPACE_DIR", ws.resolve())
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", tmp_path / "audit.log")
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    monkeypatch.setattr(srv.rate_write, "max_ops", 1000)
+    srv.rate_read.events.clear()
+    monkeypatch.setattr(srv, "_symbol_index", srv.SymbolIndex())
+    return ws
+
+@pytest.mark.asyncio
+async def test_find_symbol_python_and_ts():
+    hits = await srv.find_symbol("Widget", kind="class")
+    assert {h["file"] for h in hits} == {"pkg/models.py", "web/app.ts"}  # node_modules is denylisted
+    
+    methods = await srv.find_symbol("render", kind="method")
+    assert {(h["file"], h["parent"]) for h in methods} == {("pkg/models.py", "Widget"), ("web/app.ts", "Widget")}
+    
+    fuzzy = await srv.find_symbol("load", match="prefix")
+    assert {h["name"] for h in fuzzy} == {"load_widget", "loadWidget"}
+
+@pytest.mark.asyncio
+async def test_outline_and_incremental_update(_tmp_workspace):
+    out = await srv.outline("pkg/models.py")
+    assert [(s["name"], s["kind"]) for s in out][:3] == [("os", "import"), ("B", "import"), ("LIMIT", "variable")]
+    
+    await srv.find_symbol("Widget")
+    parsed = srv._symbol_index.stats["parsed"]
+    await srv.write_file("pkg/extra.py", "def fresh():\n    pass\n", require_confirmation=False)
+    hits = await srv.find_symbol("fresh")
+    assert hits and hits[0]["file"] == "pkg/extra.py"
+    
+    srv._symbol_index.refresh(force=True)
+    assert srv._symbol_index.stats["parsed"] == parsed + 1  # unchanged files are not re-parsed
@@ -1,3 +1,4 @@
+import json
 import pytest
 import cursor_mcp_server as srv
 
@@ -46,3 +47,162 @@ async def test_search_code_regex():
     hits = await srv.search_code(r"TODO", file_glob="**/*.py")
     assert any(h["file"].endswith("a.py") for h in hits)
 
+@pytest.mark.asyncio
+async def test_search_code_skips_binaries():
+    ws = srv.WORKSPACE_DIR
+    (ws / "logo.png").write_bytes(b"\x89PNG\r\n\x1a\nTODO")
+    (ws / "blob.bin").write_bytes(b"TODO\x00\x01")
+    (ws / "wide.txt").write_bytes("TODO wide\n".encode("utf-16"))
+    hits = await srv.search_code(r"TODO\b", file_glob="**/*")
+    assert sorted(h["file"] for h in hits) == ["src/a.py", "wide.txt"]
+    assert srv._file_classifier.classify(ws / "logo.png") == ("binary", "")
+    assert srv._file_classifier.classify(ws / "wide.txt") == ("text", "utf-16")
+
+
+@pytest.mark.asyncio
+async def test_write_patch_unified_diff_and_edits():
+    target = srv.WORKSPACE_DIR / "src" / "a.py"
+    diff = (
+        "--- a/src/a.py\n+++ b/src/a.py\n"
+        "@@ -1,2 +1,2 @@\n"
+        " print('A')\n"
+        "-# TODO: refactor\n"
+        "\\ No newline at end of file\n"
+        "+# DONE\n"
+        "\\ No newline at end of file\n"
+    )
+    preview = json.loads(await srv.write_file("src/a.py", diff, mode="patch"))
+    assert preview["diff"]["added"] == 1 and preview["diff"]["removed"] == 1
+    assert "TODO" in target.read_text(encoding="utf-8")
+    
+    assert await srv.write_file("src/a.py", diff, mode="patch", require_confirmation=False) == "OK"
+    assert target.read_text(encoding="utf-8") == "print('A')\n# DONE"
+    
+    edits = [{"start_line": 1, "end_line": 1, "text": "print('B')"}]
+    assert await srv.write_file("src/a.py", mode="patch", edits=edits, require_confirmation=False) == "OK"
+    assert target.read_text(encoding="utf-8") == "print('B')\n# DONE"
+    assert not list(target.parent.glob("*.tmp"))
+    
+    with pytest.raises(ValueError):
+        await srv.write_file("src/a.py", diff, mode="patch", require_confirmation=False)
+
+@pytest.mark.asyncio
+async def test_search_code_multi_pattern_tags_hits():
+    (srv.WORKSPACE_DIR / "src" / "c.py").write_text("# FIXME later\nfoo = 1\nfoobar = 2\n(a)(a)\n", encoding="utf-8")
+    hits = await srv.search_code(patterns=[
+        {"name": "todo", "literal": "TODO"},
+        {"name": "fixme", "literal": "fixme", "ignore_case": True},
+        {"name": "foos", "literal": "foo"},
+        {"name": "foobars", "literal": "foobar"},
+        {"name": "assign", "regex": r"(?m)^\w+ = 2$"},
+        {"name": "repeat", "regex": r"(\(a\))\1"},
+    ], file_glob="src/**/*.py")
+    tagged = {(h["file"], h["line"], h["pattern"], h["match"]) for h in hits}
+    assert tagged == {
+        ("src/a.py", 2, "todo", "TODO"),
+        ("src/c.py", 1, "fixme", "FIXME"),
+        ("src/c.py", 2, "foos", "foo"),
+        ("src/c.py", 3, "foos", "foo"),
+        ("src/c.py", 3, "foobars", "foobar"),
+        ("src/c.py", 3, "assign", "foobar = 2"),
+        ("src/c.py", 4, "repeat", "(a)(a)"),
+    }
+    with pytest.raises(ValueError):
+        await srv.search_code(patterns=[{"name": "bad", "regex": "("}])
+
+@pytest.mark.asyncio
+async def test_cursor_pagination_resumes(monkeypatch):
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    ws = srv.WORKSPACE_DIR
+    for d in ("pkg", "pkg/sub", "pkg-x"):
+        (ws / d).mkdir()
+    for i in range(4):
+        (ws / "pkg" / f"m{i}.py").write_text("hit\nhit\n", encoding="utf-8")
+        (ws / "pkg" / "sub" / f"s{i}.py").write_text("hit\n", encoding="utf-8")
+        (ws / "pkg-x" / f"x{i}.py").write_text("hit\n", encoding="utf-8")
+    
+    for respect in (None, False):  # index-backed and direct walk
+        full = await srv.list_files(".", "**/*.py", respect_gitignore=respect)
+        pages, cursor = [], None
+        while True:
+            page = await srv.list_files(".", "**/*.py", max_results=5, respect_gitignore=respect, cursor=cursor, paginate=True)
+            pages.extend(page["files"])
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        assert pages == full
+    
+    full_hits = await srv.search_code("hit", file_glob="pkg*/**/*.py", max_results=1000)
+    got, cursor = [], None
+    while True:
+        page = await srv.search_code("hit", file_glob="pkg*/**/*.py", max_results=3, cursor=cursor, paginate=True)
+        got.extend(page["hits"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert [(h["file"], h["line"]) for h in got] == [(h["file"], h["line"]) for h in full_hits]
+    
+    first = await srv.list_files(".", "**/*.py", max_results=2, paginate=True)
+    with pytest.raises(ValueError):
+        await srv.list_files(".", "**/*.txt", cursor=first["next_cursor"])
+
+@pytest.mark.asyncio
+async def test_search_code_exact_page_has_no_cursor(monkeypatch):
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    monkeypatch.setattr(srv._context_tracker, "should_summarize", lambda: True)
+    for i in range(3):
+        (srv.WORKSPACE_DIR / "src" / f"p{i}.txt").write_text("hit\nhit\n", encoding="utf-8")
+    for query in ("hit", r"hi\w"):  # in-process and sandboxed scans
+        page = await srv.search_code(query, file_glob="src/p*.txt", max_results=6, paginate=True)
+        assert len(page["hits"]) == 6 and page["next_cursor"] is None
+        page = await srv.search_code(query, file_glob="src/p*.txt", max_results=3, paginate=True)
+        assert len(page["hits"]) == 3  # not summarized while paginating
+        rest = await srv.search_code(query, file_glob="src/p*.txt", max_results=3, cursor=page["next_cursor"])
+        assert [(h["file"], h["line"]) for h in rest["hits"]] == [("src/p1.txt", 2), ("src/p2.txt", 1), ("src/p2.txt", 2)]
+        assert rest["next_cursor"] is None
+
+def test_regex_precheck_flags_nested_quantifiers():
+    for risky in (r"(a+)+$", r"(?:\s*\w+)*;", r"(x+x+)+y"):
+        assert srv._regex_risk(risky)
+    for safe in (r"\w+", r"(\d+,)*\d", r"TODO|FIXME", r"def (\w+)\("):
+        assert srv._regex_risk(safe) is None
+
+@pytest.mark.asyncio
+async def test_search_code_regex_deadline_returns_partial(monkeypatch):
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    ws = srv.WORKSPACE_DIR
+    (ws / "src" / "0_fast.txt").write_text("aaaa\n", encoding="utf-8")
+    (ws / "src" / "1_slow.txt").write_text("a" * 40 + "!\n", encoding="utf-8")
+    with pytest.raises(ValueError):
+        await srv.search_code(r"(a+)+$", file_glob="src/*.txt")
+    
+    monkeypatch.setattr(srv, "REGEX_PRECHECK", "off")
+    await srv.search_code(r"warm", file_glob="src/*.txt")  # pay for the worker spawn outside the deadline
+    started = srv.time.monotonic()
+    page = await srv.search_code(r"(a+)+$", file_glob="src/*.txt", timeout_s=1.0, paginate=True)
+    assert srv.time.monotonic() - started < 10
+    assert page["timed_out"] and [h["file"] for h in page["hits"]] == ["src/0_fast.txt"]
+    rest = await srv.search_code(r"(a+)+$", file_glob="src/*.txt", cursor=page["next_cursor"])
+    assert rest["hits"] == [] and not rest["timed_out"]  # the slow file is skipped on resume
+    assert srv._regex_sandbox.stats["timeouts"] >= 1
+
+@pytest.mark.asyncio
+async def test_find_file_ranks_basename_matches(monkeypatch):
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    ws = srv.WORKSPACE_DIR
+    for rel in ("src/user_service.py", "src/services/user/models.py", "docs/usage.md", "src/UserService.ts"):
+        (ws / rel).parent.mkdir(parents=True, exist_ok=True)
+        (ws / rel).write_text("x\n", encoding="utf-8")
+    hits = await srv.find_file("usrsvc")
+    assert hits[0]["path"] in ("src/user_service.py", "src/UserService.ts")
+    assert "docs/usage.md" not in [h["path"] for h in hits]
+    assert [h["path"] for h in await srv.find_file("UserS")] == ["src/UserService.ts"]  # smart case
+    assert [h["path"] for h in await srv.find_file("user models")] == ["src/services/user/models.py"]
+    assert await srv.find_file("zzzz") == []
+    
+    refreshes = srv._file_finder.stats["refreshes"]
+    (ws / "src" / "zzzz_outside.py").write_text("x\n", encoding="utf-8")
+    assert await srv.find_file("zzzz") == []  # within the TTL the index isn't re-walked
+    assert srv._file_finder.stats["refreshes"] == refreshes
+    await srv.write_file("src/zzzz_new.py", "x\n", require_confirmation=False)
+    assert {h["path"] for h in await srv.find_file("zzzz")} == {"src/zzzz_new.py", "src/zzzz_outside.py"}
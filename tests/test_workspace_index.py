@@ -0,0 +1,199 @@
+import shutil
+import subprocess
+import pytest
+import cursor_mcp_server as srv
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="git not installed")
+
+def _git(ws, *args):
+    subprocess.run(["git", *args], cwd=ws, check=True, capture_output=True)
+
+@pytest.fixture(autouse=True)
+def _tmp_workspace(tmp_path, monkeypatch):
+    ws = tmp_path / "ws"
+    (ws / "src").mkdir(parents=True)
+    (ws / "src" / "a.py").write_text("a = 1\n", encoding="utf-8")
+    (ws / "src" / "b.py").write_text("b = 1\n", encoding="utf-8")
+    (ws / "docs").mkdir()
+    (ws / "docs" / "index.md").write_text("# Docs\n", encoding="utf-8")
+    _git(ws, "init", "-q")
+    _git(ws, "add", "-A")
+    monkeypatch.setattr(srv, "WORKSPACE_DIR", ws.resolve())
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", tmp_path / "audit.log")
+    monkeypatch.setattr(srv.rate_read, "max_ops", 1000)
+    srv.rate_read.events.clear()
+    monkeypatch.setattr(srv, "_workspace_index", srv.WorkspaceIndex())
+    return ws
+
+def test_read_git_index_matches_ls_files(_tmp_workspace):
+    entries = srv._read_git_index(_tmp_workspace / ".git" / "index")
+    out = subprocess.run(["git", "ls-files", "-s"], cwd=_tmp_workspace, capture_output=True, text=True).stdout
+    expected = {(line.split()[1], line.split("\t")[1]) for line in out.splitlines()}
+    assert {(e.sha1, e.path) for e in entries} == expected
+
+@pytest.mark.asyncio
+async def test_list_files_from_index_and_changes(_tmp_workspace):
+    ws = _tmp_workspace
+    files = await srv.list_files("src", "*.py")
+    assert files == ["src/a.py", "src/b.py"]
+    assert srv._workspace_index.get_status()["git_index"] is True
+    
+    gen = srv._workspace_index.generation
+    (ws / "src" / "a.py").write_text("a = 2\n", encoding="utf-8")
+    (ws / "src" / "new.py").write_text("n = 1\n", encoding="utf-8")
+    (ws / "docs" / "index.md").unlink()
+    changed = await srv.list_files(".", "*", changed_only=True)
+    assert changed == ["src/a.py", "src/new.py"]
+    assert srv._workspace_index.generation > gen
+    assert srv._workspace_index.git_changes()["deleted"] == ["docs/index.md"]
+    
+    listed = srv._workspace_index.stats["dirs_listed"]
+    await srv.list_files(".")
+    assert srv._workspace_index.stats["dirs_listed"] <= listed + 3  # only changed dirs are re-listed
+
+def _commit(ws, msg):
+    _git(ws, "-c", "user.name=t", "-c", "user.email=t@example.com", "commit", "-q", "-m", msg)
+
+def test_object_store_reads_packed_deltas(_tmp_workspace):
+    import hashlib
+    ws = _tmp_workspace
+    body = "".join(f"line {i}\n" for i in range(400))
+    (ws / "big.txt").write_text(body, encoding="utf-8")
+    _git(ws, "add", "-A")
+    _commit(ws, "one")
+    (ws / "big.txt").write_text(body.replace("line 200\n", "changed\n"), encoding="utf-8")
+    _git(ws, "add", "-A")
+    _commit(ws, "two")
+    _git(ws, "repack", "-adq")
+    
+    store = srv.GitObjectStore(ws / ".git")
+    out = subprocess.run(["git", "rev-list", "--all", "--objects"], cwd=ws, capture_output=True, text=True).stdout
+    for line in out.splitlines():
+        sha = line.split()[0]
+        typ, data = store.read(sha)
+        assert hashlib.sha1(f"{typ} {len(data)}\0".encode() + data).hexdigest() == sha
+
+@pytest.mark.asyncio
+async def test_git_status_and_diff(_tmp_workspace):
+    ws = _tmp_workspace
+    _commit(ws, "init")
+    (ws / "src" / "a.py").write_text("a = 2\n", encoding="utf-8")
+    (ws / "src" / "c.py").write_text("c = 1\n", encoding="utf-8")
+    _git(ws, "add", "src/c.py")
+    (ws / "docs" / "index.md").unlink()
+    (ws / "notes.txt").write_text("todo\n", encoding="utf-8")
+    
+    status = await srv.git_status()
+    assert status["staged"] == [{"path": "src/c.py", "status": "A"}]
+    assert status["unstaged"] == [{"path": "docs/index.md", "status": "D"}, {"path": "src/a.py", "status": "M"}]
+    assert status["untracked"] == ["notes.txt"]
+    
+    diff = await srv.git_diff(paths=["src"])
+    assert [f["path"] for f in diff["files"]] == ["src/a.py"]
+    assert diff["files"][0]["hunks"][0]["lines"] == ["-a = 1", "+a = 2"]
+    staged = await srv.git_diff(staged=True)
+    assert staged["files"][0]["path"] == "src/c.py" and staged["files"][0]["added"] == 1
+
+@pytest.mark.asyncio
+async def test_tracked_files_survive_ignore_rules(_tmp_workspace):
+    ws = _tmp_workspace
+    (ws / "dist").mkdir()
+    (ws / "dist" / "tracked.js").write_text("x\n", encoding="utf-8")
+    _git(ws, "add", "dist/tracked.js")
+    (ws / "dist" / "bundle.js").write_text("x\n", encoding="utf-8")
+    (ws / ".gitignore").write_text("dist/\n", encoding="utf-8")
+    files = await srv.list_files("dist", "**/*")
+    assert files == ["dist/bundle.js", "dist/tracked.js"]  # ignored base is listed in full
+    files = await srv.list_files(".", "**/*.js")
+    assert files == ["dist/tracked.js"]
+    assert srv._workspace_index.git_changes()["untracked"] == [".gitignore"]
+
+def test_workspace_stats_update_incrementally(_tmp_workspace, monkeypatch):
+    ws = _tmp_workspace
+    stats = srv.WorkspaceStats(ttl=0)
+    stats.CHUNK = 4  # line counts span read chunks
+    monkeypatch.setattr(srv, "_workspace_stats", stats)
+    assert stats.summary() == {"files": 3, "languages": [{"language": "Python", "files": 2},
+                                                         {"language": "Markdown", "files": 1}]}
+    assert stats.stats["counted"] == 0  # the summary neither stats nor reads files
+    snap = srv.workspace_stats_snapshot()
+    assert snap["totals"]["files"] == 3 and snap["totals"]["lines"] == 3
+    assert {r["language"]: r["files"] for r in snap["languages"]} == {"Python": 2, "Markdown": 1}
+    assert {r["directory"]: r["lines"] for r in snap["directories"]} == {"src": 2, "docs": 1}
+    assert stats.snapshot() is snap  # unchanged tree serves the cached snapshot
+    counted = stats.stats["counted"]
+    (ws / "src" / "a.py").write_text("a = 1\nb = 2\nc = 3\n", encoding="utf-8")
+    (ws / "docs" / "index.md").unlink()
+    snap = stats.snapshot()
+    assert stats.stats["counted"] == counted + 1
+    assert snap["totals"] == {"files": 2, "bytes": 24, "lines": 4}
+    assert [r["directory"] for r in snap["directories"]] == ["src"]
+    assert snap["largest"][0]["path"] == "src/a.py"
+
+@pytest.mark.asyncio
+async def test_workspace_delta_from_previous_root(_tmp_workspace, monkeypatch):
+    ws = _tmp_workspace
+    monkeypatch.setattr(srv, "_workspace_manifest", srv.WorkspaceManifest())
+    first = await srv.workspace_delta()
+    assert first["full"] and first["counts"]["added"] == 3
+    blobs = subprocess.run(["git", "ls-files", "-s"], cwd=ws, capture_output=True, text=True).stdout
+    assert {e["sha"] for e in first["added"]} == {line.split()[1] for line in blobs.splitlines()}
+    assert (await srv.workspace_delta(since=first["root"]))["counts"] == {"added": 0, "modified": 0, "removed": 0}
+
+    (ws / "src" / "a.py").write_text("a = 2\n", encoding="utf-8")
+    (ws / "docs" / "index.md").unlink()
+    (ws / "pkg" / "sub").mkdir(parents=True)
+    (ws / "pkg" / "sub" / "c.py").write_text("c = 1\n", encoding="utf-8")
+    delta = await srv.workspace_delta(since=first["root"])
+    assert not delta["full"] and delta["root"] != first["root"]
+    assert [e["path"] for e in delta["added"]] == ["pkg/sub/c.py"]
+    assert [e["path"] for e in delta["modified"]] == ["src/a.py"]
+    assert delta["removed"] == ["docs/index.md"]
+
+    # Reverting restores the original root hash
+    (ws / "src" / "a.py").write_text("a = 1\n", encoding="utf-8")
+    (ws / "docs" / "index.md").write_text("# Docs\n", encoding="utf-8")
+    (ws / "pkg" / "sub" / "c.py").unlink()
+    assert (await srv.workspace_delta(since=delta["root"]))["root"] == first["root"]
+
+@pytest.mark.asyncio
+async def test_workspace_delta_ignores_server_owned_files(_tmp_workspace, monkeypatch):
+    ws = _tmp_workspace
+    monkeypatch.setattr(srv, "AUDIT_LOG_PATH", ws / ".mcp_audit.log")  # the default location
+    monkeypatch.setattr(srv, "_workspace_manifest", srv.WorkspaceManifest())
+    first = await srv.workspace_delta()
+    await srv.read_file("src/a.py")
+    srv._cache_dir("symbols")
+    assert (ws / ".mcp_audit.log").exists() and (ws / srv.CACHE_DIR).is_dir()
+    delta = await srv.workspace_delta(since=first["root"])
+    assert delta["root"] == first["root"]
+    assert delta["counts"] == {"added": 0, "modified": 0, "removed": 0}
+    assert {e["path"] for e in (await srv.workspace_delta())["added"]} == {"src/a.py", "src/b.py", "docs/index.md"}
+
+@pytest.mark.asyncio
+async def test_workspace_tree_snapshots_and_diff(_tmp_workspace, monkeypatch):
+    ws = _tmp_workspace
+    monkeypatch.setattr(srv, "_tree_snapshots", srv.TreeSnapshots())
+    first = await srv.workspace_tree_snapshot()
+    assert first["full"] and first["files"] == ["docs/index.md", "src/a.py", "src/b.py"]
+    assert srv.workspace_tree_listing() == (first["version"], "\n".join(first["files"]))
+    assert srv._tree_snapshots.stats == {"builds": 1, "hits": 1}  # served from the rendered buffer
+
+    unchanged = await srv.workspace_tree_snapshot(since=first["version"])
+    assert unchanged["version"] == first["version"] and unchanged["added"] == unchanged["removed"] == []
+
+    (ws / "docs" / "index.md").unlink()
+    (ws / "src" / "c.py").write_text("c = 1\n", encoding="utf-8")
+    delta = await srv.workspace_tree_snapshot(since=first["version"])
+    assert not delta["full"] and delta["version"] != first["version"]
+    assert delta["added"] == ["src/c.py"] and delta["removed"] == ["docs/index.md"]
+    assert "files" not in delta
+    assert (await srv.workspace_tree_snapshot(since="unknown"))["full"]
+
+@pytest.mark.asyncio
+async def test_workspace_tree_resource_carries_version(_tmp_workspace, monkeypatch):
+    pytest.importorskip("mcp")
+    monkeypatch.setattr(srv, "_tree_snapshots", srv.TreeSnapshots())
+    contents = await srv.workspace_tree()
+    version, text = srv.workspace_tree_listing()
+    assert contents.text == text and contents.meta == {"version": version}  # serialized as _meta